@@ -0,0 +1,662 @@
+"""
+Streaming input preprocessing shared by the RNA pipelines.
+
+By default the pipelines convert their input (bam, fastq.gz) to uncompressed
+fastq files with NGSTk.input_to_fastq and the trimmer reads those files back.
+In streaming mode the input is instead decoded into named pipes that sit at
+the very same _R1.fastq/_R2.fastq paths, so the trimming command is built
+exactly as before and only the trimmed reads ever land on disk.
+
+It also detects the quality encoding of the input, so the trimmer can be told
+what it reads and convert phred64 on the fly, and runs FastQC on the trimmed
+reads in the background, off the critical path of the pipeline. Whole
+branches of a pipeline can be run in the background the same way.
+
+Pipelines run on the same sample can share their preprocessing through a
+cache folder: the first one converts and trims the input, the others reuse
+its trimmed reads.
+"""
+
+import atexit
+import fcntl
+import hashlib
+import json
+import os
+import re
+import shutil
+import signal
+import subprocess
+import sys
+import time
+from collections import OrderedDict
+
+
+TOOLS_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), "tools")
+
+# FastQC runs of this pipeline, by real path of the fastq file.
+_fastqc_jobs = OrderedDict()
+# Branches running in the background, by name.
+_background_branches = OrderedDict()
+
+
+def stream_input_to_fastq(ngstk, input_files, sample_name, paired_end, fastq_folder, qc=False):
+	"""
+	Streaming counterpart of NGSTk.input_to_fastq.
+
+	Builds commands that decode the input files into named pipes placed
+	where input_to_fastq would have written the fastq files. The number of
+	records seen on the way is written to one small count file per input,
+	which check_stream() later turns into the usual read count results.
+	With qc, the records are also teed into tools/read_qc.py, which writes
+	read quality reports next to the fastq files (<prefix>_R1_qc.json/html).
+
+	:param pypiper.NGSTk ngstk: toolkit of the running pipeline
+	:param list input_files: local input files, as given by merge_or_link
+	:param str sample_name: name of the sample
+	:param bool paired_end: whether the input is paired-end
+	:param str fastq_folder: folder of the (virtual) fastq files
+	:param bool qc: collect read quality metrics on the way
+	:return list: producer commands, fastq prefix, named pipes and count files
+	"""
+	if type(input_files) != list:
+		input_files = [input_files]
+	input_files = [f for f in input_files if f]
+
+	ngstk.make_sure_path_exists(fastq_folder)
+	fastq_prefix = os.path.join(fastq_folder, sample_name)
+	fifos = [fastq_prefix + "_R1.fastq"]
+	if paired_end:
+		fifos.append(fastq_prefix + "_R2.fastq")
+
+	cmds = []
+	count_files = []
+	for i, input_file in enumerate(input_files):
+		count_file = fastq_prefix + "_R" + str(i + 1) + ".counts"
+		count_files.append(count_file)
+		# One input for paired-end data means both mates come interleaved.
+		if len(input_files) == 1:
+			outputs = fifos
+			mates = ["R1", "R2"][:len(fifos)]
+		else:
+			outputs = [fifos[i]]
+			mates = ["R" + str(i + 1)]
+		qc_cmd = None
+		if qc:
+			qc_cmd = ngstk.tools.python + " " + os.path.join(TOOLS_DIR, "read_qc.py")
+			qc_cmd += " -o " + fastq_prefix + " -n " + " ".join(mates)
+
+		input_ext = ngstk.get_input_ext(input_file)
+		if input_ext == ".bam":
+			cmds.append(_bam_to_fifos(ngstk.tools.samtools, input_file, outputs, count_file, qc_cmd))
+		else:
+			decoder = ngstk.ziptool + " -d -c" if input_ext == ".fastq.gz" else "cat"
+			cmds.append(_fastq_to_fifos(decoder, input_file, outputs, count_file, qc_cmd))
+
+	return [cmds, fastq_prefix, fifos, count_files]
+
+
+def _bam_to_fifos(samtools, bam_file, fifos, count_file, qc_cmd=None):
+	"""
+	Convert an unaligned bam to fastq records written to one or two pipes,
+	alternating mates as NGSTk.bam_to_fastq_awk does. Counts records and
+	records failing vendor quality checks (flag 512). With qc_cmd, records
+	are also written to its standard input.
+	"""
+	cmd = samtools + " view " + bam_file + " | awk"
+	cmd += " -v r1=" + fifos[0] + " -v cnt=" + count_file
+	if len(fifos) > 1:
+		cmd += " -v r2=" + fifos[1]
+		cmd += r""" '{ if (NR%2==1) { rec = "@"$1"/1\n"$10"\n+\n"$11; print rec > r1 }"""
+		cmd += r""" else { rec = "@"$1"/2\n"$10"\n+\n"$11; print rec > r2 }"""
+	else:
+		cmd += r""" '{ rec = "@"$1"\n"$10"\n+\n"$11; print rec > r1;"""
+	if qc_cmd:
+		cmd += " print rec;"
+	cmd += r""" if (int($2/512)%2==1) nf++ } END { print NR, nf+0 > cnt }'"""
+	if qc_cmd:
+		cmd += " | " + qc_cmd
+	return cmd
+
+
+def _fastq_to_fifos(decoder, fastq_file, fifos, count_file, qc_cmd=None):
+	"""
+	Decode a (gzipped) fastq file into one pipe, or split interleaved mates
+	into two pipes. With qc_cmd, records are also written to its standard
+	input; for a single pipe, it does the counting too.
+	"""
+	if len(fifos) == 1:
+		cmd = decoder + " " + fastq_file + " | tee " + fifos[0]
+		if qc_cmd:
+			return cmd + " | " + qc_cmd + " -c " + count_file
+		cmd += " | wc -l | awk '{ print $1/4, \"-\" }' > " + count_file
+		return cmd
+	cmd = decoder + " " + fastq_file + " | awk"
+	cmd += " -v r1=" + fifos[0] + " -v r2=" + fifos[1] + " -v cnt=" + count_file
+	cmd += " '{ if (int((NR-1)/4)%2==0) print > r1; else print > r2;"
+	if qc_cmd:
+		cmd += " print;"
+	cmd += " } END { print NR/4, \"-\" > cnt }'"
+	if qc_cmd:
+		cmd += " | " + qc_cmd
+	return cmd
+
+
+def stream_cmd(producers, fifos, consumer, readers=False):
+	"""
+	Wrap a consumer command (e.g. the trimmer) so that it reads from named
+	pipes fed by producers running in the background.
+
+	The named pipes are created before, and removed after, the run. The
+	command fails if either side fails, including any command of a producer
+	pipeline (e.g. the decoder of a corrupt input); if the consumer dies the
+	producers are killed instead of being left blocked on a pipe nobody reads.
+
+	With readers, it is the other way around: the background commands read
+	what the foreground command writes to the named pipes (e.g. bowtie1 --un),
+	each getting its pipe as standard input. The wrapper opens both ends of
+	every pipe up front and keeps one for writing until the foreground command
+	is done, so readers of a pipe it never opened see an empty input instead
+	of waiting for it, and nothing written before a reader starts is lost.
+
+	:param list producers: commands writing to (or with readers, reading
+		from) the named pipes
+	:param list fifos: paths of the named pipes
+	:param str consumer: command reading from (or writing to) the named pipes
+	:param bool readers: whether the background commands are the readers
+	:return str: shell command to pass to pm.run(..., shell=True)
+	"""
+	# With readers, the wrapper's write and read end of each pipe: opening
+	# read-write never blocks, and makes opening read-only not block either.
+	ends = [(str(3 + 2 * i), str(4 + 2 * i)) for i in range(len(fifos))] if readers else []
+	close_writers = " ".join(w + ">&-" for w, r in ends)
+	close_readers = " ".join(r + "<&-" for w, r in ends)
+	fifo_list = " ".join(fifos)
+	cmd = ["rm -f " + fifo_list, "mkfifo " + fifo_list, "producers="]
+	if readers:
+		cmd.append("exec " + " ".join(w + "<> " + f + " " + r + "< " + f for (w, r), f in zip(ends, fifos)))
+	for i, producer in enumerate(producers):
+		# Producers are pipelines themselves (decoder | tee | wc): with
+		# pipefail, a corrupt input fails them, and so the command, instead
+		# of ending the stream early as if complete.
+		if readers:
+			cmd.append(pipefail(producer) + " <&" + ends[i][1] + " " + close_writers + " " + close_readers + " &")
+		else:
+			cmd.append(pipefail(producer) + " &")
+		cmd.append("producers=\"$producers $!\"")
+	if readers:
+		cmd.append("exec " + close_readers)
+	cmd += [consumer, "status=$?"]
+	if readers:
+		cmd.append("exec " + close_writers)
+	cmd += [
+		"if [ $status -ne 0 ]; then for p in $producers; do pkill -P $p; kill $p; done; fi 2> /dev/null",
+		"for p in $producers; do wait $p || status=1; done",
+		"rm -f " + fifo_list,
+		"exit $status"]
+	return "\n".join(cmd)
+
+
+def capture_unaligned(ngstk, prefix, paired_end):
+	"""
+	Commands capturing the reads bowtie1 leaves unaligned (--un) while it
+	aligns, as gzipped fastq files, counting them on the way.
+
+	bowtie1 writes them to named pipes, read by the returned commands from
+	standard input; pass those to stream_cmd with readers=True around the
+	alignment command.
+
+	:param pypiper.NGSTk ngstk: toolkit of the running pipeline
+	:param str prefix: prefix of the output files
+	:param bool paired_end: whether the reads are paired-end
+	:return list: bowtie1 option, reader commands, named pipes, gzipped
+		fastq files (one per mate) and count files
+	"""
+	mates = ["R1", "R2"] if paired_end else ["R1"]
+	# For pairs, bowtie1 adds _1 and _2 to the --un file name, before the extension.
+	fifos = [prefix + "_1.fastq", prefix + "_2.fastq"] if paired_end else [prefix + ".fastq"]
+	fastqs = [prefix + "_" + mate + ".fastq.gz" for mate in mates]
+	count_files = [prefix + "_" + mate + ".count" for mate in mates]
+	cmds = []
+	for fastq, count_file in zip(fastqs, count_files):
+		cmd = "awk -v cnt=" + count_file + " '{ print } END { print NR/4 > cnt }'"
+		cmd += " | " + ngstk.ziptool + " -c > " + fastq
+		cmds.append(cmd)
+	return ["--un " + prefix + ".fastq", cmds, fifos, fastqs, count_files]
+
+
+def check_stream(pm, count_files, paired_end, qc_prefix=None):
+	"""
+	Report read counts of a streamed conversion, as NGSTk.check_fastq does
+	for converted fastq files, from the count files written by the producer.
+	With qc_prefix (the fastq prefix of a stream with qc), the read quality
+	metrics are reported too.
+
+	:param pypiper.PipelineManager pm: manager of the running pipeline
+	:param list count_files: count files given by stream_input_to_fastq
+	:param bool paired_end: whether the input is paired-end
+	:param str qc_prefix: prefix of the read quality reports
+	:return callable: function to pass as follow to pm.run
+	"""
+	def temp_func():
+		counts = []
+		failed = None
+		for count_file in count_files:
+			with open(count_file) as handle:
+				n_reads, n_failed = handle.read().split()
+			if float(n_reads) != int(float(n_reads)):
+				raise Exception("Fastq conversion error? Truncated record in " + count_file)
+			counts.append(int(float(n_reads)))
+			# Only bam input carries vendor quality flags.
+			if n_failed != "-":
+				failed = (failed or 0) + int(n_failed)
+			os.remove(count_file)
+
+		if paired_end and len(counts) == 2 and counts[0] != counts[1]:
+			raise Exception("Fastq conversion error? Number of reads doesn't match between mates")
+
+		raw_reads = sum(counts)
+		pm.report_result("Raw_reads", str(raw_reads))
+		pm.report_result("Fastq_reads", raw_reads)
+		if failed is not None:
+			pm.report_result("PF_reads", str(raw_reads - failed))
+		if qc_prefix:
+			report_read_qc(pm, qc_prefix, paired_end)
+		return raw_reads
+	return temp_func
+
+
+def report_read_qc(pm, qc_prefix, paired_end):
+	"""
+	Report the metrics of the read quality reports of tools/read_qc.py,
+	over both mates for paired-end data.
+	"""
+	summaries = []
+	for mate in ["R1", "R2"] if paired_end else ["R1"]:
+		with open(qc_prefix + "_" + mate + "_qc.json") as handle:
+			summaries.append(json.load(handle))
+		pm.report_object("Read QC report " + mate, qc_prefix + "_" + mate + "_qc.html")
+	bases = sum(s["bases"] for s in summaries)
+	reads = sum(s["reads"] for s in summaries)
+
+	def mean(key):
+		return round(sum(s[key] * s["bases"] for s in summaries) / float(max(bases, 1)), 2)
+
+	pm.report_result("Raw_mean_length", round(bases / float(max(reads, 1)), 2))
+	pm.report_result("Raw_mean_quality", mean("mean_quality"))
+	pm.report_result("Raw_GC_content", mean("gc_content"))
+	pm.report_result("Raw_N_content", mean("n_content"))
+	pm.report_result("Overrepresented_kmers",
+		len(set(kmer[0] for s in summaries for kmer in s["overrepresented_kmers"])))
+
+
+def pipefail(cmd):
+	"""
+	Run a shell pipeline with pipefail, so that it fails when any of its
+	commands fails instead of only when the last one does; a sort dying on a
+	full disk would otherwise hand a truncated stream on as if complete.
+	/bin/sh (e.g. dash) has no pipefail, so the pipeline runs in bash.
+
+	:param str cmd: shell command, e.g. "aligner ... | samtools sort ..."
+	:return str: shell command to pass to pm.run(..., shell=True)
+	"""
+	return "bash -o pipefail -c '" + cmd.replace("'", "'\\''") + "'"
+
+
+def follow_all(*funcs):
+	"""
+	Combine several follow functions into one, run in the given order.
+	"""
+	def temp_func():
+		for func in funcs:
+			func()
+	return temp_func
+
+
+def detect_phred(pm, ngstk, input_files, n_samples=16):
+	"""
+	Quality encoding of the input reads, "phred33" or "phred64".
+
+	Detected on blocks sampled across the first input file and cached in the
+	sample's stats as Phred_encoding, so reruns don't read the input again.
+	Inputs that can't be told apart are taken as phred33.
+
+	:param pypiper.PipelineManager pm: manager of the running pipeline
+	:param pypiper.NGSTk ngstk: toolkit of the running pipeline
+	:param list input_files: local input files, as given by merge_or_link
+	:param int n_samples: number of blocks to sample
+	:return str: "phred33" or "phred64"
+	"""
+	encoding = pm.get_stat("Phred_encoding")
+	if encoding:
+		return encoding
+
+	if type(input_files) != list:
+		input_files = [input_files]
+	input_file = [f for f in input_files if f][0]
+	if ngstk.get_input_ext(input_file) == ".bam":
+		# SAM/BAM qualities are phred33 by specification.
+		encoding = "phred33"
+	else:
+		if TOOLS_DIR not in sys.path:
+			sys.path.append(TOOLS_DIR)
+		from detect_quality_code import detect_encoding
+		valid, _, _ = detect_encoding(input_file, n_samples=n_samples)
+		encoding = "phred64" if valid == ["phred64"] else "phred33"
+
+	pm.report_result("Phred_encoding", encoding)
+	return encoding
+
+
+def preprocessing_key(input_files, trim_cmd, out_fastq_prefix):
+	"""
+	Key of the trimmed reads of input files: the identity of the inputs (real
+	path, size and modification time) and the trimming command, without the
+	output prefix and the resources given to the trimmer, so pipelines
+	trimming the same way share it.
+
+	:param list input_files: local input files, as given by merge_or_link
+	:param str trim_cmd: trimming command, before any stream_cmd wrapping
+	:param str out_fastq_prefix: prefix of the fastq files in trim_cmd
+	:return str: hex digest
+	"""
+	if type(input_files) != list:
+		input_files = [input_files]
+	digest = hashlib.sha1()
+	for input_file in input_files:
+		if input_file:
+			path = os.path.realpath(input_file)
+			stat = os.stat(path)
+			digest.update("{}\t{}\t{}\n".format(path, stat.st_size, int(stat.st_mtime)).encode())
+	cmd = trim_cmd.replace(out_fastq_prefix, "{fastq}")
+	cmd = re.sub(r" -Xmx\S+", "", cmd)
+	cmd = re.sub(r" -(threads|t|p) \d+", "", cmd)
+	digest.update(" ".join(cmd.split()).encode())
+	return digest.hexdigest()
+
+
+def run_preprocessing(pm, cache_folder, input_files, trim_cmd, out_fastq_prefix, steps, outputs, max_size=100):
+	"""
+	Run the conversion and trimming steps of a pipeline or, with a cache
+	folder, reuse their outputs from another pipeline run on the same input.
+
+	Under a lock on the key of the input and trimming (preprocessing_key),
+	the first pipeline runs the steps and stores the trimmed reads and the
+	results the steps reported in the cache; pipelines coming later, or
+	waiting on the lock meanwhile, link the trimmed reads into place and
+	report the same results instead.
+
+	The stored reads stay in the cache folder after the pipelines remove
+	their own, until evicted: the least recently used entries are removed
+	to keep it under its maximum size.
+
+	:param pypiper.PipelineManager pm: manager of the running pipeline
+	:param str cache_folder: shared cache folder, or None to just run the steps
+	:param list input_files: local input files, as given by merge_or_link
+	:param str trim_cmd: trimming command, before any stream_cmd wrapping
+	:param str out_fastq_prefix: prefix of the fastq files
+	:param list steps: (command, target, follow, shell) of each pm.run, where
+		a shell of None leaves it to pm.run
+	:param list outputs: trimmed fastq files, the first of them required
+	:param float max_size: maximum size of the cache folder, in GB
+	:return bool: whether the outputs were reused
+	"""
+	if not cache_folder:
+		for cmd, target, follow, shell in steps:
+			_run_step(pm, cmd, target, follow, shell)
+		return False
+
+	pm.make_sure_path_exists(cache_folder)
+	entry = os.path.join(cache_folder, preprocessing_key(input_files, trim_cmd, out_fastq_prefix))
+	with open(entry + ".lock", "w") as lock:
+		fcntl.flock(lock, fcntl.LOCK_EX)
+		if os.path.exists(os.path.join(entry, "results.json")):
+			with open(os.path.join(entry, "results.json")) as handle:
+				results = json.load(handle)
+			for output in outputs:
+				cached = os.path.join(entry, os.path.basename(output).replace(os.path.basename(out_fastq_prefix), "sample", 1))
+				if os.path.exists(cached) and not os.path.exists(output):
+					pm.make_sure_path_exists(os.path.dirname(output))
+					try:
+						os.link(cached, output)
+					except OSError:
+						# a copy, not a symlink, as the entry may be evicted
+						shutil.copyfile(cached, output)
+			os.utime(os.path.join(entry, "results.json"), None)
+			for key, value in results:
+				pm.report_result(key, value)
+			pm.report_result("Preprocessing_reused", os.path.basename(entry))
+			fcntl.flock(lock, fcntl.LOCK_UN)
+			return True
+
+		# Results the steps report, to report them again where they are reused.
+		# Steps skipped as their target exists report nothing, so only a
+		# complete run of all steps is stored.
+		results = []
+		targets = [t for _, target, _, _ in steps for t in ([target] if isinstance(target, str) else target or [])]
+		ran = not any(os.path.exists(target) for target in targets)
+
+		def capture(key, value, *args, **kwargs):
+			results.append([key, str(value)])
+			return report_result(key, value, *args, **kwargs)
+
+		report_result = pm.report_result
+		pm.report_result = capture
+		try:
+			for cmd, target, follow, shell in steps:
+				_run_step(pm, cmd, target, follow, shell)
+		finally:
+			del pm.report_result
+
+		if ran and results and os.path.exists(outputs[0]):
+			tmp = "{}.tmp{}".format(entry, os.getpid())
+			os.makedirs(tmp)
+			for output in outputs:
+				if os.path.exists(output):
+					cached = os.path.join(tmp, os.path.basename(output).replace(os.path.basename(out_fastq_prefix), "sample", 1))
+					try:
+						os.link(output, cached)
+					except OSError:
+						shutil.copyfile(output, cached)
+			with open(os.path.join(tmp, "results.json"), "w") as out:
+				json.dump(results, out)
+			os.rename(tmp, entry)
+			_evict_preprocessing(cache_folder, int(max_size * 1024 ** 3), keep=entry)
+		fcntl.flock(lock, fcntl.LOCK_UN)
+	return False
+
+
+def _evict_preprocessing(cache_folder, max_bytes, keep):
+	"""
+	Remove the least recently used entries of a preprocessing cache folder,
+	as StageCache._evict does for stages, until it fits in its maximum size.
+	Entries locked by a pipeline storing or reusing them are left alone.
+	"""
+	with open(os.path.join(cache_folder, "evict.lock"), "w") as evict_lock:
+		fcntl.flock(evict_lock, fcntl.LOCK_EX)
+		entries = []
+		for name in os.listdir(cache_folder):
+			path = os.path.join(cache_folder, name)
+			if os.path.exists(os.path.join(path, "results.json")):
+				size = sum(os.stat(os.path.join(path, f)).st_size for f in os.listdir(path))
+				entries.append((os.stat(os.path.join(path, "results.json")).st_mtime, path, size))
+		entries.sort()
+		total = sum(size for _, _, size in entries)
+		for _, path, size in entries:
+			if total <= max_bytes:
+				break
+			if path == keep:
+				continue
+			# lock files are kept: pipelines may have them open
+			with open(path + ".lock", "w") as lock:
+				try:
+					fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+				except (IOError, OSError):
+					continue  # in use
+				shutil.rmtree(path)
+				total -= size
+				fcntl.flock(lock, fcntl.LOCK_UN)
+		fcntl.flock(evict_lock, fcntl.LOCK_UN)
+
+
+def _run_step(pm, cmd, target, follow, shell):
+	if shell is None:
+		pm.run(cmd, target, follow=follow)
+	else:
+		pm.run(cmd, target, follow=follow, shell=shell)
+
+
+def _start_background(script, log_file):
+	"""
+	Run a shell script in the background, in a process group of its own so
+	that _stop_background() can kill it with everything it started.
+	"""
+	with open(log_file, "a") as log:
+		return subprocess.Popen(script, shell=True, stdout=log, stderr=subprocess.STDOUT,
+			preexec_fn=os.setsid)
+
+
+def _stop_background():
+	"""
+	Kill the FastQC runs and branches that are still running when the
+	pipeline exits without joining them, because it failed or was killed.
+	Branch steps left locked get a recover file, as pm.run leaves for its
+	own, so the next run redoes them.
+	"""
+	procs = [job[0] for job in _fastqc_jobs.values()] + [branch[0] for branch in _background_branches.values()]
+	procs = [proc for proc in procs if proc is not None and proc.poll() is None]
+	for sig in signal.SIGTERM, signal.SIGKILL:
+		for proc in procs:
+			try:
+				os.killpg(proc.pid, sig)
+			except OSError:
+				pass  # exited meanwhile
+		for _ in range(50):
+			if all(proc.poll() is not None for proc in procs):
+				break
+			time.sleep(0.1)
+	for proc, log_file, follows, locks in _background_branches.values():
+		for lock_file, recover_file in locks:
+			if os.path.exists(lock_file):
+				open(recover_file, "w").close()
+	_fastqc_jobs.clear()
+	_background_branches.clear()
+
+
+atexit.register(_stop_background)
+
+
+def start_fastqc(ngstk, fastq_files, fastqc_folder):
+	"""
+	Start FastQC on fastq files in the background, once per file.
+
+	Files already started in this pipeline, or with a FastQC report from an
+	earlier run, are skipped. FastQC writes into a folder of its own and the
+	report is moved into place once complete, so an interrupted run leaves
+	no report behind. Reports are collected by join_fastqc(), which has to be
+	called before pm.stop_pipeline().
+
+	:param pypiper.NGSTk ngstk: toolkit of the running pipeline
+	:param list fastq_files: fastq files, R1 first; None entries are ignored
+	:param str fastqc_folder: folder of the FastQC reports
+	"""
+	ngstk.make_sure_path_exists(fastqc_folder)
+	for i, fastq_file in enumerate(fastq_files):
+		if not fastq_file or os.path.realpath(fastq_file) in _fastqc_jobs:
+			continue
+		name = os.path.splitext(os.path.basename(fastq_file))[0]
+		report = os.path.join(fastqc_folder, name + "_fastqc.html")
+		proc = None
+		if not os.path.exists(report):
+			tmp = os.path.join(fastqc_folder, "tmp_" + name)
+			script = "rm -rf {tmp} && mkdir {tmp} && {fastqc} && mv -f {tmp}/*_fastqc.zip {folder} && " \
+				"mv -f {tmp}/*_fastqc.html {folder} && rm -rf {tmp}".format(
+				tmp=tmp, folder=fastqc_folder, fastqc=ngstk.fastqc(fastq_file, tmp))
+			proc = _start_background(script, os.path.join(fastqc_folder, name + "_fastqc.log"))
+		_fastqc_jobs[os.path.realpath(fastq_file)] = (proc, "FastQC report r" + str(i + 1), report)
+
+
+def join_fastqc(pm):
+	"""
+	Wait for the FastQC runs started by start_fastqc() and report them.
+	A failed run is noted but doesn't fail the pipeline, as with nofail.
+
+	:param pypiper.PipelineManager pm: manager of the running pipeline
+	"""
+	for proc, label, report in _fastqc_jobs.values():
+		if (proc is not None and proc.wait() != 0) or not os.path.exists(report):
+			pm.timestamp("FastQC failed for " + report + ", see the log next to it.")
+			continue
+		pm.report_object(label, report)
+	_fastqc_jobs.clear()
+
+
+def lock_files(pm, target):
+	"""
+	Lock and recover file of a target, named as pm.run names them, so that
+	pm.run and --recover see steps run outside of pm.run as their own.
+	"""
+	name = "lock." + target.replace(pm.outfolder, "").replace(os.sep, "__")
+	return os.path.join(pm.outfolder, name), os.path.join(pm.outfolder, "recover." + name)
+
+
+def wait_for_lock(pm, lock_file, recover_file):
+	"""
+	As pm.run does, wait for a lock held by another run, unless the pipeline
+	runs with --recover or the lock has a recover file.
+
+	:return bool: whether the lock is still there, to be taken over
+	"""
+	if os.path.exists(lock_file) and not pm.overwrite_locks and not os.path.exists(recover_file):
+		pm.timestamp("Waiting for file lock: " + lock_file)
+		while os.path.exists(lock_file) and not os.path.exists(recover_file):
+			time.sleep(10)
+	return os.path.exists(lock_file)
+
+
+def start_branch(pm, name, steps, log_file):
+	"""
+	Run a branch of the pipeline in the background, alongside the steps that
+	follow: its commands run one after the other in a shell of their own.
+	Branches are joined by join_branches(), which has to be called before
+	pm.stop_pipeline(); a branch still running when the pipeline exits
+	otherwise is killed.
+
+	Steps are locked as pm.run locks them. As with pm.run, a step whose
+	target exists is skipped; one found locked is waited for, unless the
+	pipeline runs with --recover or the lock has a recover file, left by a
+	run that failed or was killed, in which case it is run again.
+
+	:param pypiper.PipelineManager pm: manager of the running pipeline
+	:param str name: name of the branch, for messages
+	:param list steps: (command, target, follow) of each step, where follow
+		is called after joining if the step ran, or is None
+	:param str log_file: file for the output of the commands
+	"""
+	script, follows, locks = [], [], []
+	for cmd, target, follow in steps:
+		lock_file, recover_file = lock_files(pm, target)
+		if not script and not wait_for_lock(pm, lock_file, recover_file) and os.path.exists(target):
+			continue
+		script += ["echo '+ " + name + ": " + target + "'", "rm -f " + recover_file, "touch " + lock_file,
+			"( " + cmd + "\n) || exit 1", "rm -f " + lock_file]
+		locks.append((lock_file, recover_file))
+		if follow is not None:
+			follows.append(follow)
+	proc = _start_background("\n".join(script), log_file) if script else None
+	_background_branches[name] = (proc, log_file, follows, locks)
+
+
+def join_branches(pm):
+	"""
+	Wait for the branches started by start_branch() and run the follow
+	functions of their steps. A failed branch fails the pipeline.
+
+	:param pypiper.PipelineManager pm: manager of the running pipeline
+	"""
+	for name, (proc, log_file, follows, locks) in _background_branches.items():
+		pm.timestamp("### Joining " + name + ": ")
+		if proc is not None and proc.wait() != 0:
+			raise Exception(name + " failed, see " + log_file)
+		for follow in follows:
+			follow()
+	_background_branches.clear()
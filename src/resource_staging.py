@@ -0,0 +1,209 @@
+"""
+Staging of genome resources on node-local scratch.
+
+The pipelines read their indexes and annotation from the shared genomes
+folder, so jobs landing on one node at the same time all read the same
+multi-GB files over the network. A ResourceStager copies the files of a
+resource (a file, or all files of an index prefix) once to a node-local
+scratch folder, with the same layout below it as below the genomes folder,
+and points the resource there. Concurrent jobs wait on a lock instead of
+copying twice. Each copy is checked against the checksum of the data read,
+and staged files are copied again when their source changes.
+
+Staged assemblies stay in use while a job that staged them runs; the least
+recently used assemblies not in use are evicted to keep the scratch folder
+under its maximum size.
+"""
+
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+
+from stage_cache import content_hash
+
+
+# Record of the staged files of an assembly, in its scratch folder.
+MANIFEST = ".staged.json"
+
+
+class ResourceStager(object):
+	"""
+	Node-local copies of the resources below a genomes folder.
+
+	:param str scratch: node-local folder, shared by the jobs of a node
+	:param str genomes: genomes folder the resources are resolved under
+	:param float max_size: maximum size of the staged files, in GB
+	"""
+
+	def __init__(self, scratch, genomes, max_size=200):
+		self.scratch = os.path.abspath(scratch)
+		self.genomes = os.path.abspath(genomes)
+		self.max_bytes = int(max_size * 1024 ** 3)
+		self.locks = os.path.join(self.scratch, ".locks")
+		if not os.path.exists(self.locks):
+			try:
+				os.makedirs(self.locks)
+			except OSError:
+				pass
+		# use locks of the assemblies staged by this process, held until it exits
+		self._in_use = {}
+
+	def stage_resources(self, resources, names):
+		"""
+		Stage resources and point them at their node-local copies.
+
+		:param pypiper.AttributeDict resources: pipeline resources
+		:param list names: resources to stage; unset ones are skipped
+		"""
+		for name in names:
+			path = getattr(resources, name, None)
+			if path:
+				setattr(resources, name, self.stage(path))
+
+	def stage(self, path):
+		"""
+		:param str path: file, or index prefix, below the genomes folder
+		:return str: path of the node-local copy, or the path itself if it
+			is not below the genomes folder, does not exist (yet) or does
+			not fit in the scratch folder
+		"""
+		rel = os.path.relpath(os.path.abspath(path), self.genomes)
+		if rel.startswith(os.pardir) or os.sep not in rel:
+			return path
+		sources = _resource_files(os.path.abspath(path))
+		if not sources:
+			return path
+		assembly = rel.split(os.sep)[0]
+		self._use(assembly)
+
+		with open(os.path.join(self.locks, "staging.lock"), "w") as lock:
+			fcntl.flock(lock, fcntl.LOCK_EX)
+			manifest = self._manifest(assembly)
+			missing = [source for source in sources if not self._current(manifest, source)]
+			if missing:
+				# outdated copies are replaced
+				needed = sum(os.stat(source).st_size - manifest.get(self._rel(source), {}).get("source_size", 0)
+					for source in missing)
+				if not self._make_room(assembly, needed):
+					print("Not staging (scratch full): " + path)
+					return path
+				for source in missing:
+					manifest[self._rel(source)] = self._copy(source)
+					self._write_manifest(assembly, manifest)
+			fcntl.flock(lock, fcntl.LOCK_UN)
+
+		if missing:
+			print("Staged on node-local scratch: " + path)
+		return os.path.join(self.scratch, rel)
+
+	def _rel(self, source):
+		return os.path.relpath(source, self.genomes)
+
+	def _use(self, assembly):
+		"""
+		Mark an assembly as used, and in use until this process exits.
+		"""
+		if assembly not in self._in_use:
+			handle = open(os.path.join(self.locks, assembly + ".use"), "a")
+			fcntl.flock(handle, fcntl.LOCK_SH)
+			self._in_use[assembly] = handle
+		os.utime(os.path.join(self.locks, assembly + ".use"), None)
+
+	def _manifest(self, assembly):
+		path = os.path.join(self.scratch, assembly, MANIFEST)
+		if not os.path.exists(path):
+			return {}
+		with open(path) as handle:
+			return json.load(handle)
+
+	def _write_manifest(self, assembly, manifest):
+		path = os.path.join(self.scratch, assembly, MANIFEST)
+		tmp = "{}.tmp{}".format(path, os.getpid())
+		with open(tmp, "w") as out:
+			json.dump(manifest, out, indent=1, sort_keys=True)
+		os.rename(tmp, path)
+
+	def _current(self, manifest, source):
+		"""
+		:return bool: whether the staged copy of a file is there and made
+			from its current version
+		"""
+		entry = manifest.get(self._rel(source))
+		if entry is None:
+			return False
+		stat = os.stat(source)
+		staged = os.path.join(self.scratch, self._rel(source))
+		return (entry["source_size"] == stat.st_size and entry["source_mtime"] == int(stat.st_mtime)
+			and os.path.exists(staged) and os.stat(staged).st_size == stat.st_size)
+
+	def _copy(self, source):
+		"""
+		Copy a file to scratch, checking the copy against the data read.
+
+		:return dict: manifest entry of the staged file
+		"""
+		stat = os.stat(source)
+		destination = os.path.join(self.scratch, self._rel(source))
+		if not os.path.exists(os.path.dirname(destination)):
+			os.makedirs(os.path.dirname(destination))
+		tmp = "{}.tmp{}".format(destination, os.getpid())
+		digest = hashlib.sha1()
+		with open(source, "rb") as handle:
+			with open(tmp, "wb") as out:
+				for block in iter(lambda: handle.read(1 << 22), b""):
+					digest.update(block)
+					out.write(block)
+		if content_hash(tmp) != digest.hexdigest() or os.stat(source).st_size != stat.st_size:
+			os.remove(tmp)
+			raise IOError("Staged copy does not match its source: " + source)
+		shutil.copystat(source, tmp)
+		os.rename(tmp, destination)
+		return {"source_size": stat.st_size, "source_mtime": int(stat.st_mtime), "sha1": digest.hexdigest()}
+
+	def _make_room(self, assembly, needed):
+		"""
+		Evict the least recently used assemblies not in use, other than the
+		one being staged, until the needed bytes fit.
+
+		:return bool: whether they fit
+		"""
+		sizes = {}
+		for name in os.listdir(self.scratch):
+			if os.path.isdir(os.path.join(self.scratch, name)) and name != ".locks":
+				sizes[name] = sum(entry["source_size"] for entry in self._manifest(name).values())
+		total = sum(sizes.values())
+
+		def last_used(name):
+			use = os.path.join(self.locks, name + ".use")
+			return os.stat(use).st_mtime if os.path.exists(use) else 0
+
+		for name in sorted(sizes, key=last_used):
+			if total + needed <= self.max_bytes:
+				break
+			if name == assembly:
+				continue
+			with open(os.path.join(self.locks, name + ".use"), "a") as use:
+				try:
+					fcntl.flock(use, fcntl.LOCK_EX | fcntl.LOCK_NB)
+				except (IOError, OSError):
+					continue  # in use by a running job
+				print("Evicting staged assembly: " + name)
+				shutil.rmtree(os.path.join(self.scratch, name))
+				total -= sizes[name]
+		return total + needed <= self.max_bytes
+
+
+def _resource_files(path):
+	"""
+	:return list: a file, or the files of an index prefix
+		(e.g. hg19.1.bt2, hg19.rev.1.bt2, ... for .../indexed_bowtie2/hg19)
+	"""
+	if os.path.isfile(path):
+		return [path]
+	folder, prefix = os.path.split(path)
+	if not os.path.isdir(folder):
+		return []
+	return sorted(os.path.join(folder, name) for name in os.listdir(folder)
+		if name.startswith(prefix + ".") and os.path.isfile(os.path.join(folder, name)))
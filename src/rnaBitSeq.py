@@ -12,6 +12,14 @@ import subprocess
 import re
 import pypiper
 
+import preprocessing
+import stage_cache
+import resource_staging
+import stage_graph
+import stage_profile
+sys.path.append(preprocessing.TOOLS_DIR)
+import bam_stats
+
 
 # Argument Parsing
 # #######################################################################################
@@ -30,7 +38,29 @@ parser.add_argument('-em', '--ercc-mix',
 				default = "False",
 				dest = 'ERCC_mix',
 				help = 'ERCC mix. If False no ERCC analysis will be performed.')
+parser.add_argument('--ercc-cores', dest='ERCC_cores', type=int, default=None,
+				help='Cores of the ERCC branch, which runs alongside the genome branch and shares its cores (default: a quarter)')
+parser.add_argument('--combined-index', dest='combined_index', action='store_true', default=False,
+				help='Align once to a combined genome and ERCC index, built and cached next to the genome, and split the alignments, instead of realigning the unaligned reads to ERCC')
 parser.add_argument('-f', dest='filter', action='store_false', default=True)
+parser.add_argument('--stream', dest='stream', action='store_true', default=False,
+				help='Stream input conversion straight into the trimmer, without intermediate fastq files')
+parser.add_argument('--stream-qc', dest='stream_qc', action='store_true', default=False,
+				help='With --stream, also collect read quality metrics from the stream')
+parser.add_argument('--preprocessing-cache', dest='preprocessing_cache', default=None,
+				help='Folder shared by the pipelines run on a sample, to convert and trim its input only once')
+parser.add_argument('--preprocessing-cache-size', dest='preprocessing_cache_size', type=float, default=100,
+				help='Maximum size of the preprocessing cache, in GB; least recently used inputs are evicted')
+parser.add_argument('--stage-cache', dest='stage_cache', default=None,
+				help='Folder of a cache of stage results, restored instead of recomputed when command, tools and inputs are unchanged')
+parser.add_argument('--stage-cache-size', dest='stage_cache_size', type=float, default=100,
+				help='Maximum size of the stage cache, in GB; least recently used stages are evicted')
+parser.add_argument('--stage-resources', dest='stage_resources', default=None,
+				help='Node-local scratch folder to copy the genome indexes and annotation to, once per node')
+parser.add_argument('--stage-resources-size', dest='stage_resources_size', type=float, default=200,
+				help='Maximum size of the staged resources, in GB; least recently used assemblies are evicted')
+parser.add_argument('--profile', dest='profile', action='store_true', default=False,
+				help='Sample the processes of each stage for time, memory, IO and threads, into stage_profile.tsv; see tools/profile_rollup.py')
 
 # Core-seq as optional parameter
 parser.add_argument('-cs', '--core-seq', default=False, dest='coreseq', action='store_true', help='CORE-seq Mode')
@@ -52,6 +82,10 @@ if not args.input:
 # Initialize
 outfolder = os.path.abspath(os.path.join(args.output_parent, args.sample_name))
 pm = pypiper.PipelineManager(name = "rnaBitSeq", outfolder = outfolder, args = args)
+if args.stage_cache:
+	stage_cache.StageCache(args.stage_cache, args.stage_cache_size).install(pm)
+if args.profile:
+	stage_profile.StageProfiler(outfolder).install(pm)
 
 # Tools
 pm.config.tools.scripts_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), "tools")
@@ -59,10 +93,23 @@ pm.config.tools.scripts_dir = os.path.join(os.path.dirname(os.path.realpath(__fi
 # Resources
 pm.config.resources.ref_genome = os.path.join(pm.config.resources.genomes, args.genome_assembly)
 pm.config.resources.ref_genome_fasta = os.path.join(pm.config.resources.genomes, args.genome_assembly, args.genome_assembly + ".fa")
+pm.config.resources.ref_genome_2bit = os.path.join(pm.config.resources.genomes, args.genome_assembly, args.genome_assembly + ".2bit")
 pm.config.resources.ref_ERCC_fasta = os.path.join(pm.config.resources.genomes, args.ERCC_assembly, args.ERCC_assembly + ".fa")
 pm.config.resources.chrom_sizes = os.path.join(pm.config.resources.genomes, args.genome_assembly, args.genome_assembly + ".chromSizes")
 pm.config.resources.bowtie_indexed_genome = os.path.join(pm.config.resources.genomes, args.genome_assembly, "indexed_bowtie1", args.genome_assembly)
 pm.config.resources.bowtie_indexed_ERCC = os.path.join(pm.config.resources.genomes, args.ERCC_assembly, "indexed_bowtie1", args.ERCC_assembly)
+pm.config.resources.bowtie_indexed_genome_ERCC = os.path.join(pm.config.resources.genomes, args.genome_assembly, "indexed_bowtie1_" + args.ERCC_assembly, args.genome_assembly + "_" + args.ERCC_assembly)
+
+# Node-local copies of the indexes this run aligns to
+stager = None
+if args.stage_resources:
+	stager = resource_staging.ResourceStager(args.stage_resources, pm.config.resources.genomes, args.stage_resources_size)
+	if args.ERCC_mix == "False":
+		stager.stage_resources(pm.config.resources, ["bowtie_indexed_genome"])
+	elif args.combined_index:
+		stager.stage_resources(pm.config.resources, ["bowtie_indexed_genome_ERCC"])
+	else:
+		stager.stage_resources(pm.config.resources, ["bowtie_indexed_genome", "bowtie_indexed_ERCC"])
 
 # Output
 pm.config.parameters.pipeline_outfolder = outfolder
@@ -83,9 +130,13 @@ fastq_folder = os.path.join(param.pipeline_outfolder, "fastq/")
 pm.timestamp("### Merge/link and fastq conversion: ")
 
 local_input_files = ngstk.merge_or_link([args.input, args.input2], raw_folder, args.sample_name)
-cmd, out_fastq_pre, unaligned_fastq = ngstk.input_to_fastq(local_input_files, args.sample_name, args.paired_end, fastq_folder)
-pm.run(cmd, unaligned_fastq, 
-	follow=ngstk.check_fastq(local_input_files, unaligned_fastq, args.paired_end))
+if args.stream:
+	# Conversion runs together with the trimming below, through named pipes
+	stream_producers, out_fastq_pre, stream_fifos, stream_counts = preprocessing.stream_input_to_fastq(
+		ngstk, local_input_files, args.sample_name, args.paired_end, fastq_folder, qc=args.stream_qc)
+else:
+	# Conversion runs before the trimming below, unless trimmed reads are reused
+	convert_cmd, out_fastq_pre, unaligned_fastq = ngstk.input_to_fastq(local_input_files, args.sample_name, args.paired_end, fastq_folder)
 pm.clean_add(out_fastq_pre + "*.fastq", conditional=True)
 
 pm.report_result("File_mb", ngstk.get_file_size(local_input_files))
@@ -96,15 +147,17 @@ pm.report_result("Genome", args.genome_assembly)
 ################################################################################
 pm.timestamp("### Adapter trimming: ")
 
+phred = preprocessing.detect_phred(pm, ngstk, local_input_files)
+
 cmd = tools.java + " -Xmx" + str(pm.mem) + " -jar " + tools.trimmomatic_epignome
 
 if not args.paired_end:
-	cmd += " SE -phred33 -threads " + str(pm.cores) + " "
+	cmd += " SE -" + phred + " -threads " + str(pm.cores) + " "
 	cmd += out_fastq_pre + "_R1.fastq "
 	cmd += out_fastq_pre + "_R1_trimmed.fastq "
 
 else:
-	cmd += " PE -phred33 -threads " + str(pm.cores) + " "
+	cmd += " PE -" + phred + " -threads " + str(pm.cores) + " "
 	cmd += out_fastq_pre + "_R1.fastq "
 	cmd += out_fastq_pre + "_R2.fastq "
 	cmd += out_fastq_pre + "_R1_trimmed.fastq "
@@ -128,202 +181,297 @@ else:
 	cmd += " MAXINFO:16:0.40"
 	cmd += " MINLEN:21"
 
+# phred64 input is converted on the fly, so everything downstream sees phred33
+if phred == "phred64":
+	cmd += " TOPHRED33"
+
 trimmed_fastq = out_fastq_pre + "_R1_trimmed.fastq"
 trimmed_fastq_R2 = out_fastq_pre + "_R2_trimmed.fastq"
 
 #pm.run(cmd, out_fastq_pre + "_R1_trimmed.fastq",
 #	follow = lambda: pm.report_result("Trimmed_reads", ngstk.count_reads(trimmed_fastq,args.paired_end)))
 
-pm.run(cmd, trimmed_fastq, 
-	follow = ngstk.check_trim(trimmed_fastq, args.paired_end, trimmed_fastq_R2,
-		fastqc_folder = os.path.join(param.pipeline_outfolder, "fastqc/")))
+check_trim = ngstk.check_trim(trimmed_fastq, args.paired_end, trimmed_fastq_R2)
+
+if args.stream:
+	steps = [(preprocessing.stream_cmd(stream_producers, stream_fifos, cmd), trimmed_fastq,
+		preprocessing.follow_all(preprocessing.check_stream(pm, stream_counts, args.paired_end,
+			out_fastq_pre if args.stream_qc else None), check_trim), True)]
+else:
+	steps = [(convert_cmd, unaligned_fastq, ngstk.check_fastq(local_input_files, unaligned_fastq, args.paired_end), None),
+		(cmd, trimmed_fastq, check_trim, None)]
+trimmed_files = [trimmed_fastq]
+if args.paired_end:
+	trimmed_files += [trimmed_fastq_R2, out_fastq_pre + "_R1_unpaired.fastq", out_fastq_pre + "_R2_unpaired.fastq"]
+preprocessing.run_preprocessing(pm, args.preprocessing_cache, local_input_files, cmd, out_fastq_pre, steps, trimmed_files,
+	args.preprocessing_cache_size)
+
+# FastQC runs alongside the alignment; its reports are collected at the end.
+preprocessing.start_fastqc(ngstk, [trimmed_fastq, trimmed_fastq_R2 if args.paired_end else None],
+	os.path.join(param.pipeline_outfolder, "fastqc/"))
 
 
 # RNA BitSeq pipeline.
 ########################################################################################
-pm.timestamp("### Bowtie1 alignment: ")
-
 bowtie1_folder = os.path.join(param.pipeline_outfolder,"bowtie1_" + args.genome_assembly)
 pm.make_sure_path_exists(bowtie1_folder)
+# bowtie1 output is piped straight into a sorted BAM; the SAM file is only
+# written for BitSeq, from the BAM, and removed at the end.
 out_bowtie1 = os.path.join(bowtie1_folder, args.sample_name + ".aln.sam")
+sorted_bowtie1 = re.sub(".sam$" , "_sorted.bam", out_bowtie1)
+
+
+def bitseq_sam(bam, sam, cores):
+	"""
+	Command writing the SAM file BitSeq reads, with the alignments of each read
+	next to each other as bowtie1 writes them: parseAlignment takes a read's
+	alignments together, which coordinate order splits up. It is a real file,
+	as BitSeq reads it more than once.
+	"""
+	cmd = tools.samtools + " sort -n -@ " + str(cores) + " -O sam"
+	cmd += " -T " + re.sub(".sam$" , "_name_tmp", sam)
+	cmd += " -o " + sam + " " + bam
+	return cmd
+
+bowtie_index = resources.bowtie_indexed_genome
+un_option = ""
+combined_index = args.combined_index and not (args.ERCC_mix == "False" )
+if not (args.ERCC_mix == "False" ):
+	ercc_folder = os.path.join(param.pipeline_outfolder,"bowtie1_" + args.ERCC_assembly)
+	pm.make_sure_path_exists(ercc_folder)
+	out_ercc = os.path.join(ercc_folder, args.sample_name + "_ERCC.aln.sam")
+	sorted_ercc = re.sub(".sam$" , "_sorted.bam", out_ercc)
+	ercc_cores = args.ERCC_cores or max(1, int(pm.cores) // 4)
+
+if combined_index:
+	pm.timestamp("### Combined genome and ERCC bowtie1 index: ")
+	# built once per genome and ERCC assembly, next to the genome, and shared by
+	# all samples; ERCC contig names get a prefix, by which alignments are split
+	ercc_prefix = "spikein_"
+	bowtie_index = resources.bowtie_indexed_genome_ERCC
+	index_folder = os.path.dirname(bowtie_index)
+	tmp_folder = index_folder + ".tmp" + str(os.getpid())
+	cmd = "mkdir -p " + tmp_folder
+	cmd += " && (cat " + resources.ref_genome_fasta + "; sed 's/^>/>" + ercc_prefix + "/' " + resources.ref_ERCC_fasta + ")"
+	cmd += " > " + os.path.join(tmp_folder, "combined.fa")
+	cmd += " && " + tools.bowtie1_build + " " + os.path.join(tmp_folder, "combined.fa") + " " + os.path.join(tmp_folder, os.path.basename(bowtie_index))
+	cmd += " && rm " + os.path.join(tmp_folder, "combined.fa")
+	# another sample may have finished the same index in the meantime
+	cmd += " && (mv -T " + tmp_folder + " " + index_folder + " || rm -r " + tmp_folder + ")"
+	pm.run(cmd, bowtie_index + ".1.ebwt", shell=True)
+	if stager is not None:
+		# just built
+		bowtie_index = stager.stage(bowtie_index)
+elif not (args.ERCC_mix == "False" ):
+	# Reads left unaligned go straight to gzipped fastq files for the ERCC
+	# alignment, counted on the way, instead of being pulled out of the BAM.
+	unmappable_fastq = re.sub(".sam$","_unmappable",out_bowtie1)
+	un_option, un_readers, un_fifos, unaligned_fastqs, unaligned_counts = preprocessing.capture_unaligned(
+		ngstk, unmappable_fastq, args.paired_end)
 
+pm.timestamp("### Bowtie1 alignment: ")
 if not args.paired_end:
 	cmd = tools.bowtie1
-	cmd += " -q -p " + str(pm.cores) + " -a -m 100 --sam "
-	cmd += resources.bowtie_indexed_genome + " "
+	cmd += " -q -p " + str(pm.cores) + " -a -m 100 --sam " + un_option + " "
+	cmd += bowtie_index + " "
 	cmd += out_fastq_pre + "_R1_trimmed.fastq"
-	cmd += " " + out_bowtie1
 else:
 	cmd = tools.bowtie1
-	cmd += " -q -p " + str(pm.cores) + " -a -m 100 --minins 0 --maxins 5000 --fr --sam --chunkmbs 200 "    # also checked --rf (1% aln) and --ff (0% aln) --fr(8% aln)
-	cmd += resources.bowtie_indexed_genome
+	cmd += " -q -p " + str(pm.cores) + " -a -m 100 --minins 0 --maxins 5000 --fr --sam --chunkmbs 200 " + un_option + " "    # also checked --rf (1% aln) and --ff (0% aln) --fr(8% aln)
+	cmd += bowtie_index
 	cmd += " -1 " + out_fastq_pre + "_R1_trimmed.fastq"
 	cmd += " -2 " + out_fastq_pre + "_R2_trimmed.fastq"
-	cmd += " " + out_bowtie1
-
-pm.run(cmd, out_bowtie1,
-	follow=lambda: pm.report_result("Aligned_reads", ngstk.count_unique_mapped_reads(out_bowtie1, args.paired_end)))
 
-pm.timestamp("### Raw: SAM to BAM conversion and sorting: ")
+genome_sort = tools.samtools + " sort -@ " + str(pm.cores)
+genome_sort += " -T " + re.sub(".sam$" , "_tmp", out_bowtie1)
+genome_sort += " -o " + sorted_bowtie1 + " -"
+if combined_index:
+	# Alignments to ERCC contigs go to a BAM of their own, without the prefix;
+	# header lines go to both, and unaligned reads stay with the genome. As
+	# when only the reads left unaligned are realigned to ERCC, a read keeps
+	# its ERCC alignments only if it has none to the genome: bowtie1 writes
+	# the alignments of a read together, so they are held until the next read.
+	ercc_sort = tools.samtools + " sort -@ " + str(ercc_cores)
+	ercc_sort += " -T " + re.sub(".sam$" , "_tmp", out_ercc)
+	ercc_sort += " -o " + sorted_ercc + " -"
+	cmd += " | awk -F '\\t' -v OFS='\\t' -v p=" + ercc_prefix
+	cmd += " -v genome='" + genome_sort + "' -v ercc='" + ercc_sort + "'"
+	cmd += r""" 'function flush(  i) { for (i = 1; i <= n; i++) if (!is_ercc[i]) print held[i] | genome;"""
+	cmd += r""" else if (!on_genome) { $0 = held[i]; $3 = substr($3, length(p) + 1); if (index($7, p) == 1) $7 = substr($7, length(p) + 1); print | ercc }"""
+	cmd += r""" n = 0; on_genome = 0 }"""
+	cmd += r""" /^@SQ/ { if (index($2, "SN:" p) == 1) { $2 = "SN:" substr($2, length(p) + 4); print | ercc } else print | genome; next }"""
+	cmd += r""" /^@/ { print | genome; print | ercc; next }"""
+	cmd += r""" $1 != read { line = $0; flush(); $0 = line; read = $1 }"""
+	cmd += r""" { held[++n] = $0; is_ercc[n] = index($3, p) == 1; if ($3 != "*" && !is_ercc[n]) on_genome = 1 }"""
+	cmd += r""" END { flush(); if (close(genome) + close(ercc)) exit 1 }'"""
+	cmd += " && " + tools.samtools + " index " + sorted_ercc
+else:
+	cmd += " | " + genome_sort
+cmd = preprocessing.pipefail(cmd)
+cmd += " && " + tools.samtools + " index " + sorted_bowtie1
 
+check_aligned = lambda: pm.report_result("Aligned_reads", bam_stats.get_stats(sorted_bowtie1, args.paired_end, tools.samtools)["Aligned_reads"])
 if args.filter:
-	cmd = ngstk.sam_conversions(out_bowtie1,False)
-	pm.run(cmd,  re.sub(".sam$" , "_sorted.bam",out_bowtie1),shell=True)
+	target = sorted_bowtie1
 else:
-	cmd = ngstk.sam_conversions(out_bowtie1,True)
-	pm.run(cmd,  re.sub(".sam$" , "_sorted.depth",out_bowtie1),shell=True)
+	cmd += " && " + tools.python + " " + os.path.join(tools.scripts_dir, "bam_coverage.py")
+	cmd += " -i " + sorted_bowtie1 + " -o " + re.sub(".sam$" , "_sorted.depth.bw", out_bowtie1)
+	cmd += " -p " + str(pm.cores) + " --samtools " + tools.samtools
+	target = re.sub(".sam$" , "_sorted.depth.bw", out_bowtie1)
+
+if not (args.ERCC_mix == "False" ) and not combined_index:
+	def check_unaligned():
+		counts = []
+		for count_file in unaligned_counts:
+			with open(count_file) as handle:
+				counts.append(int(float(handle.read().split()[0])))
+		if len(set(counts)) > 1:
+			raise Exception("Unaligned mates differ in number: " + ", ".join(str(n) for n in counts))
+		pm.report_result("ERCC_raw_reads", str(sum(counts)))
+		pm.report_result("ERCC_fastq_reads", sum(counts))
+
+	cmd = preprocessing.stream_cmd(un_readers, un_fifos, cmd, readers=True)
+	pm.run(cmd, target, shell=True, follow=preprocessing.follow_all(check_aligned, check_unaligned))
+else:
+	pm.run(cmd, target, shell=True, follow=check_aligned)
 
-pm.clean_add(out_bowtie1, conditional=False)
-pm.clean_add(re.sub(".sam$" , ".bam", out_bowtie1), conditional=False)
+genome_cores = int(pm.cores)
 
+# ERCC Spike-in alignment
+########################################################################################
+# The ERCC branch only needs the unaligned reads (or its share of the combined
+# alignment): it runs in the background, alongside the genome branch, with its
+# own share of the cores.
+if not (args.ERCC_mix == "False" ):
+	genome_cores = max(1, int(pm.cores) - ercc_cores)
+	pm.timestamp("### ERCC: Bowtie1 alignment and expression analysis (BitSeq), in the background: ")
+
+	if combined_index:
+		# already aligned, split off and sorted above
+		cmd = ""
+	elif not args.paired_end:
+		cmd = tools.bowtie1
+		cmd += " -q -p " + str(ercc_cores) + " -a -m 100 --sam "
+		cmd += resources.bowtie_indexed_ERCC + " "
+		cmd += unaligned_fastqs[0]
+	else:
+		cmd = tools.bowtie1
+		cmd += " -q -p " + str(ercc_cores) + " -a -m 100 --minins 0 --maxins 5000 --fr --sam --chunkmbs 200 "
+		cmd += resources.bowtie_indexed_ERCC
+		cmd += " -1 " + unaligned_fastqs[0]
+		cmd += " -2 " + unaligned_fastqs[1]
+
+	if not combined_index:
+		cmd += " | " + tools.samtools + " sort -@ " + str(ercc_cores)
+		cmd += " -T " + re.sub(".sam$" , "_tmp", out_ercc)
+		cmd += " -o " + sorted_ercc + " -"
+		cmd = preprocessing.pipefail(cmd)
+		cmd += " && " + tools.samtools + " index " + sorted_ercc + " && "
+	cmd += tools.python + " " + os.path.join(tools.scripts_dir, "bam_coverage.py")
+	cmd += " -i " + sorted_ercc + " -o " + re.sub(".sam$" , "_sorted.depth.bw", out_ercc)
+	cmd += " -p " + str(ercc_cores) + " --samtools " + tools.samtools
+	ercc_steps = [(cmd, re.sub(".sam$" , "_sorted.depth.bw", out_ercc),
+		lambda: pm.report_result("ERCC_aligned_reads", bam_stats.get_stats(sorted_ercc, args.paired_end, tools.samtools)["Aligned_reads"]))]
+
+	ercc_bitSeq_dir = os.path.join(ercc_folder,"bitSeq")
+	pm.make_sure_path_exists(ercc_bitSeq_dir)
+	out_ercc_bitSeq = os.path.join(ercc_bitSeq_dir,re.sub(".aln.sam$" , ".counts",out_ercc))
+
+	cmd = bitseq_sam(sorted_ercc, out_ercc, ercc_cores)
+	cmd += " && " + tools.Rscript + " " + os.path.join(tools.scripts_dir,"bitSeq_parallel.R") + " " + out_ercc + " " + ercc_bitSeq_dir + " " + resources.ref_ERCC_fasta
+	ercc_steps.append((cmd, out_ercc_bitSeq, None))
+	pm.clean_add(out_ercc, conditional=False)
+
+	preprocessing.start_branch(pm, "ERCC", ercc_steps, os.path.join(ercc_folder, args.sample_name + "_ERCC.log"))
+	if not combined_index:
+		pm.clean_add(unmappable_fastq + "*.fastq.gz", conditional=False)
 
-if not args.filter:
-	pm.timestamp("### MarkDuplicates: ")
-	aligned_file = re.sub(".sam$" , "_sorted.bam",out_bowtie1)
-	out_file = re.sub(".sam$" , "_dedup.bam",out_bowtie1)
-	metrics_file = re.sub(".sam$" , "_dedup.metrics",out_bowtie1)
-	cmd = ngstk.markDuplicates(aligned_file, out_file, metrics_file)
-	pm.run(cmd, out_file, follow= lambda: pm.report_result("Deduplicated_reads", ngstk.count_unique_mapped_reads(out_file, args.paired_end)))
 
 if args.filter:
+	pm.timestamp("### Packed genome store: ")
+	# built once per assembly, next to the fasta, and shared by all samples
+	cmd = tools.python + " " + os.path.join(tools.scripts_dir, "packed_genome.py")
+	cmd += " -f " + resources.ref_genome_fasta
+	cmd += " -o " + resources.ref_genome_2bit
+	pm.run(cmd, resources.ref_genome_2bit)
+
 	pm.timestamp("### Aligned read filtering: ")
+	# The filter writes sorted BAM files; the .sam names only serve as a base.
 	out_sam_filter = bowtie1_folder + args.sample_name + ".aln.filt.sam"
 	skipped_sam = out_sam_filter.replace(".filt." , ".skipped.")
-	headerLines = subprocess.check_output("samtools view -SH " + out_bowtie1 + "|wc -l", shell=True).strip()
+	filtered_bam = re.sub(".sam$" , "_sorted.bam", out_sam_filter)
+	skipped_bam = re.sub(".sam$" , "_sorted.bam", skipped_sam)
 	cmd = tools.python + " " + os.path.join(tools.scripts_dir,"bisulfiteReadFiltering_forRNA.py")
-	cmd += " --infile=" + out_bowtie1
-	cmd += " --outfile=" + out_sam_filter
-	cmd += " --skipped=" + skipped_sam
-	cmd += " --skipHeaderLines=" + headerLines
+	cmd += " --outfile=" + filtered_bam
+	cmd += " --skipped=" + skipped_bam
 	cmd += " --genome=" + args.genome_assembly
 	cmd += " --genomeDir=" + resources.ref_genome
 	cmd += " --minNonCpgSites=3"
 	cmd += " --minConversionRate=0.9"
 	cmd += " --maxConversionRate=0.1"
 	cmd += " -r"
+	cmd += " --cores=" + str(genome_cores)
+	cmd += " --samtools=" + tools.samtools
 
 	if args.paired_end:
-		cmd = cmd + " --pairedEnd"
-
-	pm.run(cmd, out_sam_filter,follow=pm.report_result("Filtered_reads", ngstk.count_unique_mapped_reads(out_sam_filter, args.paired_end)))
-
-	pm.timestamp("### Filtered: SAM to BAM conversion, sorting and depth calculation: ")
-	cmd = ngstk.sam_conversions(out_sam_filter)
-	pm.run(cmd, re.sub(".sam$" , "_sorted.depth",out_sam_filter),shell=True)
+		# mates are judged together, so the filter needs the reads grouped by name
+		cmd += " --pairedEnd --sort --infile=-"
+		cmd = tools.samtools + " sort -n -@ " + str(genome_cores) + " -O sam -T " + re.sub(".sam$" , "_tmp", out_bowtie1) + " " + sorted_bowtie1 + " | " + cmd
+		cmd = preprocessing.pipefail(cmd)
+	else:
+		cmd += " --infile=" + sorted_bowtie1
 
+	pm.run(cmd, filtered_bam, shell=True,
+		follow=lambda: pm.report_result("Filtered_reads", bam_stats.get_stats(filtered_bam, args.paired_end, tools.samtools)["Aligned_reads"]))
 
-	pm.timestamp("### Skipped: SAM to BAM conversion and sorting: ")
-	cmd = ngstk.sam_conversions(skipped_sam,False)
-	pm.run(cmd, re.sub(".sam$", "_sorted.bam", skipped_sam),shell=True)
-	
-	pm.clean_add(skipped_sam, conditional=False)
-	pm.clean_add(re.sub(".sam$" , ".bam", skipped_sam), conditional=False)
-	pm.clean_add(out_sam_filter, conditional=False)
-	pm.clean_add(re.sub(".sam$" , ".bam", out_sam_filter), conditional=False)
+# Depth, duplicates and BitSeq only read the aligned (and filtered) reads, so
+# they run side by side on shares of the genome branch's cores.
+stages = stage_graph.StageGraph(pm, cores=genome_cores)
+side_cores = max(1, genome_cores // 4)
+if args.filter:
+	cmd = tools.python + " " + os.path.join(tools.scripts_dir, "bam_coverage.py")
+	cmd += " -i " + filtered_bam + " -o " + re.sub(".sam$" , "_sorted.depth.bw", out_sam_filter)
+	cmd += " -p " + str(side_cores) + " --samtools " + tools.samtools
+	stages.add("Filtered: depth calculation", cmd, re.sub(".sam$" , "_sorted.depth.bw", out_sam_filter),
+		inputs=[filtered_bam], cores=side_cores, mem=stages.mem / 8, shell=True)
 
-	pm.timestamp("### MarkDuplicates: ")
-	
 	aligned_file = re.sub(".sam$" , "_sorted.bam",out_sam_filter)
 	out_file = re.sub(".sam$" , "_dedup.bam",out_sam_filter)
 	metrics_file = re.sub(".sam$" , "_dedup.metrics",out_sam_filter)
-	cmd = ngstk.markDuplicates(aligned_file, out_file, metrics_file)
-	pm.run(cmd, out_file,follow=lambda: pm.report_result("Deduplicated_reads", ngstk.count_unique_mapped_reads(out_file, args.paired_end)))
+else:
+	aligned_file = re.sub(".sam$" , "_sorted.bam",out_bowtie1)
+	out_file = re.sub(".sam$" , "_dedup.bam",out_bowtie1)
+	metrics_file = re.sub(".sam$" , "_dedup.metrics",out_bowtie1)
+# NGSTk gives java the job's memory; MarkDuplicates gets half of it, next to BitSeq
+cmd = stage_graph.java_mem(ngstk.markDuplicates(aligned_file, out_file, metrics_file), stages.mem / 2)
+stages.add("MarkDuplicates", cmd, out_file, inputs=[aligned_file], outputs=[metrics_file], mem=stages.mem / 2,
+	follow=lambda: pm.report_result("Deduplicated_reads", bam_stats.get_stats(out_file, args.paired_end, tools.samtools)["Aligned_reads"]))
 
 # BitSeq
 ########################################################################################
-pm.timestamp("### Expression analysis (BitSeq): ")
-
 bitSeq_dir = os.path.join(bowtie1_folder,"bitSeq")
 pm.make_sure_path_exists(bitSeq_dir)
 out_bitSeq = os.path.join(bitSeq_dir, args.sample_name + ".counts")
 
 if args.filter:
-	cmd = tools.Rscript + " " + os.path.join(tools.scripts_dir,"bitSeq_parallel.R") + " " + out_sam_filter + " " + bitSeq_dir + " " + resources.ref_genome_fasta
+	cmd = bitseq_sam(filtered_bam, out_sam_filter, max(1, genome_cores - side_cores - 1))
+	cmd += " && " + tools.Rscript + " " + os.path.join(tools.scripts_dir,"bitSeq_parallel.R") + " " + out_sam_filter + " " + bitSeq_dir + " " + resources.ref_genome_fasta
+	stages.add("Expression analysis (BitSeq)", cmd, out_bitSeq, inputs=[filtered_bam], outputs=[bitSeq_dir],
+		cores=max(1, genome_cores - side_cores - 1), mem=stages.mem * 3 / 8, shell=True)
+	pm.clean_add(out_sam_filter, conditional=False)
 else:
-	cmd = tools.Rscript + " " + os.path.join(tools.scripts_dir,"bitSeq_parallel.R") + " " + out_bowtie1 + " " + bitSeq_dir + " " + resources.ref_genome_fasta
-
-pm.run(cmd, out_bitSeq)
-
-
-# ERCC Spike-in alignment
-########################################################################################
-if not (args.ERCC_mix == "False" ):
-	pm.timestamp("### ERCC: Convert unmapped reads into fastq files: ")
-
-	# Sanity checks:
-	def check_fastq_ERCC():
-		raw_reads = ngstk.count_reads(unmappable_bam + ".bam",args.paired_end)
-		pm.report_result("ERCC_raw_reads", str(raw_reads))
-		fastq_reads = ngstk.count_reads(unmappable_bam + "_R1.fastq", paired_end=args.paired_end)
-		pm.report_result("ERCC_fastq_reads", fastq_reads)
-		if (fastq_reads != int(raw_reads)):
-			raise Exception("Fastq conversion error? Size doesn't match unaligned bam")
-
-	unmappable_bam = re.sub(".sam$","_unmappable",out_bowtie1)
-	cmd = tools.samtools + " view -hbS -f4 " + out_bowtie1 + " > " + unmappable_bam + ".bam"
-	pm.run(cmd, unmappable_bam + ".bam", shell=True)
-
-	cmd = ngstk.bam_to_fastq(unmappable_bam + ".bam", unmappable_bam, args.paired_end)
-	pm.run(cmd, unmappable_bam + "_R1.fastq",follow=check_fastq_ERCC)
-
-	pm.timestamp("### ERCC: Bowtie1 alignment: ")
-	bowtie1_folder = os.path.join(param.pipeline_outfolder,"bowtie1_" + args.ERCC_assembly)
-	pm.make_sure_path_exists(bowtie1_folder)
-	out_bowtie1 = os.path.join(bowtie1_folder, args.sample_name + "_ERCC.aln.sam")
-
-	if not args.paired_end:
-		cmd = tools.bowtie1
-		cmd += " -q -p " + str(pm.cores) + " -a -m 100 --sam "
-		cmd += resources.bowtie_indexed_ERCC + " "
-		cmd += unmappable_bam + "_R1.fastq"
-		cmd += " -S " + out_bowtie1
-	else:
-		cmd = tools.bowtie1
-		cmd += " -q -p " + str(pm.cores) + " -a -m 100 --minins 0 --maxins 5000 --fr --sam --chunkmbs 200 "
-		cmd += resources.bowtie_indexed_ERCC
-		cmd += " -1 " + unmappable_bam + "_R1.fastq"
-		cmd += " -2 " + unmappable_bam + "_R2.fastq"
-		cmd += " -S " + out_bowtie1
-
-
-#	if not args.paired_end:
-#		cmd = param.bowtie1
-#		cmd += " -q -p 6 -a -m 100 --sam "
-#		cmd += param.bowtie_indexed_ERCC + " "
-#		cmd += unmappable_bam + "_R1.fastq"
-#		cmd += " " + out_bowtie1
-#	else:
-#		cmd = param.bowtie1
-#		cmd += " -q -p 6 -a -m 100 --minins 0 --maxins 5000 --fr --sam --chunkmbs 200 "
-#		cmd += param.bowtie_indexed_ERCC
-#		cmd += " -1 " + unmappable_bam + "_R1.fastq"
-#		cmd += " -2 " + unmappable_bam + "_R2.fastq"
-#		cmd += " " + out_bowtie1
-
-	pm.run(cmd, out_bowtie1,follow=lambda: pm.report_result("ERCC_aligned_reads", ngstk.count_unique_mapped_reads(out_bowtie1, args.paired_end)))
-
-	pm.timestamp("### ERCC: SAM to BAM conversion, sorting and depth calculation: ")
-	cmd = ngstk.sam_conversions(out_bowtie1)
-	pm.run(cmd, re.sub(".sam$" , "_sorted.depth", out_bowtie1), shell=True)
-
+	cmd = bitseq_sam(sorted_bowtie1, out_bowtie1, max(1, genome_cores - 1))
+	cmd += " && " + tools.Rscript + " " + os.path.join(tools.scripts_dir,"bitSeq_parallel.R") + " " + out_bowtie1 + " " + bitSeq_dir + " " + resources.ref_genome_fasta
+	stages.add("Expression analysis (BitSeq)", cmd, out_bitSeq, inputs=[sorted_bowtie1], outputs=[bitSeq_dir],
+		cores=max(1, genome_cores - 1), mem=stages.mem / 2, shell=True)
 	pm.clean_add(out_bowtie1, conditional=False)
-	pm.clean_add(re.sub(".sam$" , ".bam", out_bowtie1), conditional=False)
-	pm.clean_add(unmappable_bam + "*.fastq", conditional=False)
-
-# BitSeq
-########################################################################################
-	pm.timestamp("### ERCC: Expression analysis (BitSeq): ")
-
-	bitSeq_dir = os.path.join(bowtie1_folder,"bitSeq")
-	pm.make_sure_path_exists(bitSeq_dir)
-	out_bitSeq = os.path.join(bitSeq_dir,re.sub(".aln.sam$" , ".counts",out_bowtie1))
-
-	cmd = tools.Rscript + " " + os.path.join(tools.scripts_dir,"bitSeq_parallel.R") + " " + out_bowtie1 + " " + bitSeq_dir + " " + resources.ref_ERCC_fasta
-	pm.run(cmd, out_bitSeq)
+stages.run()
 
 
 # Cleanup
 ########################################################################################
+preprocessing.join_branches(pm)
+preprocessing.join_fastqc(pm)
 # remove temporary marker file:
 pm.stop_pipeline()
 
@@ -3,6 +3,7 @@
 
 from argparse import ArgumentParser
 from functools import partial
+import json
 import os
 import sys
 
@@ -11,6 +12,14 @@ import yaml
 from peppy import AttributeDict
 from pypiper import add_pypiper_args, get_first_value, NGSTk, PipelineManager
 
+import preprocessing
+import stage_cache
+import resource_staging
+import stage_graph
+import stage_profile
+sys.path.append(preprocessing.TOOLS_DIR)
+import kallisto_batch
+
 
 __author__ = "Andre Rendeiro"
 __copyright__ = "Copyright 2015, Andre Rendeiro"
@@ -57,10 +66,95 @@ def arg_parser(parser):
 		dest="single_end_defaults",
 		help="Use the default fragment length and fragment length standard deviation "
 			 "specified in the Yaml config file.")
+	parser.add_argument(
+		"--stream",
+		action="store_true",
+		dest="stream",
+		help="Stream input conversion straight into the trimmer, "
+			 "without intermediate fastq files.")
+	parser.add_argument(
+		"--stream-qc",
+		action="store_true",
+		dest="stream_qc",
+		help="With --stream, also collect read quality metrics from the stream.")
+	parser.add_argument(
+		"--preprocessing-cache",
+		dest="preprocessing_cache",
+		help="Folder shared by the pipelines run on a sample, to convert "
+			 "and trim its input only once.")
+	parser.add_argument(
+		"--preprocessing-cache-size",
+		dest="preprocessing_cache_size",
+		type=float,
+		default=100,
+		help="Maximum size of the preprocessing cache, in GB; least recently "
+			 "used inputs are evicted.")
+	parser.add_argument(
+		"--stage-cache",
+		dest="stage_cache",
+		help="Folder of a cache of stage results, restored instead of "
+			 "recomputed when command, tools and inputs are unchanged.")
+	parser.add_argument(
+		"--stage-cache-size",
+		dest="stage_cache_size",
+		type=float,
+		default=100,
+		help="Maximum size of the stage cache, in GB; least recently used "
+			 "stages are evicted.")
+	parser.add_argument(
+		"--stage-resources",
+		dest="stage_resources",
+		help="Node-local scratch folder to copy the kallisto index to, "
+			 "once per node.")
+	parser.add_argument(
+		"--stage-resources-size",
+		dest="stage_resources_size",
+		type=float,
+		default=200,
+		help="Maximum size of the staged resources, in GB; least recently "
+			 "used assemblies are evicted.")
+	parser.add_argument(
+		"--profile",
+		action="store_true",
+		dest="profile",
+		help="Sample the processes of each stage for time, memory, IO and "
+			 "threads, into stage_profile.tsv; see tools/profile_rollup.py.")
+	parser.add_argument(
+		"--kallisto-batch",
+		dest="kallisto_batch",
+		help="Instead of quantifying the sample, add its trimmed reads to this "
+			 "project batch file, to be quantified with all other samples "
+			 "by tools/kallisto_batch.py.")
+	parser.add_argument(
+		"--scatter-bootstraps",
+		action="store_true",
+		dest="scatter_bootstraps",
+		help="Spread the bootstrap samples over concurrent kallisto quant "
+			 "runs, each with a seed of its own, instead of running them all "
+			 "within one. Each run loads the index, so there are as many as "
+			 "fit in the job's memory.")
+	parser.add_argument(
+		"--abundance-matrix",
+		dest="abundance_matrix",
+		help="Project matrix folder to add the sample's abundances to, "
+			 "see tools/abundance_matrix.py.")
 	return parser
 
 
 
+def report_run_info(pm, run_info):
+	"""
+	Report the read counts of a kallisto run, as kallisto_batch.py does for
+	the samples of a batch.
+	"""
+	with open(run_info) as handle:
+		info = json.load(handle)
+	pm.report_result("Kallisto_processed_reads", info["n_processed"])
+	pm.report_result("Kallisto_pseudoaligned_reads", info["n_pseudoaligned"])
+	pm.report_result("Kallisto_pseudoaligned_rate", info["p_pseudoaligned"])
+
+
+
 def process(sample, pipeline_config, args):
 	"""
 	This takes unmapped Bam files and makes trimmed, aligned, duplicate marked
@@ -79,6 +173,10 @@ def process(sample, pipeline_config, args):
 
 	# Start Pypiper object
 	pm = PipelineManager("rnaKallisto", sample.paths.sample_root, args=args)
+	if args.stage_cache:
+		stage_cache.StageCache(args.stage_cache, args.stage_cache_size).install(pm)
+	if args.profile:
+		stage_profile.StageProfiler(sample.paths.sample_root).install(pm)
 
 	print "\nPipeline configuration:"
 	print(pm.config)
@@ -99,9 +197,13 @@ def process(sample, pipeline_config, args):
 	pm.timestamp("Converting to Fastq format", checkpoint="standardize_input")
 
 	local_input_files = ngstk.merge_or_link([args.input, args.input2], raw_folder, args.sample_name)
-	cmd, out_fastq_pre, unaligned_fastq = ngstk.input_to_fastq(local_input_files, args.sample_name, sample.paired, fastq_folder)
-	pm.run(cmd, unaligned_fastq, 
-		follow=ngstk.check_fastq(local_input_files, unaligned_fastq, sample.paired))
+	if args.stream:
+		# Conversion runs together with the trimming, through named pipes
+		stream_producers, out_fastq_pre, stream_fifos, stream_counts = preprocessing.stream_input_to_fastq(
+			ngstk, local_input_files, args.sample_name, sample.paired, fastq_folder, qc=args.stream_qc)
+	else:
+		# Conversion runs before the trimming below, unless trimmed reads are reused
+		convert_cmd, out_fastq_pre, unaligned_fastq = ngstk.input_to_fastq(local_input_files, args.sample_name, sample.paired, fastq_folder)
 	pm.clean_add(out_fastq_pre + "*.fastq", conditional=True)
 
 	pm.report_result("File_mb", ngstk.get_file_size(local_input_files))
@@ -126,6 +228,17 @@ def process(sample, pipeline_config, args):
 
 	# Trim reads
 	pm.timestamp("Trimming adapters from sample", checkpoint="trim")
+	check_trim = ngstk.check_trim(sample.trimmed, sample.paired, sample.trimmed2)
+	if args.stream:
+		check_trim = preprocessing.follow_all(
+			preprocessing.check_stream(pm, stream_counts, sample.paired,
+				out_fastq_pre if args.stream_qc else None), check_trim)
+
+	convert_steps = []
+	if not args.stream:
+		convert_steps.append((convert_cmd, unaligned_fastq,
+			ngstk.check_fastq(local_input_files, unaligned_fastq, sample.paired), None))
+
 	if pipeline_config.parameters.trimmer == "trimmomatic":
 
 		inputFastq1 = sample.fastq1 if sample.paired else sample.fastq
@@ -152,17 +265,22 @@ def process(sample, pipeline_config, args):
 		cmd += " MAXINFO:16:0.40"
 		cmd += " MINLEN:21"
 
-
-		pm.run(cmd, sample.trimmed1 if sample.paired else sample.trimmed, shell=True,
-			follow = ngstk.check_trim(sample.trimmed, sample.paired, sample.trimmed2,
-				fastqc_folder = os.path.join(sample.paths.sample_root, "fastqc/")))
-		if not sample.paired:
-			pm.clean_add(sample.trimmed, conditional=True)
-		else:
-			pm.clean_add(sample.trimmed1, conditional=True)
-			pm.clean_add(sample.trimmed1Unpaired, conditional=True)
-			pm.clean_add(sample.trimmed2, conditional=True)
-			pm.clean_add(sample.trimmed2Unpaired, conditional=True)
+		trim_cmd = cmd
+		if args.stream:
+			cmd = preprocessing.stream_cmd(stream_producers, stream_fifos, cmd)
+		preprocessing.run_preprocessing(pm, args.preprocessing_cache, local_input_files, trim_cmd, out_fastq_pre,
+			convert_steps + [(cmd, sample.trimmed1 if sample.paired else sample.trimmed, check_trim, True)],
+			[sample.trimmed1, sample.trimmed1Unpaired, sample.trimmed2, sample.trimmed2Unpaired] if sample.paired else [sample.trimmed],
+			args.preprocessing_cache_size)
+		# In batch mode, trimmed reads are kept until kallisto_batch.py quantifies them.
+		if not args.kallisto_batch:
+			if not sample.paired:
+				pm.clean_add(sample.trimmed, conditional=True)
+			else:
+				pm.clean_add(sample.trimmed1, conditional=True)
+				pm.clean_add(sample.trimmed1Unpaired, conditional=True)
+				pm.clean_add(sample.trimmed2, conditional=True)
+				pm.clean_add(sample.trimmed2Unpaired, conditional=True)
 
 	elif pipeline_config.parameters.trimmer == "skewer":
 		skewer_dirpath = os.path.join(sample.paths.sample_root, "skewer")
@@ -178,26 +296,30 @@ def process(sample, pipeline_config, args):
 			cpus=args.cores,
 			adapters=pipeline_config.resources.adapters
 		)
-		pm.run(cmd, sample.trimmed1 if sample.paired else sample.trimmed, shell=True,
-			follow = ngstk.check_trim(sample.trimmed, sample.paired, sample.trimmed2,
-				fastqc_folder = os.path.join(sample.paths.sample_root, "fastqc/")))
-		if not sample.paired:
-			pm.clean_add(sample.trimmed, conditional=True)
-		else:
-			pm.clean_add(sample.trimmed1, conditional=True)
-			pm.clean_add(sample.trimmed2, conditional=True)
-
+		trim_cmd = cmd
+		if args.stream:
+			cmd = preprocessing.stream_cmd(stream_producers, stream_fifos, cmd)
+		preprocessing.run_preprocessing(pm, args.preprocessing_cache, local_input_files, trim_cmd, out_fastq_pre,
+			convert_steps + [(cmd, sample.trimmed1 if sample.paired else sample.trimmed, check_trim, True)],
+			[sample.trimmed1, sample.trimmed1Unpaired, sample.trimmed2, sample.trimmed2Unpaired] if sample.paired else [sample.trimmed],
+			args.preprocessing_cache_size)
+		if not args.kallisto_batch:
+			if not sample.paired:
+				pm.clean_add(sample.trimmed, conditional=True)
+			else:
+				pm.clean_add(sample.trimmed1, conditional=True)
+				pm.clean_add(sample.trimmed2, conditional=True)
+
+	# FastQC runs alongside the quantification; its reports are collected at the end.
 	pm.timestamp("Performing quality control", checkpoint="quality_control")
-	fastqc_folder = os.path.join(sample.paths.sample_root, "fastqc")
-	perform_quality_control = ngstk.check_trim(
-		sample.trimmed, sample.paired, sample.trimmed2, fastqc_folder=fastqc_folder)
-	perform_quality_control()
+	preprocessing.start_fastqc(ngstk, [sample.trimmed, sample.trimmed2 if sample.paired else None],
+		os.path.join(sample.paths.sample_root, "fastqc"))
 
 	# With kallisto from unmapped reads
 	pm.timestamp("Quantifying read counts with kallisto", checkpoint="quantify")
 
 	inputFastq = sample.trimmed1 if sample.paired else sample.trimmed
-	inputFastq2 = sample.trimmed1 if sample.paired else None
+	inputFastq2 = sample.trimmed2 if sample.paired else None
 	transcriptome_index = os.path.join(	pm.config.resources.genomes, 
 										sample.transcriptome,
 										"indexed_kallisto",
@@ -223,28 +345,81 @@ def process(sample, pipeline_config, args):
 
 	sample.paths.quant = os.path.join(sample.paths.sample_root, "kallisto")
 	sample.kallistoQuant = os.path.join(sample.paths.quant,"abundance.h5")
-	cmd1 = tools.kallisto + " quant -b {boot} -i {index} -o {outdir} -t {cores}".\
-			format(boot=n_boot, index=transcriptome_index, outdir=sample.paths.quant, cores=args.cores)
 
-	
-	# Point to the data file(s).
-	if not sample.paired:
-		cmd1 += " --single {0}".format(inputFastq)
-		# Add fragment size parameters.
-		if size is not None:
-			cmd1 += " -l {0}".format(size)
-		if sdev is not None:
-			cmd1 += " -s {0}".format(sdev)
+	if args.kallisto_batch:
+		# The index is loaded once for all samples of the batch, by kallisto_batch.py,
+		# which adds the kallisto read counts to this sample's stats file. It runs
+		# later, maybe on another node, so it gets the index from the genomes
+		# folder and stages it itself.
+		if n_boot:
+			pm.timestamp("Bootstraps are not estimated in batch mode.")
+		kallisto_batch.add_sample(
+			os.path.abspath(args.kallisto_batch), sample.sample_name, transcriptome_index,
+			sample.paths.quant, os.path.abspath(inputFastq),
+			os.path.abspath(inputFastq2) if sample.paired else None,
+			None if sample.paired else size, None if sample.paired else sdev,
+			os.path.abspath(pm.pipeline_stats_file))
+		pm.report_result("Kallisto_batch", os.path.abspath(args.kallisto_batch))
+		pm.timestamp("Added sample %s to kallisto batch %s" % (sample.sample_name, args.kallisto_batch))
+		preprocessing.join_fastqc(pm)
+		pm.stop_pipeline()
+		return
+
+	stager = None
+	if args.stage_resources:
+		# kept for the whole run: it holds the staged index in use, so that
+		# other jobs don't evict it while kallisto reads it
+		stager = resource_staging.ResourceStager(
+			args.stage_resources, pm.config.resources.genomes, args.stage_resources_size)
+		transcriptome_index = stager.stage(transcriptome_index)
 
+	abundance_outfile_path = os.path.join(sample.paths.quant, "abundance.h5")
+	if args.scatter_bootstraps and n_boot:
+		# Spread the bootstraps over kallisto runs, as many as have memory for
+		# the index (twice its size, to be safe) and at most one per core.
+		index_mb = os.path.getsize(transcriptome_index) / 1024.0 ** 2
+		shards = max(1, min(int(args.cores), int(stage_graph.megabytes(pm.mem) / (2 * index_mb + 1))))
+		cmd1 = tools.python + " " + os.path.join(preprocessing.TOOLS_DIR, "kallisto_bootstrap.py")
+		cmd1 += " -b {boot} -i {index} -o {outdir} -p {cores} -j {shards}".\
+			format(boot=n_boot, index=transcriptome_index, outdir=sample.paths.quant, cores=args.cores, shards=shards)
+		cmd1 += " --kallisto " + tools.kallisto
+		if not sample.paired:
+			cmd1 += " -l {0} -s {1} {2}".format(size, sdev, inputFastq)
+		else:
+			cmd1 += " {0} {1}".format(inputFastq, inputFastq2)
+		# it writes the tables of abundance.h5 itself
+		cmds = [cmd1]
 	else:
-		cmd1 += " {0} {1}".format(inputFastq, inputFastq2)
+		cmd1 = tools.kallisto + " quant -b {boot} -i {index} -o {outdir} -t {cores}".\
+				format(boot=n_boot, index=transcriptome_index, outdir=sample.paths.quant, cores=args.cores)
 
-	abundance_outfile_path = os.path.join(sample.paths.quant, "abundance.h5")
-	cmd2 = tools.kallisto + " h5dump -o {} {}".format(
-			sample.paths.quant, abundance_outfile_path)
+		# Point to the data file(s).
+		if not sample.paired:
+			cmd1 += " --single {0}".format(inputFastq)
+			# Add fragment size parameters.
+			if size is not None:
+				cmd1 += " -l {0}".format(size)
+			if sdev is not None:
+				cmd1 += " -s {0}".format(sdev)
+
+		else:
+			cmd1 += " {0} {1}".format(inputFastq, inputFastq2)
+
+		cmd2 = tools.kallisto + " h5dump -o {} {}".format(
+				sample.paths.quant, abundance_outfile_path)
+		cmds = [cmd1, cmd2]
+
+	pm.run(cmds, sample.kallistoQuant, shell=True)
+	report_run_info(pm, os.path.join(sample.paths.quant, "run_info.json"))
 
-	pm.run([cmd1,cmd2], sample.kallistoQuant, shell=True)
+	if args.abundance_matrix:
+		cmd = tools.python + " " + os.path.join(preprocessing.TOOLS_DIR, "abundance_matrix.py")
+		cmd += " -m " + args.abundance_matrix + " " + sample.kallistoQuant
+		# Marks the sample as added to the matrix, so reruns skip the step.
+		added = os.path.join(sample.paths.quant, "abundance_matrix.added")
+		pm.run([cmd, "touch " + added], added, lock_name="abundance_matrix")
 
+	preprocessing.join_fastqc(pm)
 	pm.stop_pipeline()
 	print("Finished processing sample %s." % sample.sample_name)
 
@@ -10,6 +10,14 @@ import subprocess
 import re
 import pypiper
 
+import preprocessing
+import stage_cache
+import resource_staging
+import stage_graph
+import stage_profile
+sys.path.append(preprocessing.TOOLS_DIR)
+import bam_stats
+
 
 # Argument Parsing
 # #######################################################################################
@@ -19,6 +27,24 @@ parser = pypiper.add_pypiper_args(parser, all_args=True)
 parser.add_argument('-f', dest='filter', action='store_false', default=True)
 parser.add_argument('-d', dest='markDupl', action='store_true', default=False)
 parser.add_argument('-w', '--wigsum', default=500000000, dest='wigsum', type=int, help='Target wigsum for track normalisation')
+parser.add_argument('--stream', dest='stream', action='store_true', default=False,
+				help='Stream input conversion straight into the trimmer, without intermediate fastq files')
+parser.add_argument('--stream-qc', dest='stream_qc', action='store_true', default=False,
+				help='With --stream, also collect read quality metrics from the stream')
+parser.add_argument('--preprocessing-cache', dest='preprocessing_cache', default=None,
+				help='Folder shared by the pipelines run on a sample, to convert and trim its input only once')
+parser.add_argument('--preprocessing-cache-size', dest='preprocessing_cache_size', type=float, default=100,
+				help='Maximum size of the preprocessing cache, in GB; least recently used inputs are evicted')
+parser.add_argument('--stage-cache', dest='stage_cache', default=None,
+				help='Folder of a cache of stage results, restored instead of recomputed when command, tools and inputs are unchanged')
+parser.add_argument('--stage-cache-size', dest='stage_cache_size', type=float, default=100,
+				help='Maximum size of the stage cache, in GB; least recently used stages are evicted')
+parser.add_argument('--stage-resources', dest='stage_resources', default=None,
+				help='Node-local scratch folder to copy the genome indexes and annotation to, once per node')
+parser.add_argument('--stage-resources-size', dest='stage_resources_size', type=float, default=200,
+				help='Maximum size of the staged resources, in GB; least recently used assemblies are evicted')
+parser.add_argument('--profile', dest='profile', action='store_true', default=False,
+				help='Sample the processes of each stage for time, memory, IO and threads, into stage_profile.tsv; see tools/profile_rollup.py')
 
 # Core-seq as optional parameter
 parser.add_argument('-cs', '--core-seq', default=False, dest='coreseq', action='store_true', help='CORE-seq Mode')
@@ -38,6 +64,10 @@ if not args.input:
 # Initialize
 outfolder = os.path.abspath(os.path.join(args.output_parent, args.sample_name))
 pm = pypiper.PipelineManager(name = "rnaTopHat", outfolder = outfolder, args = args)
+if args.stage_cache:
+	stage_cache.StageCache(args.stage_cache, args.stage_cache_size).install(pm)
+if args.profile:
+	stage_profile.StageProfiler(outfolder).install(pm)
 
 # Tools
 pm.config.tools.scripts_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), "tools")
@@ -45,12 +75,17 @@ pm.config.tools.scripts_dir = os.path.join(os.path.dirname(os.path.realpath(__fi
 # Resources
 pm.config.resources.ref_genome = os.path.join(pm.config.resources.genomes, args.genome_assembly)
 pm.config.resources.ref_genome_fasta = os.path.join(pm.config.resources.genomes, args.genome_assembly, args.genome_assembly + ".fa")
+pm.config.resources.ref_genome_2bit = os.path.join(pm.config.resources.genomes, args.genome_assembly, args.genome_assembly + ".2bit")
 pm.config.resources.chrom_sizes = os.path.join(pm.config.resources.genomes, args.genome_assembly, args.genome_assembly + ".chromSizes")
 pm.config.resources.bowtie_indexed_genome = os.path.join(pm.config.resources.genomes, args.genome_assembly, "indexed_bowtie2", args.genome_assembly)
 # tophat specific resources
 pm.config.resources.gtf = os.path.join(pm.config.resources.genomes, args.genome_assembly , "ucsc_" + args.genome_assembly + "_ensembl_genes.gtf")
 pm.config.resources.gene_model_bed = os.path.join(pm.config.resources.genomes, args.genome_assembly , "ucsc_" + args.genome_assembly + "_ensembl_genes.bed")
-pm.config.resources.gene_model_sub_bed = os.path.join(pm.config.resources.genomes, args.genome_assembly , "ucsc_" + args.genome_assembly + "_ensembl_genes_500rand.bed")
+
+# Node-local copies of the index and annotation tophat reads
+if args.stage_resources:
+	stager = resource_staging.ResourceStager(args.stage_resources, pm.config.resources.genomes, args.stage_resources_size)
+	stager.stage_resources(pm.config.resources, ["bowtie_indexed_genome", "gtf"])
 
 # Output
 pm.config.parameters.pipeline_outfolder = outfolder
@@ -74,9 +109,13 @@ fastq_folder = os.path.join(param.pipeline_outfolder, "fastq/")
 pm.timestamp("### Merge/link and fastq conversion: ")
 
 local_input_files = ngstk.merge_or_link([args.input, args.input2], raw_folder, args.sample_name)
-cmd, out_fastq_pre, unaligned_fastq = ngstk.input_to_fastq(local_input_files, args.sample_name, args.paired_end, fastq_folder)
-pm.run(cmd, unaligned_fastq, 
-	follow=ngstk.check_fastq(local_input_files, unaligned_fastq, args.paired_end))
+if args.stream:
+	# Conversion runs together with the trimming below, through named pipes
+	stream_producers, out_fastq_pre, stream_fifos, stream_counts = preprocessing.stream_input_to_fastq(
+		ngstk, local_input_files, args.sample_name, args.paired_end, fastq_folder, qc=args.stream_qc)
+else:
+	# Conversion runs before the trimming below, unless trimmed reads are reused
+	convert_cmd, out_fastq_pre, unaligned_fastq = ngstk.input_to_fastq(local_input_files, args.sample_name, args.paired_end, fastq_folder)
 pm.clean_add(out_fastq_pre + "*.fastq", conditional=True)
 
 pm.report_result("File_mb", ngstk.get_file_size(local_input_files))
@@ -87,15 +126,17 @@ pm.report_result("Genome", args.genome_assembly)
 ################################################################################
 pm.timestamp("### Adapter trimming: ")
 
+phred = preprocessing.detect_phred(pm, ngstk, local_input_files)
+
 cmd = tools.java + " -Xmx" + str(pm.mem) + " -jar " + tools.trimmomatic_epignome
 
 if not args.paired_end:
-	cmd += " SE -phred33 -threads " + str(pm.cores) + " "
+	cmd += " SE -" + phred + " -threads " + str(pm.cores) + " "
 	cmd += out_fastq_pre + "_R1.fastq "
 	cmd += out_fastq_pre + "_R1_trimmed.fastq "
 
 else:
-	cmd += " PE -phred33 -threads " + str(pm.cores) + " "
+	cmd += " PE -" + phred + " -threads " + str(pm.cores) + " "
 	cmd += out_fastq_pre + "_R1.fastq "
 	cmd += out_fastq_pre + "_R2.fastq "
 	cmd += out_fastq_pre + "_R1_trimmed.fastq "
@@ -117,14 +158,33 @@ else:
 	cmd += " MAXINFO:16:0.40"
 	cmd += " MINLEN:21"
 
+# phred64 input is converted on the fly, so everything downstream sees phred33
+if phred == "phred64":
+	cmd += " TOPHRED33"
+
 trimmed_fastq = out_fastq_pre + "_R1_trimmed.fastq"
 trimmed_fastq_R2 = out_fastq_pre + "_R2_trimmed.fastq"
 #pm.run(cmd, out_fastq_pre + "_R1_trimmed.fastq")
 #pm.report_result("Trimmed_reads", ngstk.count_reads(trimmed_fastq,args.paired_end))
 
-pm.run(cmd, trimmed_fastq, 
-	follow = ngstk.check_trim(trimmed_fastq, args.paired_end, trimmed_fastq_R2,
-		fastqc_folder = os.path.join(param.pipeline_outfolder, "fastqc/")))
+check_trim = ngstk.check_trim(trimmed_fastq, args.paired_end, trimmed_fastq_R2)
+
+if args.stream:
+	steps = [(preprocessing.stream_cmd(stream_producers, stream_fifos, cmd), trimmed_fastq,
+		preprocessing.follow_all(preprocessing.check_stream(pm, stream_counts, args.paired_end,
+			out_fastq_pre if args.stream_qc else None), check_trim), True)]
+else:
+	steps = [(convert_cmd, unaligned_fastq, ngstk.check_fastq(local_input_files, unaligned_fastq, args.paired_end), None),
+		(cmd, trimmed_fastq, check_trim, None)]
+trimmed_files = [trimmed_fastq]
+if args.paired_end:
+	trimmed_files += [trimmed_fastq_R2, out_fastq_pre + "_R1_unpaired.fastq", out_fastq_pre + "_R2_unpaired.fastq"]
+preprocessing.run_preprocessing(pm, args.preprocessing_cache, local_input_files, cmd, out_fastq_pre, steps, trimmed_files,
+	args.preprocessing_cache_size)
+
+# FastQC runs alongside the alignment; its reports are collected at the end.
+preprocessing.start_fastqc(ngstk, [trimmed_fastq, trimmed_fastq_R2 if args.paired_end else None],
+	os.path.join(param.pipeline_outfolder, "fastqc/"))
 
 
 # RNA Tophat pipeline.
@@ -162,15 +222,19 @@ pm.run(cmd, os.path.join(tophat_folder,"align_summary.txt"), shell=False)
 pm.timestamp("### renaming tophat aligned bam file ")
 cmd = "mv " + os.path.join(tophat_folder,"accepted_hits.bam") + " " + out_tophat
 pm.run(cmd, re.sub(".bam$", "_sorted.bam", out_tophat), shell=False, follow=lambda:
-	pm.report_result("Aligned_reads", ngstk.count_unique_mapped_reads(out_tophat,args.paired_end and not align_paired_as_single)))
+	pm.report_result("Aligned_reads", bam_stats.get_stats(out_tophat, args.paired_end and not align_paired_as_single, tools.samtools)["Aligned_reads"]))
 
 pm.timestamp("### BAM to SAM sorting and indexing: ")
 if args.filter:
 	cmd = ngstk.bam_conversions(out_tophat,False)
 	pm.run(cmd,  re.sub(".bam$", "_sorted.bam", out_tophat) ,shell=True)
 else:
-	cmd = ngstk.bam_conversions(out_tophat,True)
-	pm.run(cmd, re.sub(".bam$", "_sorted.depth", out_tophat),shell=True)
+	# depth is stored as an indexed bigWig instead of samtools depth text
+	cmd = ngstk.bam_conversions(out_tophat,False)
+	cmd += tools.python + " " + os.path.join(tools.scripts_dir, "bam_coverage.py")
+	cmd += " -i " + re.sub(".bam$", "_sorted.bam", out_tophat) + " -o " + re.sub(".bam$", "_sorted.depth.bw", out_tophat)
+	cmd += " -p " + str(pm.cores) + " --samtools " + tools.samtools
+	pm.run(cmd, re.sub(".bam$", "_sorted.depth.bw", out_tophat),shell=True)
 
 pm.clean_add(out_tophat, conditional=False)
 pm.clean_add(re.sub(".bam$" , ".sam", out_tophat), conditional=False)
@@ -183,94 +247,98 @@ if not args.filter and args.markDupl:
 	metrics_file = re.sub(".sam$", "_dedup.metrics", out_tophat)
 	cmd = ngstk.markDuplicates(aligned_file, out_file, metrics_file)
 	pm.run(cmd, out_file, follow= lambda:
-		pm.report_result("Deduplicated_reads", ngstk.count_unique_mapped_reads(out_file, args.paired_end and not align_paired_as_single)))
+		pm.report_result("Deduplicated_reads", bam_stats.get_stats(out_file, args.paired_end and not align_paired_as_single, tools.samtools)["Aligned_reads"]))
 
 #read filtering
 ########################################################################################
 
 if args.filter:
+	pm.timestamp("### Packed genome store: ")
+	# built once per assembly, next to the fasta, and shared by all samples
+	cmd = tools.python + " " + os.path.join(tools.scripts_dir, "packed_genome.py")
+	cmd += " -f " + resources.ref_genome_fasta
+	cmd += " -o " + resources.ref_genome_2bit
+	pm.run(cmd, resources.ref_genome_2bit)
+
 	pm.timestamp("### Aligned read filtering: ")
 
+	# The filter writes sorted BAM files; the .sam names only serve as a base.
 	out_sam_filter = tophat_folder + args.sample_name + ".aln.filt.sam"
-	headerLines = subprocess.check_output(tools.samtools + " view -SH " + re.sub(".bam$", ".sam", out_tophat) + "| wc -l", shell=True).strip()
+	skipped_sam = out_sam_filter.replace(".filt." , ".skipped.")
+	filtered_bam = re.sub(".sam$", "_sorted.bam", out_sam_filter)
 	cmd = tools.python + " " + os.path.join(tools.scripts_dir,"bisulfiteReadFiltering_forRNA.py")
-	cmd += " --infile=" + re.sub(".bam$",".sam", out_tophat)
-	cmd += " --outfile=" + out_sam_filter
-	cmd += " --skipped=" + out_sam_filter.replace(".filt." , ".skipped.")
-	cmd += " --skipHeaderLines=" + headerLines
+	cmd += " --outfile=" + filtered_bam
+	cmd += " --skipped=" + re.sub(".sam$" , "_sorted.bam", skipped_sam)
 	cmd += " --genome=" + args.genome_assembly
 	cmd += " --genomeDir=" + resources.ref_genome
 	cmd += " --minNonCpgSites=3"
 	cmd += " --minConversionRate=0.9"
 	cmd += " --maxConversionRate=0.1"
 	cmd += " -r"
+	cmd += " --cores=" + str(pm.cores)
+	cmd += " --samtools=" + tools.samtools
 
 	if args.paired_end and not align_paired_as_single:
-		cmd = cmd + " --pairedEnd"
-
-	pm.run(cmd, out_sam_filter, follow=lambda:
-		pm.report_result("Filtered_reads", ngstk.count_unique_mapped_reads(out_sam_filter, args.paired_end and not align_paired_as_single)))
-
-	pm.timestamp("### Filtered: SAM to BAM conversion, sorting and depth calculation: ")
-	cmd = ngstk.sam_conversions(out_sam_filter)
-	pm.run(cmd, re.sub(".sam$", "_sorted.depth", out_sam_filter),shell=True)
-
-	skipped_sam = out_sam_filter.replace(".filt." , ".skipped.")
-	pm.timestamp("### Skipped: SAM to BAM conversion and sorting: ")
-	cmd = ngstk.sam_conversions(skipped_sam,False)
-	pm.run(cmd, re.sub(".sam$" , "_sorted.bam", skipped_sam),shell=True)
+		# mates are judged together, so the filter needs the reads grouped by name
+		cmd += " --pairedEnd --sort --infile=-"
+		cmd = tools.samtools + " sort -n -@ " + str(pm.cores) + " -O sam -T " + re.sub(".bam$", "_tmp", out_tophat) + " " + re.sub(".bam$", "_sorted.bam", out_tophat) + " | " + cmd
+		cmd = preprocessing.pipefail(cmd)
+	else:
+		cmd += " --infile=" + re.sub(".bam$", "_sorted.bam", out_tophat)
 
-	pm.clean_add(skipped_sam, conditional=False)
-	pm.clean_add(re.sub(".sam$" , ".bam", skipped_sam), conditional=False)
-	pm.clean_add(out_sam_filter, conditional=False)
-	pm.clean_add(re.sub(".sam$" , ".bam", out_sam_filter), conditional=False)
+	pm.run(cmd, filtered_bam, shell=True, follow=lambda:
+		pm.report_result("Filtered_reads", bam_stats.get_stats(filtered_bam, args.paired_end and not align_paired_as_single, tools.samtools)["Aligned_reads"]))
 
 
 #create tracks
 ########################################################################################
-pm.timestamp("### bam2wig: ")
+# Depth, coverage track and read distribution only read the aligned reads, so
+# they run side by side on shares of the cores; gene coverage reads the track.
+stages = stage_graph.StageGraph(pm)
+track_cores = max(1, int(pm.cores) // 2)
+side_cores = max(1, int(pm.cores) // 4)
 if args.filter:
-	trackFile = re.sub(".sam$", "_sorted.bam", out_sam_filter)
-	cmd = tools.bam2wig + " -i " + trackFile
-	cmd += " -s " + resources.chrom_sizes
-	cmd += " -o " + re.sub(".sam$" , "_sorted", out_sam_filter)
-	cmd += " -t " + str(args.wigsum)
-	pm.run(cmd, re.sub(".sam$" , "_sorted.wig",out_sam_filter),shell=False)
-
-	pm.timestamp("### wigToBigWig: ")
-	cmd = tools.wigToBigWig + " " + re.sub(".sam$" , "_sorted.wig",out_sam_filter)
-	cmd += " " + resources.chrom_sizes
-	cmd += " " + re.sub(".sam$" , "_sorted.bw",out_sam_filter)
-	pm.run(cmd, re.sub(".sam$" , "_sorted.bw",out_sam_filter),shell=False)
+	cmd = tools.python + " " + os.path.join(tools.scripts_dir, "bam_coverage.py")
+	cmd += " -i " + filtered_bam + " -o " + re.sub(".sam$", "_sorted.depth.bw", out_sam_filter)
+	cmd += " -p " + str(side_cores) + " --samtools " + tools.samtools
+	stages.add("Filtered: depth calculation", cmd, re.sub(".sam$", "_sorted.depth.bw", out_sam_filter),
+		inputs=[filtered_bam], cores=side_cores, mem=stages.mem / 8, shell=True)
 
+	trackFile = re.sub(".sam$", "_sorted.bam", out_sam_filter)
+	out_track = re.sub(".sam$", "_sorted.bw", out_sam_filter)
 else:
 	trackFile = re.sub(".bam$", "_sorted.bam",out_tophat)
-	cmd = tools.bam2wig + " -i " + trackFile
-	cmd += " -s " + resources.chrom_sizes
-	cmd += " -o " + re.sub(".bam$" , "_sorted",out_tophat)
-	cmd += " -t " + str(args.wigsum)
-	pm.run(cmd, re.sub(".bam$" , "_sorted.wig",out_tophat),shell=False)
-
-	pm.timestamp("### wigToBigWig: ")
-	cmd = tools.wigToBigWig + " " + re.sub(".bam$" , "_sorted.wig",out_tophat)
-	cmd += " " + resources.chrom_sizes
-	cmd += " " + re.sub(".bam$" , "_sorted.bw",out_tophat)
-	pm.run(cmd, re.sub(".bam$" , "_sorted.bw", out_tophat),shell=False)
-
-pm.timestamp("### read_distribution: ")
-cmd = tools.read_distribution + " -i " + trackFile
+	out_track = re.sub(".bam$", "_sorted.bw", out_tophat)
+cmd = tools.python + " " + os.path.join(tools.scripts_dir, "bam_coverage.py")
+cmd += " -i " + trackFile
+cmd += " -s " + resources.chrom_sizes
+cmd += " -o " + out_track
+cmd += " -t " + str(args.wigsum)
+cmd += " -p " + str(track_cores)
+cmd += " --samtools " + tools.samtools
+stages.add("Coverage track", cmd, out_track, inputs=[trackFile], cores=track_cores, mem=stages.mem / 4, shell=False)
+
+cmd = tools.python + " " + os.path.join(tools.scripts_dir, "read_distribution.py")
+cmd += " -i " + trackFile
 cmd += " -r " + resources.gene_model_bed
+cmd += " -p " + str(side_cores) + " --samtools " + tools.samtools
 cmd += " > " + re.sub("_sorted.bam$", "_read_distribution.txt",trackFile)
-pm.run(cmd, re.sub("_sorted.bam$", "_read_distribution.txt",trackFile),shell=True, nofail=True)
+stages.add("read_distribution", cmd, re.sub("_sorted.bam$", "_read_distribution.txt",trackFile),
+	inputs=[trackFile], cores=side_cores, mem=stages.mem / 8, shell=True, nofail=True)
 
-pm.timestamp("### gene_coverage: ")
-cmd = tools.gene_coverage + " -i " + re.sub(".bam$" , ".bw",trackFile)
-cmd += " -r " + resources.gene_model_sub_bed
+cmd = tools.python + " " + os.path.join(tools.scripts_dir, "gene_body_coverage.py")
+cmd += " -i " + out_track
+cmd += " -r " + resources.gene_model_bed
 cmd += " -o " + re.sub("_sorted.bam$", "",trackFile)
-pm.run(cmd, re.sub("_sorted.bam$", ".geneBodyCoverage.png",trackFile),shell=False)
+cmd += " -p " + str(track_cores) + " --rscript " + tools.Rscript
+stages.add("gene_coverage", cmd, re.sub("_sorted.bam$", ".geneBodyCoverage.png",trackFile),
+	inputs=[out_track], outputs=[re.sub("_sorted.bam$", ".geneBodyCoverage.txt",trackFile),
+	re.sub("_sorted.bam$", ".geneBodyCoverage_plot.r",trackFile)], cores=track_cores, mem=stages.mem / 4, shell=False)
+stages.run()
 
 
 # Cleanup
 ########################################################################################
 
+preprocessing.join_fastqc(pm)
 pm.stop_pipeline()
@@ -0,0 +1,351 @@
+"""
+Stage result cache shared by the RNA pipelines.
+
+pm.run skips a stage only when its target exists, whatever the command that
+made it. With a stage cache, each stage gets a key from its command (with the
+sample's output folder taken out), the tools it calls and fast fingerprints
+of the input files it names (size, modification time and a hash of a few
+sampled blocks). A stage whose key is known is restored instead of run: its
+outputs are copied from a content-addressed store, also into other output
+folders. Store and output folders never share a file, so a tool rewriting an
+output in place can't change what is stored. A target left by a stage with
+another key, e.g. after changing MINLEN, is stale and made again.
+
+Outputs of a stage are the files it creates or changes at its target, at the
+paths its command names, or below them (e.g. an index next to a BAM, or the
+files of an output folder), within the output folder; they are no inputs of
+the stage. Stages with a target outside the output folder, like an index
+built next to the genome, are run as they are. The store is kept under a
+maximum size by evicting the least recently used stages.
+"""
+
+import fcntl
+import hashlib
+import json
+import os
+import re
+import shutil
+try:
+	from shutil import which
+except ImportError:
+	from distutils.spawn import find_executable as which
+
+
+# Block size and number of blocks sampled to fingerprint a file.
+SAMPLE_BLOCK = 65536
+SAMPLE_BLOCKS = 4
+# Record of the key and outputs of each target of an output folder.
+KEYS_FILE = "stage_keys.tsv"
+
+
+def fingerprint(path):
+	"""
+	:return str: size, modification time and sampled hash of a file
+	"""
+	stat = os.stat(path)
+	digest = hashlib.sha1()
+	with open(path, "rb") as handle:
+		if stat.st_size <= SAMPLE_BLOCK * SAMPLE_BLOCKS:
+			digest.update(handle.read())
+		else:
+			step = (stat.st_size - SAMPLE_BLOCK) // (SAMPLE_BLOCKS - 1)
+			for i in range(SAMPLE_BLOCKS):
+				handle.seek(i * step)
+				digest.update(handle.read(SAMPLE_BLOCK))
+	return "{}:{}:{}".format(stat.st_size, int(stat.st_mtime), digest.hexdigest())
+
+
+def content_hash(path):
+	"""
+	:return str: hash of the whole content of a file
+	"""
+	digest = hashlib.sha1()
+	with open(path, "rb") as handle:
+		for block in iter(lambda: handle.read(1 << 20), b""):
+			digest.update(block)
+	return digest.hexdigest()
+
+
+def command_paths(cmd):
+	"""
+	:return list: absolute paths named in a command, as words or option values
+	"""
+	paths = []
+	for word in re.split(r"[\s;|&()<>'\"]+", cmd):
+		word = word.split("=", 1)[-1]
+		if word.startswith("/") and word not in paths:
+			paths.append(word.rstrip("/") or word)
+	return paths
+
+
+def command_tools(cmd):
+	"""
+	:return list: executables of the commands of a shell command line
+	"""
+	tools = []
+	for part in re.split(r"\|\|?|&&|;|\(|\n", cmd):
+		words = part.split()
+		if words and words[0] not in tools:
+			tools.append(words[0])
+	return tools
+
+
+def _copy(source, destination):
+	"""
+	Copy a file into a new file of its own, keeping its modification time,
+	so that the fingerprints of restored files match those of the originals.
+	"""
+	tmp = "{}.tmp{}".format(destination, os.getpid())
+	shutil.copy2(source, tmp)
+	os.rename(tmp, destination)
+
+
+class StageCache(object):
+	"""
+	Content-addressed store of stage outputs.
+
+	:param str folder: cache folder, shared by pipelines and samples
+	:param float max_size: maximum size of the stored outputs, in GB
+	"""
+
+	def __init__(self, folder, max_size=100):
+		self.folder = folder
+		self.max_bytes = int(max_size * 1024 ** 3)
+		for sub in ("objects", "stages"):
+			path = os.path.join(folder, sub)
+			if not os.path.exists(path):
+				try:
+					os.makedirs(path)
+				except OSError:
+					pass
+
+	def install(self, pm):
+		"""
+		Send the stages of a pipeline through the cache, by wrapping pm.run.
+		The cache is also left as pm.stage_cache, for stages run outside of
+		pm.run (see stage_graph).
+
+		:param pypiper.PipelineManager pm: manager of the running pipeline
+		"""
+		run = pm.run
+
+		def cached_run(cmd, target=None, *args, **kwargs):
+			return self.run(pm, run, cmd, target, *args, **kwargs)
+
+		pm.run = cached_run
+		pm.stage_cache = self
+
+	def key(self, cmd, outfolder, outputs=()):
+		"""
+		:param list outputs: outputs of the stage, which are no inputs
+		:return str: key of a stage: command, tools and input fingerprints
+		"""
+		outfolder = os.path.abspath(outfolder).rstrip("/") + "/"
+		digest = hashlib.sha1()
+		digest.update(cmd.replace(outfolder, "{outfolder}/").encode())
+		for tool in command_tools(cmd):
+			path = which(tool) if "/" not in tool else tool
+			if path and os.path.isfile(path):
+				digest.update(("\ntool " + tool + " " + fingerprint(os.path.realpath(path))).encode())
+		for path in command_paths(cmd):
+			if os.path.isfile(path) and path not in outputs:
+				name = path.replace(outfolder, "{outfolder}/")
+				digest.update(("\ninput " + name + " " + fingerprint(path)).encode())
+		return digest.hexdigest()
+
+	def cached(self, pm, cmd, target):
+		"""
+		:return bool: whether a stage goes through the cache: a single
+			command with a target in the output folder
+		"""
+		return isinstance(cmd, str) and isinstance(target, str) and \
+			os.path.abspath(target).startswith(os.path.abspath(pm.outfolder).rstrip("/") + "/")
+
+	def start(self, pm, cmd, target, outputs=()):
+		"""
+		Key of a stage about to run. A target left by the stage with another
+		key is stale, and removed with the outputs recorded with it.
+
+		:param list outputs: outputs of the stage besides the target, if known
+		:return str: key of the stage
+		"""
+		target = os.path.abspath(target)
+		recorded, recorded_outputs = self._recorded(pm.outfolder).get(target, (None, []))
+		key = self.key(cmd, pm.outfolder, [target] + list(outputs) + recorded_outputs)
+		if os.path.exists(target) and recorded is not None and recorded != key:
+			print("Stale target (stage changed): " + target)
+			for path in [target] + recorded_outputs:
+				if os.path.lexists(path):
+					os.remove(path)
+		return key
+
+	def restore(self, pm, key, target):
+		"""
+		Restore the outputs of a stage from the store, if its key is known.
+
+		:return bool: whether the target was restored
+		"""
+		target = os.path.abspath(target)
+		manifest = os.path.join(self.folder, "stages", key + ".json")
+		if not os.path.exists(manifest):
+			return False
+		try:
+			with open(manifest) as handle:
+				outputs = json.load(handle)["outputs"]
+			for name, obj in outputs.items():
+				path = os.path.join(pm.outfolder, name)
+				if not os.path.exists(os.path.dirname(path)):
+					os.makedirs(os.path.dirname(path))
+				_copy(self._object(obj), path)
+			os.utime(manifest, None)
+		except (IOError, OSError, ValueError):
+			return False  # evicted meanwhile
+		if not os.path.exists(target):
+			return False
+		print("Restored from the stage cache (" + key + "): " + target)
+		self._record(pm.outfolder, target, key, [os.path.join(pm.outfolder, name) for name in outputs])
+		return True
+
+	def finish(self, pm, key, target, outputs):
+		"""
+		Store the outputs of a stage that ran.
+
+		:param list outputs: files the stage made, or folders of them
+		"""
+		target = os.path.abspath(target)
+		files = set()
+		for path in [target] + list(outputs):
+			path = os.path.abspath(path)
+			if os.path.isdir(path):
+				for root, _, names in os.walk(path):
+					files.update(os.path.join(root, name) for name in names)
+			else:
+				files.add(path)
+		files = sorted(path for path in files if os.path.isfile(path) and not os.path.islink(path))
+		self._store(key, pm.outfolder, files)
+		self._record(pm.outfolder, target, key, files)
+
+	def run(self, pm, run, cmd, target, *args, **kwargs):
+		"""
+		pm.run through the cache: restore the stage if its key is known,
+		otherwise run it and store its outputs, the files at the paths its
+		command names that changed while it ran.
+		"""
+		if not self.cached(pm, cmd, target):
+			return run(cmd, target, *args, **kwargs)
+		target = os.path.abspath(target)
+		key = self.start(pm, cmd, target)
+		if os.path.exists(target):
+			return run(cmd, target, *args, **kwargs)
+		if self.restore(pm, key, target):
+			follow = kwargs.get("follow")
+			if follow is not None:
+				follow()
+			return 0
+
+		before = self._scan(cmd, target, pm.outfolder)
+		result = run(cmd, target, *args, **kwargs)
+		if os.path.exists(target):
+			after = self._scan(cmd, target, pm.outfolder)
+			self.finish(pm, key, target, [path for path, stat in after.items() if before.get(path) != stat])
+		return result
+
+	def _object(self, obj):
+		return os.path.join(self.folder, "objects", obj[:2], obj[2:])
+
+	def _scan(self, cmd, target, outfolder):
+		"""
+		:return dict: inode, size and modification time of the files below
+			the output folder at the target or at (or below) a path the
+			command names, the candidate outputs of the stage
+		"""
+		outfolder = os.path.abspath(outfolder).rstrip("/") + "/"
+		prefixes = [target] + [p for p in command_paths(cmd) if p.startswith(outfolder)]
+		folders = set(os.path.dirname(p) for p in prefixes) | set(p for p in prefixes if os.path.isdir(p))
+		files = {}
+		for folder in folders:
+			for root, dirs, names in os.walk(folder):
+				for name in names:
+					path = os.path.join(root, name)
+					if any(path.startswith(p) for p in prefixes) and os.path.isfile(path) and not os.path.islink(path):
+						stat = os.stat(path)
+						files[path] = (stat.st_ino, stat.st_size, stat.st_mtime)
+				if root not in prefixes and not any(root.startswith(p + "/") for p in prefixes):
+					# only look below folders the command names
+					del dirs[:]
+		return files
+
+	def _store(self, key, outfolder, outputs):
+		outfolder = os.path.abspath(outfolder).rstrip("/") + "/"
+		stored = {}
+		with open(os.path.join(self.folder, "lock"), "w") as lock:
+			fcntl.flock(lock, fcntl.LOCK_EX)
+			for path in outputs:
+				if not path.startswith(outfolder):
+					continue
+				obj = content_hash(path)
+				if not os.path.exists(self._object(obj)):
+					if not os.path.exists(os.path.dirname(self._object(obj))):
+						os.makedirs(os.path.dirname(self._object(obj)))
+					_copy(path, self._object(obj))
+				stored[path[len(outfolder):]] = obj
+			manifest = os.path.join(self.folder, "stages", key + ".json")
+			tmp = "{}.tmp{}".format(manifest, os.getpid())
+			with open(tmp, "w") as out:
+				json.dump({"outputs": stored}, out)
+			os.rename(tmp, manifest)
+			self._evict(keep=manifest)
+			fcntl.flock(lock, fcntl.LOCK_UN)
+
+	def _evict(self, keep):
+		"""
+		Remove the least recently used stages, and the objects only they
+		refer to, until the store fits in its maximum size.
+		"""
+		stages = os.path.join(self.folder, "stages")
+		manifests = []
+		for name in os.listdir(stages):
+			if name.endswith(".json"):
+				path = os.path.join(stages, name)
+				with open(path) as handle:
+					objects = set(json.load(handle)["outputs"].values())
+				manifests.append((os.stat(path).st_mtime, path, objects))
+		manifests.sort()
+		sizes = {}
+		for _, _, objects in manifests:
+			for obj in objects:
+				if obj not in sizes and os.path.exists(self._object(obj)):
+					sizes[obj] = os.stat(self._object(obj)).st_size
+		total = sum(sizes.values())
+		refs = {}
+		for _, _, objects in manifests:
+			for obj in objects:
+				refs[obj] = refs.get(obj, 0) + 1
+		for _, path, objects in manifests:
+			if total <= self.max_bytes:
+				break
+			if path == keep:
+				continue
+			os.remove(path)
+			for obj in objects:
+				refs[obj] -= 1
+				if not refs[obj] and obj in sizes:
+					os.remove(self._object(obj))
+					total -= sizes[obj]
+
+	def _recorded(self, outfolder):
+		"""
+		:return dict: key and outputs of each target of an output folder
+		"""
+		keys = {}
+		path = os.path.join(outfolder, KEYS_FILE)
+		if os.path.exists(path):
+			with open(path) as handle:
+				for line in handle:
+					fields = line.rstrip("\n").split("\t")
+					keys[fields[0]] = (fields[1], fields[2:])
+		return keys
+
+	def _record(self, outfolder, target, key, outputs):
+		with open(os.path.join(outfolder, KEYS_FILE), "a") as out:
+			out.write("\t".join([target, key] + [o for o in outputs if o != target]) + "\n")
@@ -0,0 +1,245 @@
+"""
+Concurrent stages of a pipeline, within the cores and memory of its job.
+
+pm.run runs one command at a time, and a command that uses a single core
+still holds all of them. A StageGraph takes stages declared with the files
+they read and write and the cores and memory they need, and runs each one as
+soon as the stages making its inputs are done and it fits in what the running
+stages leave free.
+
+pm.run is not thread-safe, so the graph doesn't use it: each command runs as
+a subprocess of its own, waited for by a thread of the graph, which does
+nothing else. All that touches the pipeline manager happens in the thread
+that calls run(), as pm.run would do it: the stage's timestamp, skipping it
+when its target exists, the lock file (named as pm.run names it, so that
+recover works), follow functions, the stage cache (pm.stage_cache, with the
+outputs the stage declares) and failing the pipeline. Only the profiler
+(pm.stage_profiler) is called from the threads, and it has a lock of its own.
+"""
+
+import os
+import re
+import shlex
+import signal
+import subprocess
+import sys
+import threading
+
+import preprocessing
+
+
+def megabytes(mem):
+	"""
+	:param str mem: memory as pypiper takes it, e.g. 4000 (MB) or 8G
+	:return float: memory in MB, 0 if it can't be read
+	"""
+	match = re.match(r"^\s*([\d.]+)\s*([kmgt]?)b?\s*$", str(mem), re.IGNORECASE)
+	if not match:
+		return 0
+	scale = {"k": 1.0 / 1024, "": 1, "m": 1, "g": 1024, "t": 1024 ** 2}
+	return float(match.group(1)) * scale[match.group(2).lower()]
+
+
+def java_mem(cmd, mem):
+	"""
+	Give a java command (e.g. from NGSTk, which sets its heap to the job's
+	memory) the memory of its stage instead.
+
+	:param str cmd: java command with -Xmx
+	:param float mem: memory of the stage, in MB; 0 leaves the command as is
+	:return str: the command, its heap at 90% of the stage's memory, the rest
+		left to the JVM itself
+	"""
+	if not mem:
+		return cmd
+	return re.sub(r"-Xmx\S+", "-Xmx{}m".format(int(mem * 0.9)), cmd)
+
+
+class StageGraph(object):
+	"""
+	Stages run as their inputs become ready, within a core and memory budget.
+
+	:param pypiper.PipelineManager pm: manager of the running pipeline
+	:param int cores: cores of the stages together, default pm.cores
+	:param str mem: memory of the stages together, default pm.mem
+	"""
+
+	def __init__(self, pm, cores=None, mem=None):
+		self.pm = pm
+		self.cores = int(cores or pm.cores)
+		self.mem = megabytes(pm.mem if mem is None else mem)
+		self.stages = []
+
+	def add(self, name, cmd, target, inputs=(), outputs=(), cores=1, mem=0, shell=True, follow=None, nofail=False):
+		"""
+		Declare a stage; stages run by run().
+
+		:param str name: name of the stage, for messages
+		:param str cmd: command, as for pm.run
+		:param str target: target, as for pm.run
+		:param list inputs: files the stage reads; a stage waits for the
+			stages that make its inputs
+		:param list outputs: files, or folders of files, the stage makes
+			besides its target; they are what the stage cache stores
+		:param int cores: cores the command uses
+		:param int mem: memory the command needs, in MB; stages that
+			don't declare it are not held to the memory budget
+		:param bool shell: run the command in a shell
+		:param callable follow: called once the command has run, as with pm.run
+		:param bool nofail: a failure of the command doesn't fail the pipeline
+		"""
+		self.stages.append({"name": name, "cmd": cmd, "target": target, "inputs": list(inputs),
+			"outputs": [target] + list(outputs), "cores": cores, "mem": mem,
+			"shell": shell, "follow": follow, "nofail": nofail})
+
+	def run(self):
+		"""
+		Run the declared stages and wait for them. When a stage fails, no
+		further stage is started, and the pipeline fails once the running
+		ones are done. If the pipeline is stopped meanwhile, the commands
+		still running are killed and their lock files left to recover.
+		"""
+		producers = {}
+		for i, stage in enumerate(self.stages):
+			for path in stage["outputs"]:
+				producers[path] = i
+		needs = [set(producers[path] for path in stage["inputs"] if producers.get(path, i) != i)
+			for i, stage in enumerate(self.stages)]
+
+		pending = list(range(len(self.stages)))
+		running, done, finished, errors = {}, set(), [], []
+		condition = threading.Condition()
+		try:
+			with condition:
+				while pending or running:
+					for i in list(pending):
+						stage = self.stages[i]
+						if errors or not needs[i] <= done:
+							continue
+						used_cores = sum(self.stages[j]["cores"] for j in running)
+						used_mem = sum(self.stages[j]["mem"] for j in running)
+						fits = used_cores + stage["cores"] <= self.cores and (
+							not self.mem or used_mem + stage["mem"] <= self.mem)
+						if running and not fits:
+							continue
+						# the first stage runs whatever it needs
+						pending.remove(i)
+						started = self._start(stage, i, condition, finished)
+						if started is None:
+							done.add(i)
+						else:
+							running[i] = started
+					if not running:
+						if pending and not errors:
+							raise Exception("Stages wait on each other: " +
+								", ".join(self.stages[i]["name"] for i in pending))
+						break
+					while not finished:
+						# with a timeout, to stay responsive to signals
+						condition.wait(1)
+					for i, returncode in finished:
+						if self._finish(self.stages[i], running.pop(i), returncode, errors):
+							done.add(i)
+					del finished[:]
+		except BaseException:
+			self._stop(running)
+			raise
+		finally:
+			self.stages = []
+		if errors:
+			self.pm.fail_pipeline(errors[0])
+			raise errors[0]
+
+	def _start(self, stage, i, condition, finished):
+		"""
+		Start the command of a stage, unless its target exists or is restored
+		from the stage cache.
+
+		:return dict: the running stage: lock and recover file, cache key
+			and process, which the thread fills in; None if the stage is done
+		"""
+		self.pm.timestamp("### " + stage["name"] + ": ")
+		cmd, target = stage["cmd"], stage["target"]
+		cache = getattr(self.pm, "stage_cache", None)
+		key = None
+		if cache is not None and cache.cached(self.pm, cmd, target):
+			key = cache.start(self.pm, cmd, target, stage["outputs"][1:])
+			if not os.path.exists(target) and cache.restore(self.pm, key, target):
+				if stage["follow"] is not None:
+					stage["follow"]()
+				return None
+		lock_file, recover_file = preprocessing.lock_files(self.pm, target)
+		if not preprocessing.wait_for_lock(self.pm, lock_file, recover_file) and os.path.exists(target):
+			print("Target exists: `" + target + "`")
+			if getattr(self.pm, "force_follow", False) and stage["follow"] is not None:
+				stage["follow"]()
+			return None
+		open(lock_file, "w").close()
+		if os.path.exists(recover_file):
+			os.remove(recover_file)
+		print("\n> `" + cmd + "`\n")
+		sys.stdout.flush()
+
+		started = {"lock": lock_file, "recover": recover_file, "key": key, "proc": None}
+		profiler = getattr(self.pm, "stage_profiler", None)
+
+		def execute(cmd, target):
+			proc = subprocess.Popen(cmd if stage["shell"] else shlex.split(cmd), shell=stage["shell"],
+				preexec_fn=os.setsid)
+			started["proc"] = proc
+			return proc.wait()
+
+		def work():
+			try:
+				returncode = profiler.run(execute, cmd, target) if profiler is not None else execute(cmd, target)
+			except Exception as e:
+				returncode = e
+			with condition:
+				finished.append((i, returncode))
+				condition.notify()
+
+		thread = threading.Thread(target=work)
+		thread.stage_name = stage["name"]
+		thread.daemon = True
+		thread.start()
+		return started
+
+	def _finish(self, stage, started, returncode, errors):
+		"""
+		Wrap up a stage whose command has ended: release its lock, store its
+		outputs in the stage cache and call its follow function, or note its
+		failure.
+
+		:return bool: whether the stages that need it can run
+		"""
+		if returncode == 0:
+			os.remove(started["lock"])
+			cache = getattr(self.pm, "stage_cache", None)
+			if started["key"] is not None and os.path.exists(stage["target"]):
+				cache.finish(self.pm, started["key"], stage["target"], stage["outputs"][1:])
+			if stage["follow"] is not None:
+				stage["follow"]()
+			return True
+		message = "{} failed: {}".format(stage["name"], returncode if isinstance(returncode, Exception)
+			else "`{}` returned {}".format(stage["cmd"], returncode))
+		if stage["nofail"]:
+			os.remove(started["lock"])
+			self.pm.timestamp(message + " (nofail)")
+			return True
+		# left to be redone by the next run, as pm.run leaves a failed target
+		open(started["recover"], "w").close()
+		errors.append(Exception(message))
+		return False
+
+	def _stop(self, running):
+		"""
+		Kill the commands of the running stages, leaving their locks with a
+		recover file.
+		"""
+		for started in running.values():
+			if started["proc"] is not None and started["proc"].poll() is None:
+				try:
+					os.killpg(started["proc"].pid, signal.SIGTERM)
+				except OSError:
+					pass  # exited meanwhile
+			open(started["recover"], "w").close()
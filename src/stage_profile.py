@@ -0,0 +1,261 @@
+"""
+Resource profile of the stages of a pipeline.
+
+pm.timestamp only tells when a stage started. A StageProfiler samples the
+processes each pm.run stage starts, with their descendants, from /proc while
+the stage runs: wall and CPU time, peak resident memory of the processes
+together, bytes read and written, and the most threads they ran at once.
+Stages run side by side (see stage_graph) each get the processes whose
+command line matches theirs. A stage that ran alone gets the exact CPU time
+and IO of its processes once they are waited for, which sampling may miss.
+
+Profiles go to stage_profile.json and stage_profile.tsv in the output folder,
+next to the stats file, one row per target; stages skipped because their
+target exists keep the row of the run that made it. tools/profile_rollup.py
+sums the profiles of a project up per stage.
+"""
+
+import json
+import os
+import resource
+import threading
+import time
+
+
+PROFILE_JSON = "stage_profile.json"
+PROFILE_TSV = "stage_profile.tsv"
+COLUMNS = ["stage", "target", "start", "wall_s", "cpu_s", "cores", "peak_rss_mb",
+	"threads", "read_mb", "write_mb", "concurrent", "command"]
+MB = 1024.0 ** 2
+
+
+def _process_stat(pid):
+	"""
+	:return tuple: parent pid, CPU seconds, resident bytes, threads and
+		start time of a process
+	"""
+	with open("/proc/{}/stat".format(pid)) as handle:
+		# the command name may contain spaces, but ends with the last ")"
+		fields = handle.read().rsplit(")", 1)[1].split()
+	ticks = int(fields[11]) + int(fields[12])
+	return (int(fields[1]), float(ticks) / os.sysconf("SC_CLK_TCK"),
+		int(fields[21]) * os.sysconf("SC_PAGE_SIZE"), int(fields[17]), int(fields[19]))
+
+
+def _process_io(pid):
+	"""
+	:return tuple: bytes read and written by a process and by its waited for
+		descendants, 0 where not readable
+	"""
+	io = {}
+	try:
+		with open("/proc/{}/io".format(pid)) as handle:
+			for line in handle:
+				name, value = line.split(":")
+				io[name] = int(value)
+	except (IOError, OSError, ValueError):
+		pass
+	return io.get("read_bytes", 0), io.get("write_bytes", 0)
+
+
+def _process_words(pid):
+	"""
+	:return set: words of the command line of a process
+	"""
+	try:
+		with open("/proc/{}/cmdline".format(pid)) as handle:
+			return set(" ".join(handle.read().split("\0")).split())
+	except (IOError, OSError):
+		return set()
+
+
+def _processes():
+	"""
+	:return dict: parent pid, CPU seconds, resident bytes, threads and start
+		time of the running processes
+	"""
+	processes = {}
+	if not os.path.isdir("/proc"):
+		return processes
+	for name in os.listdir("/proc"):
+		if name.isdigit():
+			try:
+				processes[int(name)] = _process_stat(name)
+			except (IOError, OSError, IndexError, ValueError):
+				pass  # exited meanwhile
+	return processes
+
+
+class StageProfiler(object):
+	"""
+	Sampled resource use of the pm.run stages of a pipeline.
+
+	:param str outfolder: folder of the profile files, the pipeline's
+		output folder
+	:param float interval: seconds between samples
+	"""
+
+	def __init__(self, outfolder, interval=1):
+		self.outfolder = outfolder
+		self.interval = interval
+		self.pipeline = ""
+		self._lock = threading.Lock()
+		self._active = []
+		# direct children that are no stage's, e.g. background FastQC
+		self._ignored = set()
+		self._sampler = None
+		self._delay = interval
+		self._label = ""
+
+	def install(self, pm):
+		"""
+		Profile the stages of a pipeline, by wrapping pm.run; pm.timestamp
+		is wrapped too, for the names of the stages. The profiler is also
+		left as pm.stage_profiler, for stages run outside of pm.run (see
+		stage_graph).
+
+		:param pypiper.PipelineManager pm: manager of the running pipeline
+		"""
+		self.pipeline = getattr(pm, "name", "")
+		run, timestamp = pm.run, pm.timestamp
+
+		def profiled_run(cmd, target=None, *args, **kwargs):
+			return self.run(run, cmd, target, *args, **kwargs)
+
+		def labelled_timestamp(message="", *args, **kwargs):
+			label = str(message).strip().lstrip("#").strip().rstrip(":").strip()
+			if label:
+				self._label = label
+			return timestamp(message, *args, **kwargs)
+
+		pm.run = profiled_run
+		pm.timestamp = labelled_timestamp
+		pm.stage_profiler = self
+
+	def run(self, run, cmd, target, *args, **kwargs):
+		"""
+		pm.run, or any function running a stage's command, with the
+		processes of the stage sampled while it runs.
+		"""
+		# stage_graph names its threads after their stages
+		stage = {"stage": getattr(threading.current_thread(), "stage_name", None) or self._label,
+			"target": target, "command": cmd if isinstance(cmd, str) else " ; ".join(cmd),
+			"existed": target is not None and os.path.exists(target),
+			"roots": set(), "seen": {}, "cpu": 0.0, "rss": 0, "threads": 0, "read": 0, "write": 0, "concurrent": False}
+		stage["words"] = set(stage["command"].split())
+		with self._lock:
+			if self._active:
+				self._sample()
+				stage["concurrent"] = True
+				for other in self._active:
+					other["concurrent"] = True
+			else:
+				# started between stages, or by the pipeline itself
+				self._ignored = set(pid for pid, stat in _processes().items() if stat[0] == os.getpid())
+			self._active.append(stage)
+			self._delay = min(self.interval, 0.1)
+			if self._sampler is None:
+				self._sampler = threading.Thread(target=self._sample_loop)
+				self._sampler.daemon = True
+				self._sampler.start()
+		usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+		io = _process_io(os.getpid())
+		start = time.time()
+		try:
+			return run(cmd, target, *args, **kwargs)
+		finally:
+			wall = time.time() - start
+			with self._lock:
+				self._active.remove(stage)
+				if not stage["concurrent"]:
+					# everything the stage started has been waited for by now
+					after = resource.getrusage(resource.RUSAGE_CHILDREN)
+					stage["cpu"] = max(stage["cpu"], after.ru_utime + after.ru_stime - usage.ru_utime - usage.ru_stime)
+					io_after = _process_io(os.getpid())
+					stage["read"] = max(stage["read"], io_after[0] - io[0])
+					stage["write"] = max(stage["write"], io_after[1] - io[1])
+				if stage["roots"] or not stage["existed"]:
+					self._save(stage, start, wall)
+
+	def _sample_loop(self):
+		while True:
+			# soon after a stage starts, then every interval
+			time.sleep(self._delay)
+			self._delay = min(self.interval, self._delay * 2)
+			with self._lock:
+				if not self._active:
+					self._sampler = None
+					return
+				self._sample()
+
+	def _sample(self):
+		"""
+		Assign new child processes to the active stages, and update the use
+		of the process trees of the stages. Called with the lock held.
+		"""
+		if not self._active:
+			return
+		processes = _processes()
+		children = {}
+		for pid, stat in processes.items():
+			children.setdefault(stat[0], []).append(pid)
+		claimed = set().union(*[stage["roots"] for stage in self._active])
+		for pid in children.get(os.getpid(), []):
+			if pid in claimed or pid in self._ignored:
+				continue
+			words = _process_words(pid)
+			# the stage whose command shares most words with the process
+			stage = max(self._active, key=lambda s: len(words & s["words"]))
+			stage["roots"].add(pid)
+
+		for stage in self._active:
+			rss, threads, read, write = 0, 0, 0, 0
+			tree = [pid for pid in stage["roots"] if pid in processes]
+			while tree:
+				pid = tree.pop()
+				# CPU time of each process as last seen, also once it exited
+				stage["seen"][(pid, processes[pid][4])] = processes[pid][1]
+				rss += processes[pid][2]
+				threads += processes[pid][3]
+				pid_read, pid_write = _process_io(pid)
+				read += pid_read
+				write += pid_write
+				tree.extend(children.get(pid, []))
+			stage["cpu"] = sum(stage["seen"].values())
+			stage["rss"] = max(stage["rss"], rss)
+			stage["threads"] = max(stage["threads"], threads)
+			stage["read"] = max(stage["read"], read)
+			stage["write"] = max(stage["write"], write)
+
+	def _save(self, stage, start, wall):
+		"""
+		Add the profile of a stage to the profile files, replacing an
+		earlier one of its target. Called with the lock held.
+		"""
+		profile = {"pipeline": self.pipeline, "stages": []}
+		path = os.path.join(self.outfolder, PROFILE_JSON)
+		if os.path.exists(path):
+			with open(path) as handle:
+				profile = json.load(handle)
+		row = {"stage": stage["stage"], "target": stage["target"],
+			"start": time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(start)),
+			"wall_s": round(wall, 1), "cpu_s": round(stage["cpu"], 1),
+			"cores": round(stage["cpu"] / wall, 2) if wall else 0,
+			"peak_rss_mb": round(stage["rss"] / MB, 1), "threads": stage["threads"],
+			"read_mb": round(stage["read"] / MB, 1), "write_mb": round(stage["write"] / MB, 1),
+			"concurrent": stage["concurrent"], "command": stage["command"]}
+		profile["stages"] = [old for old in profile["stages"]
+			if stage["target"] is None or old["target"] != stage["target"]] + [row]
+
+		tmp = "{}.tmp{}".format(path, os.getpid())
+		with open(tmp, "w") as out:
+			json.dump(profile, out, indent=1)
+		os.rename(tmp, path)
+		path = os.path.join(self.outfolder, PROFILE_TSV)
+		tmp = "{}.tmp{}".format(path, os.getpid())
+		with open(tmp, "w") as out:
+			out.write("\t".join(COLUMNS) + "\n")
+			for row in profile["stages"]:
+				out.write("\t".join(str(row[column]).replace("\t", " ").replace("\n", " ")
+					for column in COLUMNS) + "\n")
+		os.rename(tmp, path)
@@ -0,0 +1,262 @@
+#!/usr/bin/env python
+"""
+Project-level matrix of kallisto abundances, built incrementally.
+
+Each sample's abundance.h5 is read once and its estimated counts and TPM
+are written as one column of a targets-by-samples matrix kept in a folder:
+the columns of every 256 samples share one .npy file per quantity, which is
+memory-mapped, so appending a sample writes only its own column and reading
+one sample or a block of targets never loads the whole matrix. Samples are
+added as they finish; those already in the matrix are skipped.
+
+With a transcript-to-gene table (-g, two columns as used by bustools), the
+matrix is also summed up per gene, chunk by chunk, as samples are added.
+
+Writing is locked, so several pipelines can append to the same matrix.
+--tsv writes a quantity out as a targets-by-samples table.
+
+Usage: abundance_matrix.py -m <matrix folder> [-g t2g.tsv] <sample/kallisto/abundance.h5> ...
+       abundance_matrix.py -m <matrix folder> --tsv <out.tsv> [-q tpm|est_counts] [--genes]
+"""
+
+import fcntl
+import json
+import os
+import sys
+from argparse import ArgumentParser
+
+import numpy as np
+
+import kallisto_h5
+
+
+CHUNK_SAMPLES = 256
+QUANTITIES = ("est_counts", "tpm")
+DTYPE = np.float32
+
+
+def sample_name(h5):
+	"""
+	Sample of an abundance.h5 file: the folder above the kallisto folder of
+	the pipeline, or else the folder of the file.
+	"""
+	folder = os.path.dirname(os.path.abspath(h5))
+	if os.path.basename(folder) == "kallisto":
+		folder = os.path.dirname(folder)
+	return os.path.basename(folder)
+
+
+def read_t2g(path):
+	"""
+	:return dict: gene of each transcript
+	"""
+	t2g = {}
+	with open(path) as handle:
+		for line in handle:
+			fields = line.split()
+			if len(fields) >= 2:
+				t2g[fields[0]] = fields[1]
+	return t2g
+
+
+def _read_lines(path):
+	with open(path) as handle:
+		return [line.rstrip("\n") for line in handle]
+
+
+def _write_lines(path, lines):
+	tmp = "{}.tmp{}".format(path, os.getpid())
+	with open(tmp, "w") as out:
+		out.writelines(line + "\n" for line in lines)
+	os.rename(tmp, path)
+
+
+class AbundanceMatrix(object):
+	"""
+	Read access to a matrix folder.
+	"""
+
+	def __init__(self, path):
+		self.path = path
+		with open(os.path.join(path, "meta.json")) as handle:
+			meta = json.load(handle)
+		self.chunk_samples = meta["chunk_samples"]
+		self.samples = meta["samples"]
+		self.transcripts = _read_lines(os.path.join(path, "transcripts.txt"))
+		genes = os.path.join(path, "genes.txt")
+		self.genes = _read_lines(genes) if os.path.exists(genes) else None
+
+	def __len__(self):
+		return len(self.samples)
+
+	def chunk_file(self, quantity, chunk, genes=False):
+		return os.path.join(self.path, "{}.{}.{:05d}.npy".format(
+			"gene" if genes else "transcript", quantity, chunk))
+
+	def chunk(self, quantity, chunk, genes=False):
+		"""
+		:return numpy.memmap: one row per sample of a chunk
+		"""
+		n = min(len(self.samples) - chunk * self.chunk_samples, self.chunk_samples)
+		return np.load(self.chunk_file(quantity, chunk, genes), mmap_mode="r")[:n]
+
+	def n_chunks(self):
+		return (len(self.samples) + self.chunk_samples - 1) // self.chunk_samples
+
+	def column(self, sample, quantity="tpm", genes=False):
+		"""
+		:return numpy.ndarray: values of one sample
+		"""
+		i = self.samples.index(sample)
+		return np.array(self.chunk(quantity, i // self.chunk_samples, genes)[i % self.chunk_samples])
+
+	def rows(self, start, end, quantity="tpm", genes=False):
+		"""
+		:return numpy.ndarray: values of targets start to end, one row per
+			target and one column per sample
+		"""
+		return np.concatenate([self.chunk(quantity, k, genes)[:, start:end]
+			for k in range(self.n_chunks())], axis=0).T
+
+	def write_tsv(self, out, quantity="tpm", genes=False, block=10000):
+		"""
+		Write a targets-by-samples table, a block of targets at a time.
+		"""
+		names = self.genes if genes else self.transcripts
+		out.write("\t".join(["gene_id" if genes else "target_id"] + self.samples) + "\n")
+		for start in range(0, len(names), block):
+			values = self.rows(start, start + block, quantity, genes)
+			for name, row in zip(names[start:start + block], values):
+				out.write(name + "\t" + "\t".join("{:g}".format(v) for v in row) + "\n")
+
+
+def _gene_rollup(transcripts, t2g):
+	"""
+	:return (list, numpy.ndarray, numpy.ndarray): genes, transcripts ordered
+		by gene and the position of each gene's first transcript in that order
+	"""
+	genes = sorted(set(t2g[t] for t in transcripts if t in t2g))
+	gene_index = dict((g, i) for i, g in enumerate(genes))
+	of = np.array([gene_index.get(t2g.get(t), -1) for t in transcripts])
+	order = np.argsort(of, kind="mergesort")
+	order = order[of[order] >= 0]
+	starts = np.flatnonzero(np.concatenate([[True], np.diff(of[order]) != 0]))
+	return genes, order, starts
+
+
+def _open_chunk(matrix, quantity, chunk, n_columns, genes=False):
+	path = matrix.chunk_file(quantity, chunk, genes)
+	if os.path.exists(path):
+		return np.load(path, mmap_mode="r+")
+	return np.lib.format.open_memmap(path, mode="w+", dtype=DTYPE, shape=(matrix.chunk_samples, n_columns))
+
+
+def add_samples(path, samples, t2g=None):
+	"""
+	Add samples to a matrix folder, creating it if needed.
+
+	:param str path: matrix folder
+	:param list samples: (name, abundance.h5 file) of each sample
+	:param str t2g: transcript-to-gene table, to also sum the matrix up per gene
+	:return int: number of samples added
+	"""
+	if not os.path.exists(path):
+		os.makedirs(path)
+	with open(os.path.join(path, "lock"), "w") as lock:
+		fcntl.flock(lock, fcntl.LOCK_EX)
+		meta_file = os.path.join(path, "meta.json")
+		if not os.path.exists(meta_file):
+			with open(meta_file, "w") as out:
+				json.dump({"chunk_samples": CHUNK_SAMPLES, "samples": []}, out)
+		matrix = AbundanceMatrix(path) if os.path.exists(os.path.join(path, "transcripts.txt")) else None
+
+		known = set(matrix.samples) if matrix else set()
+		added, touched = [], set()
+		chunks = {}
+		for name, h5 in samples:
+			if name in known:
+				continue
+			abundance = kallisto_h5.read_abundance(h5, bootstraps=False)
+			ids = list(abundance["ids"])
+			if matrix is None:
+				_write_lines(os.path.join(path, "transcripts.txt"), ids)
+				matrix = AbundanceMatrix(path)
+			elif ids != matrix.transcripts:
+				raise Exception("Targets of {} differ from those of the matrix in {}".format(h5, path))
+			i = len(matrix.samples) + len(added)
+			chunk, row = divmod(i, matrix.chunk_samples)
+			if chunk not in chunks:
+				chunks[chunk] = dict((q, _open_chunk(matrix, q, chunk, len(ids))) for q in QUANTITIES)
+			chunks[chunk]["est_counts"][row] = abundance["est_counts"]
+			chunks[chunk]["tpm"][row] = kallisto_h5.tpm(abundance["est_counts"], abundance["eff_lengths"])
+			touched.add(chunk)
+			added.append(name)
+			known.add(name)
+		for arrays in chunks.values():
+			for array in arrays.values():
+				array.flush()
+		if matrix is None:
+			return 0
+		matrix.samples = matrix.samples + added
+
+		rollup = os.path.join(path, "genes.npz")
+		if t2g:
+			genes, order, starts = _gene_rollup(matrix.transcripts, read_t2g(t2g))
+			same = matrix.genes == genes
+			if same:
+				with np.load(rollup) as arrays:
+					same = np.array_equal(arrays["order"], order)
+			if not same:
+				# New or changed gene table: sum up every chunk again.
+				for chunk in range(matrix.n_chunks()):
+					for quantity in QUANTITIES:
+						if os.path.exists(matrix.chunk_file(quantity, chunk, genes=True)):
+							os.remove(matrix.chunk_file(quantity, chunk, genes=True))
+				np.savez(rollup[:-len(".npz")], order=order, starts=starts)
+				_write_lines(os.path.join(path, "genes.txt"), genes)
+				matrix.genes = genes
+				touched = set(range(matrix.n_chunks()))
+		elif matrix.genes is not None:
+			genes = matrix.genes
+			with np.load(rollup) as arrays:
+				order, starts = arrays["order"], arrays["starts"]
+		if matrix.genes is not None:
+			for chunk in sorted(touched):
+				for quantity in QUANTITIES:
+					values = matrix.chunk(quantity, chunk)
+					gene_values = _open_chunk(matrix, quantity, chunk, len(genes), genes=True)
+					gene_values[:len(values)] = np.add.reduceat(values[:, order], starts, axis=1)
+					gene_values.flush()
+
+		# Samples only count as added once their columns are written.
+		tmp = "{}.tmp{}".format(meta_file, os.getpid())
+		with open(tmp, "w") as out:
+			json.dump({"chunk_samples": matrix.chunk_samples, "samples": matrix.samples}, out)
+		os.rename(tmp, meta_file)
+		fcntl.flock(lock, fcntl.LOCK_UN)
+	return len(added)
+
+
+if __name__ == "__main__":
+	parser = ArgumentParser(description="Project-level matrix of kallisto abundances.")
+	parser.add_argument("-m", "--matrix", dest="matrix", required=True, help="Matrix folder.")
+	parser.add_argument("-g", "--t2g", dest="t2g", default=None,
+		help="Transcript-to-gene table, to also sum the matrix up per gene.")
+	parser.add_argument("--tsv", dest="tsv", default=None,
+		help="Write the matrix out as a table to this file (- for stdout) instead of adding samples.")
+	parser.add_argument("-q", "--quantity", dest="quantity", default="tpm", choices=QUANTITIES,
+		help="Quantity to write with --tsv.")
+	parser.add_argument("--genes", dest="genes", action="store_true", default=False,
+		help="Write the gene-level matrix with --tsv.")
+	parser.add_argument("h5", nargs="*", help="abundance.h5 files of the samples to add.")
+	args = parser.parse_args()
+	if args.tsv:
+		matrix = AbundanceMatrix(args.matrix)
+		if args.tsv == "-":
+			matrix.write_tsv(sys.stdout, args.quantity, args.genes)
+		else:
+			with open(args.tsv, "w") as out:
+				matrix.write_tsv(out, args.quantity, args.genes)
+	else:
+		n = add_samples(args.matrix, [(sample_name(h5), h5) for h5 in args.h5], args.t2g)
+		print("Added {} samples to {}".format(n, args.matrix))
@@ -0,0 +1,213 @@
+#!/usr/bin/env python
+"""
+Coverage track of a sorted, indexed BAM file, written directly as bigWig.
+
+Takes the place of RSeQC bam2wig.py followed by wigToBigWig: alignments are
+read once, per chromosome in parallel worker processes, and turned into runs
+of constant depth with numpy; no intermediate wig file is written. As with
+bam2wig, unmapped, secondary, QC-failed and duplicate alignments are ignored,
+only the aligned blocks of a read count (not deletions or spliced introns), and
+with -t the track is scaled so that it sums up to the given wigsum.
+
+Without -t and -q, the track holds the same per-base depth as samtools depth,
+stored as runs in an indexed binary file instead of a text line per base;
+bigwig.BigWig reads it back by region.
+
+Usage: bam_coverage.py -i <file_sorted.bam> -o <file.bw> [-s chrom.sizes] [-t wigsum] [-q mapq] [-p cores]
+"""
+
+import array
+import multiprocessing
+import os
+import re
+import subprocess
+import sys
+from argparse import ArgumentParser
+
+import numpy as np
+
+import bigwig
+
+
+CIGAR_RE = re.compile(b"(\\d+)([MIDNSHP=X])")
+# unmapped, secondary, QC fail, duplicate
+SKIP_FLAGS = "0x704"
+
+
+def read_chrom_sizes(path):
+	"""
+	:return list: (name, size) of each chromosome of a chrom.sizes file
+	"""
+	sizes = []
+	with open(path) as handle:
+		for line in handle:
+			fields = line.split()
+			if len(fields) >= 2:
+				sizes.append((fields[0], int(fields[1])))
+	return sizes
+
+
+def bam_chrom_sizes(samtools, bam):
+	"""
+	:return list: (name, size) of each reference sequence in the BAM header
+	"""
+	sizes = []
+	for line in subprocess.check_output([samtools, "view", "-H", bam]).decode().splitlines():
+		if line.startswith("@SQ"):
+			tags = dict(field.split(":", 1) for field in line.split("\t")[1:])
+			sizes.append((tags["SN"], int(tags["LN"])))
+	return sizes
+
+
+def mapped_contigs(samtools, bam):
+	"""
+	Contigs with mapped reads, from the BAM index.
+	"""
+	out = subprocess.check_output([samtools, "idxstats", bam]).decode()
+	return set(fields[0] for fields in (line.split("\t") for line in out.splitlines())
+		if len(fields) > 2 and int(fields[2]) > 0)
+
+
+def depth_runs(starts, ends, size):
+	"""
+	Runs of constant, non-zero depth covered by a set of intervals.
+
+	:return (numpy.ndarray, numpy.ndarray, numpy.ndarray): run starts, ends and depths
+	"""
+	if len(starts) == 0:
+		# e.g. a contig whose alignments are all filtered out
+		empty = np.zeros(0, np.int64)
+		return empty, empty, empty
+	pos = np.concatenate([starts, ends])
+	order = np.argsort(pos, kind="mergesort")
+	pos = pos[order]
+	depth = np.cumsum(np.concatenate([np.ones(len(starts), np.int64), -np.ones(len(ends), np.int64)])[order])
+	# The depth after all intervals starting or ending at a position.
+	last = np.concatenate([pos[1:] != pos[:-1], [True]])
+	pos, depth = pos[last], depth[last]
+
+	run_starts, run_ends, depth = np.minimum(pos[:-1], size), np.minimum(pos[1:], size), depth[:-1]
+	keep = (depth > 0) & (run_ends > run_starts)
+	run_starts, run_ends, depth = run_starts[keep], run_ends[keep], depth[keep]
+	if len(depth) == 0:
+		return run_starts, run_ends, depth
+	# Merge neighbours of equal depth, left where a read ends as another starts.
+	new = np.flatnonzero(np.concatenate([[True],
+		(depth[1:] != depth[:-1]) | (run_starts[1:] != run_ends[:-1])]))
+	run_ends = run_ends[np.concatenate([new[1:] - 1, [len(depth) - 1]])]
+	return run_starts[new], run_ends, depth[new]
+
+
+def contig_coverage(job):
+	"""
+	Depth runs of one chromosome, saved to a temporary .npz file.
+
+	:param tuple job: BAM file, chromosome, size, samtools, mapping quality
+		cutoff, temporary file
+	:return (str, int, int, int): chromosome, sum of depth over all bases,
+		number of runs, bases covered
+	"""
+	bam, chrom, size, samtools, mapq, tmp = job
+	starts, ends = array.array("l"), array.array("l")
+	cmd = [samtools, "view", "-F", SKIP_FLAGS, "-q", str(mapq), bam, chrom]
+	proc = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+	for line in proc.stdout:
+		fields = line.split(b"\t", 6)
+		pos = int(fields[3]) - 1
+		cigar = fields[5]
+		if cigar[:-1].isdigit() and cigar[-1:] == b"M":
+			starts.append(pos)
+			ends.append(pos + int(cigar[:-1]))
+			continue
+		for length, op in CIGAR_RE.findall(cigar):
+			length = int(length)
+			if op in b"M=X":
+				starts.append(pos)
+				ends.append(pos + length)
+				pos += length
+			elif op in b"DN":
+				pos += length
+	if proc.wait() != 0:
+		raise Exception("samtools view failed on " + bam + " " + chrom)
+
+	run_starts, run_ends, depth = depth_runs(
+		np.frombuffer(starts, dtype=np.int_), np.frombuffer(ends, dtype=np.int_), size)
+	np.savez(tmp, starts=run_starts, ends=run_ends, depth=depth)
+	lengths = run_ends - run_starts
+	return chrom, int((depth * lengths).sum()), len(depth), int(lengths.sum())
+
+
+def zoom_reductions(n_runs, covered, max_size, levels=10):
+	"""
+	Bases per zoom record of each zoom level: starting at ten times the mean
+	run length, four times coarser at each level, as wigToBigWig does.
+	"""
+	reduction = max(10 * covered // max(n_runs, 1), 10)
+	reductions = []
+	while len(reductions) < levels and reduction < max_size:
+		reductions.append(reduction)
+		reduction *= 4
+	return reductions
+
+
+def bam_coverage(bam, chrom_sizes, output, wigsum=None, mapq=0, cores=1, samtools="samtools"):
+	"""
+	Write the coverage track of a sorted, indexed BAM file as bigWig.
+
+	:param str bam: BAM file
+	:param list chrom_sizes: (name, size) of each chromosome
+	:param str output: bigWig file
+	:param int wigsum: scale the track to sum up to this; raw depth if not given
+	:param int mapq: ignore alignments of a lower mapping quality
+	:param int cores: number of worker processes
+	:param str samtools: path to samtools
+	"""
+	contigs = mapped_contigs(samtools, bam)
+	sizes = dict(chrom_sizes)
+	tmp = "{}.tmp{}_".format(output, os.getpid())
+	# Largest chromosomes first, so they don't end up last in a busy pool.
+	jobs = [(bam, chrom, size, samtools, mapq, tmp + str(i))
+		for i, (chrom, size) in enumerate(sorted(chrom_sizes, key=lambda c: -c[1])) if chrom in contigs]
+
+	if cores > 1 and len(jobs) > 1:
+		pool = multiprocessing.Pool(min(cores, len(jobs)))
+		results = pool.map(contig_coverage, jobs, chunksize=1)
+		pool.close()
+		pool.join()
+	else:
+		results = [contig_coverage(job) for job in jobs]
+
+	total = sum(r[1] for r in results)
+	scale = float(wigsum) / total if wigsum and total else 1.0
+	tmp_files = dict((job[1], job[5] + ".npz") for job in jobs)
+	writer = bigwig.BigWigWriter(output, chrom_sizes,
+		zoom_reductions(sum(r[2] for r in results), sum(r[3] for r in results), max(sizes.values())))
+	for chrom, _ in writer.chroms:
+		if chrom not in tmp_files:
+			continue
+		runs = np.load(tmp_files[chrom])
+		writer.add(chrom, runs["starts"], runs["ends"], runs["depth"] * scale)
+		runs.close()
+		os.remove(tmp_files[chrom])
+	writer.close()
+
+
+if __name__ == "__main__":
+	parser = ArgumentParser(description="BAM coverage to bigWig.")
+	parser.add_argument("-i", "--input", dest="bam", required=True, help="Sorted and indexed BAM file.")
+	parser.add_argument("-s", "--chrom-sizes", dest="chrom_sizes", default=None,
+		help="Chromosome sizes file; by default, the reference sequences of the BAM header.")
+	parser.add_argument("-o", "--output", dest="output", required=True, help="Output bigWig file.")
+	parser.add_argument("-t", "--wigsum", dest="wigsum", type=int, default=None,
+		help="Scale the track to sum up to this; no scaling by default.")
+	parser.add_argument("-q", "--mapq", dest="mapq", type=int, default=0,
+		help="Minimum mapping quality of an alignment; none by default, as bam2wig without -u.")
+	parser.add_argument("-p", "--cores", dest="cores", type=int, default=1, help="Number of worker processes.")
+	parser.add_argument("--samtools", dest="samtools", default="samtools", help="Path to samtools.")
+	args = parser.parse_args()
+	if args.chrom_sizes:
+		chrom_sizes = read_chrom_sizes(args.chrom_sizes)
+	else:
+		chrom_sizes = bam_chrom_sizes(args.samtools, args.bam)
+	bam_coverage(args.bam, chrom_sizes, args.output,
+		args.wigsum, args.mapq, args.cores, args.samtools)
@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+"""
+Single-pass alignment statistics of a BAM file.
+
+Reads the BAM once and computes what otherwise takes one samtools pass per
+NGSTk count_* call:
+- Aligned_reads: distinct mapped reads, per mate in paired-end mode
+  (as NGSTk.count_unique_mapped_reads);
+- Uniquely_mapped_reads / Multimapped_reads: aligned reads with one / more
+  than one alignment;
+- Secondary_alignments: records flagged secondary
+  (as NGSTk.count_multimapping_reads);
+- Duplicate_records, Properly_paired_records, Total_records, Mapped_records;
+- Contigs: mapped records per contig.
+
+Read names are kept as 64-bit hashes, so distinct reads are counted without
+sorting the names. The hashes are spilled, chunk by chunk, to bucket files
+next to the BAM by their top bits, and the buckets counted one at a time, so
+memory holds one chunk and one bucket (1/64 of the mapped records), not the
+hash of every record of e.g. a bowtie1 -a -m 100 BAM. Results are cached next
+to the BAM in <name>.bamstats.json and reused for as long as the BAM is not
+newer than the cache.
+
+Usage: bam_stats.py -i <file.bam> [-p]
+"""
+
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+from argparse import ArgumentParser
+from collections import Counter
+
+import numpy as np
+
+
+# Hashes are spilled to 2 ** BUCKET_BITS bucket files, by their top bits.
+BUCKET_BITS = 6
+
+
+def collect(bam, paired_end=False, samtools="samtools", chunk_size=1 << 20):
+	"""
+	Compute the statistics of a BAM file in a single pass.
+
+	:param str bam: path to the BAM file
+	:param bool paired_end: count mates of a pair as separate reads
+	:param str samtools: path to samtools
+	:return dict: statistics
+	"""
+	tmp = tempfile.mkdtemp(prefix=os.path.basename(bam) + ".stats", dir=os.path.dirname(os.path.abspath(bam)))
+	try:
+		stats = _collect(bam, paired_end, samtools, chunk_size, tmp)
+	finally:
+		shutil.rmtree(tmp)
+	return stats
+
+
+def _spill(chunk, buckets):
+	"""
+	Append the hashes of a chunk to the bucket files of their top bits.
+	"""
+	values = np.array(chunk, dtype=np.int64)
+	which = (values >> (64 - BUCKET_BITS)) & (len(buckets) - 1)
+	order = np.argsort(which, kind="mergesort")
+	values = values[order]
+	bounds = np.searchsorted(which[order], np.arange(len(buckets) + 1))
+	for i, bucket in enumerate(buckets):
+		values[bounds[i]:bounds[i + 1]].tofile(bucket)
+
+
+def _collect(bam, paired_end, samtools, chunk_size, tmp):
+	paths = [os.path.join(tmp, str(i)) for i in range(2 ** BUCKET_BITS)]
+	buckets = [open(path, "wb") for path in paths]
+	proc = subprocess.Popen([samtools, "view", "-@", "2", bam], stdout=subprocess.PIPE)
+	total = mapped = secondary = duplicate = proper = 0
+	contigs = Counter()
+	chunk = []
+	for line in proc.stdout:
+		name, flag, chrom, _ = line.split(b"\t", 3)
+		flag = int(flag)
+		total += 1
+		if flag & 4:
+			continue
+		mapped += 1
+		contigs[chrom] += 1
+		if flag & 256:
+			secondary += 1
+		if flag & 1024:
+			duplicate += 1
+		if flag & 2:
+			proper += 1
+		chunk.append(hash((name, flag & 192)) if paired_end else hash(name))
+		if len(chunk) >= chunk_size:
+			_spill(chunk, buckets)
+			chunk = []
+	if proc.wait() != 0:
+		raise Exception("samtools view failed on " + bam)
+	_spill(chunk, buckets)
+	for bucket in buckets:
+		bucket.close()
+
+	# all alignments of a read have the same hash, so fall in the same bucket
+	n_reads = unique = 0
+	for path in paths:
+		_, alignments = np.unique(np.fromfile(path, dtype=np.int64), return_counts=True)
+		n_reads += len(alignments)
+		unique += int((alignments == 1).sum())
+
+	return {
+		"paired_end": paired_end,
+		"Total_records": total,
+		"Mapped_records": mapped,
+		"Aligned_reads": n_reads,
+		"Uniquely_mapped_reads": unique,
+		"Multimapped_reads": n_reads - unique,
+		"Secondary_alignments": secondary,
+		"Duplicate_records": duplicate,
+		"Properly_paired_records": proper,
+		"Contigs": dict((c.decode(), n) for c, n in contigs.items())}
+
+
+def stats_file(bam):
+	return os.path.splitext(bam)[0] + ".bamstats.json"
+
+
+def get_stats(bam, paired_end=False, samtools="samtools"):
+	"""
+	Statistics of a BAM file, from the cache if it is up to date.
+
+	:param str bam: path to the BAM file
+	:param bool paired_end: count mates of a pair as separate reads
+	:param str samtools: path to samtools
+	:return dict: statistics
+	"""
+	path = stats_file(bam)
+	if os.path.exists(path) and os.path.getmtime(path) >= os.path.getmtime(bam):
+		with open(path) as handle:
+			stats = json.load(handle)
+		if stats["paired_end"] == paired_end:
+			return stats
+	stats = collect(bam, paired_end, samtools)
+	with open(path, "w") as handle:
+		json.dump(stats, handle, indent=1, sort_keys=True)
+	return stats
+
+
+if __name__ == "__main__":
+	parser = ArgumentParser(description="Single-pass BAM statistics.")
+	parser.add_argument("-i", "--input", dest="bam", required=True, help="BAM file.")
+	parser.add_argument("-p", "--paired-end", dest="paired_end", action="store_true", default=False,
+		help="Count mates of a pair as separate reads.")
+	parser.add_argument("--samtools", dest="samtools", default="samtools", help="Path to samtools.")
+	args = parser.parse_args()
+	json.dump(get_stats(args.bam, args.paired_end, args.samtools), sys.stdout, indent=1, sort_keys=True)
+	sys.stdout.write("\n")
@@ -0,0 +1,415 @@
+#!/usr/bin/env python
+"""
+Minimal bigWig writer and reader.
+
+Writes bedGraph-style data sections, the chromosome B+ tree, the R-tree data
+index and zoom levels as described in the UCSC bigWig format (Kent et al.
+2010), so the output reads in the genome browser, pyBigWig, deepTools and
+RSeQC like a file made by wigToBigWig.
+
+Data is given per chromosome as numpy arrays of run starts, ends and values.
+The reader maps the file into memory and, through the data index, only
+decompresses the blocks overlapping a query:
+
+	track = BigWig("sample_sorted.depth.bw")
+	depth = track.values("chr1", 1000000, 1001000, missing=0)
+
+Usage: bigwig.py -i <file.bw> -r chr1:1000000-1001000
+"""
+
+import mmap
+import os
+import struct
+import sys
+import zlib
+from argparse import ArgumentParser
+
+import numpy as np
+
+
+BIGWIG_MAGIC = 0x888FFC26
+BPT_MAGIC = 0x78CA8C91
+CIRTREE_MAGIC = 0x2468ACE0
+VERSION = 4
+BEDGRAPH = 1
+
+HEADER_FORMAT = "<IHHQQQHHQQIQ"
+ZOOM_HEADER_FORMAT = "<IIQQ"
+SUMMARY_FORMAT = "<Qdddd"
+SECTION_FORMAT = "<IIIIIBBH"
+VARSTEP = 2
+FIXEDSTEP = 3
+
+BEDGRAPH_DTYPE = np.dtype([("start", "<u4"), ("end", "<u4"), ("value", "<f4")])
+ZOOM_DTYPE = np.dtype([("chrom", "<u4"), ("start", "<u4"), ("end", "<u4"), ("valid", "<u4"),
+	("min", "<f4"), ("max", "<f4"), ("sum", "<f4"), ("squares", "<f4")])
+
+
+class BigWigWriter(object):
+	"""
+	Write a bigWig file, one chromosome at a time.
+
+	Chromosomes are numbered in name order, and add() has to be called in that
+	order too, as the data index relies on it. The file is written under a
+	temporary name and moved into place by close().
+	"""
+
+	def __init__(self, path, chrom_sizes, reductions=(), items_per_slot=1024, block_size=256):
+		"""
+		:param str path: output file
+		:param list chrom_sizes: (name, size) of each chromosome
+		:param reductions: bases per zoom record of each zoom level
+		:param int items_per_slot: records per compressed block
+		:param int block_size: items per node of the index trees
+		"""
+		self.path = path
+		self.chroms = sorted(chrom_sizes)
+		self.reductions = sorted(reductions)
+		self.items_per_slot = items_per_slot
+		self.block_size = block_size
+		self._ids = dict((name, i) for i, (name, _) in enumerate(self.chroms))
+		self._last_id = -1
+		self._index = []
+		self._zooms = [[] for _ in self.reductions]
+		self._summary = [0, float("inf"), float("-inf"), 0.0, 0.0]
+		self._buffer_size = 0
+
+		self._tmp = "{}.tmp{}".format(path, os.getpid())
+		self._out = open(self._tmp, "wb")
+		self._out.write(b"\0" * (struct.calcsize(HEADER_FORMAT)
+			+ len(self.reductions) * struct.calcsize(ZOOM_HEADER_FORMAT)
+			+ struct.calcsize(SUMMARY_FORMAT)))
+		self._chrom_tree_offset = self._out.tell()
+		self._write_chrom_tree()
+		self._data_offset = self._out.tell()
+		self._out.write(struct.pack("<Q", 0))
+
+	def add(self, chrom, starts, ends, values):
+		"""
+		Add the data of a chromosome.
+
+		:param str chrom: chromosome name
+		:param numpy.ndarray starts: 0-based run starts, sorted
+		:param numpy.ndarray ends: run ends, exclusive
+		:param numpy.ndarray values: run values
+		"""
+		chrom_id = self._ids[chrom]
+		if chrom_id <= self._last_id:
+			raise ValueError("Chromosomes have to be added once each, in name order: " + chrom)
+		self._last_id = chrom_id
+		if len(starts) == 0:
+			return
+
+		records = np.zeros(len(starts), dtype=BEDGRAPH_DTYPE)
+		records["start"], records["end"], records["value"] = starts, ends, values
+		for i in range(0, len(records), self.items_per_slot):
+			block = records[i:i + self.items_per_slot]
+			header = struct.pack(SECTION_FORMAT, chrom_id, int(block["start"][0]), int(block["end"][-1]),
+				0, 0, BEDGRAPH, 0, len(block))
+			offset, size = self._write_block(header + block.tobytes())
+			self._index.append((chrom_id, int(block["start"][0]), chrom_id, int(block["end"][-1]), offset, size))
+
+		values = records["value"].astype(np.float64)
+		lengths = (records["end"] - records["start"]).astype(np.float64)
+		self._summary[0] += int(lengths.sum())
+		self._summary[1] = min(self._summary[1], values.min())
+		self._summary[2] = max(self._summary[2], values.max())
+		self._summary[3] += (values * lengths).sum()
+		self._summary[4] += (values * values * lengths).sum()
+
+		size = self.chroms[chrom_id][1]
+		for level, reduction in enumerate(self.reductions):
+			self._zooms[level].append(_zoom_records(chrom_id, size, records, reduction))
+
+	def close(self):
+		index_offset = self._out.tell()
+		self._write_index(self._index, index_offset)
+
+		zoom_headers = []
+		for reduction, zooms in zip(self.reductions, self._zooms):
+			records = np.concatenate(zooms) if zooms else np.zeros(0, dtype=ZOOM_DTYPE)
+			zoom_data_offset = self._out.tell()
+			self._out.write(struct.pack("<I", len(records)))
+			zoom_index = []
+			for i in range(0, len(records), self.items_per_slot):
+				block = records[i:i + self.items_per_slot]
+				offset, size = self._write_block(block.tobytes())
+				zoom_index.append((int(block["chrom"][0]), int(block["start"][0]),
+					int(block["chrom"][-1]), int(block["end"][-1]), offset, size))
+			zoom_index_offset = self._out.tell()
+			self._write_index(zoom_index, zoom_index_offset)
+			zoom_headers.append((reduction, 0, zoom_data_offset, zoom_index_offset))
+
+		if not self._summary[0]:
+			self._summary[1] = self._summary[2] = 0.0
+		self._out.seek(0)
+		self._out.write(struct.pack(HEADER_FORMAT, BIGWIG_MAGIC, VERSION, len(zoom_headers),
+			self._chrom_tree_offset, self._data_offset, index_offset, 0, 0, 0,
+			struct.calcsize(HEADER_FORMAT) + len(zoom_headers) * struct.calcsize(ZOOM_HEADER_FORMAT),
+			self._buffer_size, 0))
+		for zoom_header in zoom_headers:
+			self._out.write(struct.pack(ZOOM_HEADER_FORMAT, *zoom_header))
+		self._out.write(struct.pack(SUMMARY_FORMAT, *self._summary))
+		self._out.seek(self._data_offset)
+		self._out.write(struct.pack("<Q", len(self._index)))
+		self._out.close()
+		os.rename(self._tmp, self.path)
+
+	def _write_block(self, data):
+		"""
+		Write a compressed block, returning its offset and compressed size.
+		"""
+		self._buffer_size = max(self._buffer_size, len(data))
+		offset = self._out.tell()
+		self._out.write(zlib.compress(data))
+		return offset, self._out.tell() - offset
+
+	def _write_chrom_tree(self):
+		names = [name.encode() for name, _ in self.chroms]
+		key_size = max([len(name) for name in names] + [1])
+		block_size = max(min(self.block_size, len(names)), 1)
+		self._out.write(struct.pack("<IIIIQQ", BPT_MAGIC, block_size, key_size, 8, len(names), 0))
+		leaves = [(name, i, size) for i, (name, (_, size)) in enumerate(zip(names, self.chroms))]
+		_write_tree(self._out, leaves, block_size,
+			lambda item: item[0].ljust(key_size, b"\0") + struct.pack("<II", item[1], item[2]),
+			lambda item, offset: item[0].ljust(key_size, b"\0") + struct.pack("<Q", offset),
+			lambda group: group[0][:1], key_size + 8, key_size + 8)
+
+	def _write_index(self, items, end_offset):
+		"""
+		Write the R-tree index of a list of blocks,
+		(start chrom, start, end chrom, end, offset, size).
+		"""
+		first = items[0] if items else (0, 0, 0, 0)
+		last = items[-1] if items else (0, 0, 0, 0)
+		self._out.write(struct.pack("<IIQIIIIQII", CIRTREE_MAGIC, self.block_size, len(items),
+			first[0], first[1], last[2], last[3], end_offset, self.items_per_slot, 0))
+		_write_tree(self._out, items, self.block_size,
+			lambda item: struct.pack("<IIIIQQ", *item),
+			lambda item, offset: struct.pack("<IIIIQ", item[0], item[1], item[2], item[3], offset),
+			lambda group: (group[0][0], group[0][1], group[-1][2], group[-1][3]), 32, 24)
+
+
+def _write_tree(out, leaves, block_size, leaf_item, node_item, merge, leaf_size, node_size):
+	"""
+	Write a tree of nodes holding up to block_size items, root first. Upper
+	levels hold one item per node of the level below, made by merge() from
+	the items of that node; leaf_item() and node_item() encode items.
+	"""
+	levels = [leaves]
+	while len(levels[-1]) > block_size:
+		below = levels[-1]
+		levels.append([merge(below[i:i + block_size]) for i in range(0, len(below), block_size)])
+	levels.reverse()
+
+	level_start = out.tell()
+	for depth, items in enumerate(levels):
+		leaf = depth == len(levels) - 1
+		n_nodes = max((len(items) + block_size - 1) // block_size, 1)
+		level_end = level_start + 4 * n_nodes + len(items) * (leaf_size if leaf else node_size)
+		child_size = 4 + block_size * (leaf_size if depth + 1 == len(levels) - 1 else node_size)
+		for i in range(0, max(len(items), 1), block_size):
+			group = items[i:i + block_size]
+			out.write(struct.pack("<BBH", leaf, 0, len(group)))
+			for j, item in enumerate(group, i):
+				out.write(leaf_item(item) if leaf else node_item(item, level_end + j * child_size))
+		level_start = level_end
+
+
+def _zoom_records(chrom_id, size, records, reduction):
+	"""
+	Summarize bedGraph records in bins of reduction bases.
+	"""
+	starts = records["start"].astype(np.int64)
+	ends = records["end"].astype(np.int64)
+	first = starts // reduction
+	pieces = (ends - 1) // reduction - first + 1
+	# Split runs at bin boundaries: one piece per run and bin it overlaps.
+	run = np.repeat(np.arange(len(records)), pieces)
+	bins = first[run] + np.arange(pieces.sum()) - np.repeat(np.cumsum(pieces) - pieces, pieces)
+	lengths = np.minimum(ends[run], (bins + 1) * reduction) - np.maximum(starts[run], bins * reduction)
+	values = records["value"][run].astype(np.float64)
+
+	idx = np.flatnonzero(np.concatenate([[True], bins[1:] != bins[:-1]]))
+	zoom = np.zeros(len(idx), dtype=ZOOM_DTYPE)
+	zoom["chrom"] = chrom_id
+	zoom["start"] = bins[idx] * reduction
+	zoom["end"] = np.minimum((bins[idx] + 1) * reduction, size)
+	zoom["valid"] = np.add.reduceat(lengths, idx)
+	zoom["min"] = np.minimum.reduceat(values, idx)
+	zoom["max"] = np.maximum.reduceat(values, idx)
+	zoom["sum"] = np.add.reduceat(values * lengths, idx)
+	zoom["squares"] = np.add.reduceat(values * values * lengths, idx)
+	return zoom
+
+
+class BigWig(object):
+	"""
+	Memory-mapped, read-only view of a bigWig file.
+	"""
+
+	def __init__(self, path):
+		self.path = path
+		with open(path, "rb") as handle:
+			self._mm = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+
+		self._endian = "<"
+		if struct.unpack_from("<I", self._mm, 0)[0] != BIGWIG_MAGIC:
+			self._endian = ">"
+			if struct.unpack_from(">I", self._mm, 0)[0] != BIGWIG_MAGIC:
+				raise ValueError("Not a bigWig file: " + path)
+		header = self._unpack(HEADER_FORMAT, 0)
+		chrom_tree_offset, self._index_offset, self._buffer_size = header[3], header[5], header[10]
+
+		_, _, key_size, _, _, _ = self._unpack("<IIIIQQ", chrom_tree_offset)
+		self._chroms = {}
+		self._read_chrom_node(chrom_tree_offset + 32, key_size)
+		self._names = dict((chrom_id, name) for name, (chrom_id, _) in self._chroms.items())
+
+	def __contains__(self, chrom):
+		return chrom in self._chroms
+
+	def chrom_sizes(self):
+		"""
+		:return list: (name, size) of each chromosome, in file order
+		"""
+		return [(self._names[i], self._chroms[self._names[i]][1]) for i in sorted(self._names)]
+
+	def length(self, chrom):
+		return self._chroms[chrom][1]
+
+	def intervals(self, chrom, start=0, end=None):
+		"""
+		Runs of data overlapping chrom[start:end], clipped to it.
+
+		:param str chrom: chromosome name
+		:param int start: 0-based start, inclusive
+		:param int end: end, exclusive; the chromosome end by default
+		:return (numpy.ndarray, numpy.ndarray, numpy.ndarray): run starts, ends and values
+		"""
+		chrom_id, size = self._chroms[chrom]
+		end = size if end is None else min(end, size)
+		starts, ends, values = [], [], []
+		for offset, length in self._find_blocks(self._index_offset + 48, chrom_id, start, end):
+			data = self._mm[offset:offset + length]
+			if self._buffer_size:
+				data = zlib.decompress(data)
+			block_chrom, block_start, _, step, span, kind, _, count = self._unpack(SECTION_FORMAT, 0, data)
+			if block_chrom != chrom_id:
+				continue
+			body = data[struct.calcsize(SECTION_FORMAT):]
+			if kind == BEDGRAPH:
+				records = np.frombuffer(body, dtype=BEDGRAPH_DTYPE.newbyteorder(self._endian), count=count)
+				run_starts, run_ends = records["start"], records["end"]
+			elif kind == VARSTEP:
+				records = np.frombuffer(body, dtype=np.dtype([("start", "u4"), ("value", "f4")]).newbyteorder(self._endian), count=count)
+				run_starts = records["start"]
+				run_ends = run_starts + span
+			elif kind == FIXEDSTEP:
+				records = np.frombuffer(body, dtype=np.dtype([("value", "f4")]).newbyteorder(self._endian), count=count)
+				run_starts = block_start + step * np.arange(count, dtype=np.int64)
+				run_ends = run_starts + span
+			else:
+				raise ValueError("Unknown bigWig section type {} in {}".format(kind, self.path))
+			starts.append(run_starts.astype(np.int64))
+			ends.append(run_ends.astype(np.int64))
+			values.append(records["value"].astype(np.float64))
+		if not starts:
+			return np.zeros(0, np.int64), np.zeros(0, np.int64), np.zeros(0, np.float64)
+
+		starts, ends, values = np.concatenate(starts), np.concatenate(ends), np.concatenate(values)
+		keep = (ends > start) & (starts < end)
+		return np.maximum(starts[keep], start), np.minimum(ends[keep], end), values[keep]
+
+	def values(self, chrom, start, end, missing=np.nan):
+		"""
+		Value of every base of chrom[start:end].
+
+		:param missing: value of bases without data
+		:return numpy.ndarray: one float per base
+		"""
+		end = min(end, self.length(chrom))
+		out = np.full(max(end - start, 0), missing, dtype=np.float64)
+		for run_start, run_end, value in zip(*self.intervals(chrom, start, end)):
+			out[run_start - start:run_end - start] = value
+		return out
+
+	def mean(self, chrom, start, end):
+		"""
+		Mean value over chrom[start:end], counting bases without data as 0.
+		"""
+		end = min(end, self.length(chrom))
+		if end <= start:
+			return 0.0
+		run_starts, run_ends, values = self.intervals(chrom, start, end)
+		return float((values * (run_ends - run_starts)).sum()) / (end - start)
+
+	def close(self):
+		self._mm.close()
+
+	def _unpack(self, fmt, offset, data=None):
+		return struct.unpack_from(self._endian + fmt.lstrip("<"), self._mm if data is None else data, offset)
+
+	def _read_chrom_node(self, offset, key_size):
+		is_leaf, _, count = self._unpack("<BBH", offset)
+		offset += 4
+		for _ in range(count):
+			key = self._mm[offset:offset + key_size].rstrip(b"\0").decode()
+			if is_leaf:
+				self._chroms[key] = self._unpack("<II", offset + key_size)
+			else:
+				self._read_chrom_node(self._unpack("<Q", offset + key_size)[0], key_size)
+			offset += key_size + 8
+
+	def _find_blocks(self, offset, chrom_id, start, end):
+		"""
+		Yield (offset, size) of the data blocks overlapping a region, from the
+		R-tree node at offset.
+		"""
+		is_leaf, _, count = self._unpack("<BBH", offset)
+		offset += 4
+		for _ in range(count):
+			start_chrom, start_base, end_chrom, end_base = self._unpack("<IIII", offset)
+			overlaps = (start_chrom, start_base) < (chrom_id, end) and (end_chrom, end_base) > (chrom_id, start)
+			if is_leaf:
+				if overlaps:
+					yield self._unpack("<QQ", offset + 16)
+				offset += 32
+			else:
+				if overlaps:
+					for block in self._find_blocks(self._unpack("<Q", offset + 16)[0], chrom_id, start, end):
+						yield block
+				offset += 24
+
+
+def parse_region(region):
+	"""
+	"chr1:1000-2000" (1-based, inclusive) -> ("chr1", 999, 2000); "chr1" -> ("chr1", 0, None)
+	"""
+	chrom, _, span = region.partition(":")
+	if not span:
+		return chrom, 0, None
+	start, _, end = span.replace(",", "").partition("-")
+	return chrom, int(start) - 1, int(end) if end else None
+
+
+if __name__ == "__main__":
+	parser = ArgumentParser(description="Query a bigWig file.")
+	parser.add_argument("-i", "--input", dest="bigwig", required=True, help="bigWig file.")
+	parser.add_argument("-r", "--region", dest="regions", nargs="+", required=True,
+		help="Regions as chrom:start-end, 1-based and inclusive, or whole chromosomes.")
+	parser.add_argument("-m", "--mean", dest="mean", action="store_true", default=False,
+		help="Print the mean value of each region instead of its bedGraph runs.")
+	args = parser.parse_args()
+
+	track = BigWig(args.bigwig)
+	for region in args.regions:
+		chrom, start, end = parse_region(region)
+		if end is None:
+			end = track.length(chrom)
+		if args.mean:
+			sys.stdout.write("{}\t{}\t{}\t{}\n".format(chrom, start, end, track.mean(chrom, start, end)))
+			continue
+		for run in zip(*track.intervals(chrom, start, end)):
+			sys.stdout.write("{}\t{}\t{}\t{:g}\n".format(chrom, *run))
+	track.close()
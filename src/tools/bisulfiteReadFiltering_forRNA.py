@@ -0,0 +1,337 @@
+#!/usr/bin/env python
+"""
+Filter aligned reads by their C-to-T conversion rate at non-CpG cytosines.
+
+For every alignment, the cytosines of the reference that are not in a CpG
+context are compared with the read: on the forward strand a converted base
+reads as T where the reference has C, on the reverse strand as A where the
+reference has G. The fraction of converted sites is the conversion rate.
+For pairs, the strand is that of the fragment, i.e. of the first mate.
+
+Reads are kept or skipped as follows:
+- reads covering fewer than --minNonCpgSites informative sites are kept,
+  as there is no way to tell;
+- by default, converted reads (rate >= --minConversionRate) are kept;
+- with -r, unconverted reads (rate <= --maxConversionRate) are kept instead,
+  e.g. to drop bisulfite-converted contamination from RNA libraries;
+- anything else, and unaligned reads, go to the skipped output.
+Paired-end mates (--pairedEnd, name-grouped input) are judged together.
+
+Alignments are streamed in chunks to a pool of --cores worker processes, the
+base comparison within a chunk is vectorized with numpy, and both outputs are
+written as BAM in input order. The header is taken from the stream itself.
+The reference is read from the memory-mapped packed store built by
+packed_genome.py.
+"""
+
+import collections
+import multiprocessing
+import os
+import re
+import subprocess
+import sys
+from argparse import ArgumentParser
+
+import numpy as np
+
+import packed_genome
+
+
+CIGAR_RE = re.compile(b"(\\d+)([MIDNSHP=X])")
+A, C, G, T, N = [ord(b) for b in "ACGTN"]
+
+# Set in every process that filters reads.
+GENOME = None
+OPTS = None
+
+
+def init_worker(opts):
+	"""
+	Set up a filtering process. The packed reference is opened through mmap,
+	so its pages are shared with every other process reading the assembly.
+	"""
+	global GENOME, OPTS
+	OPTS = opts
+	GENOME = packed_genome.open_genome(opts.genome_dir, opts.genome)
+
+
+def _aligned_blocks(pos, cigar):
+	"""
+	Yield (reference start, query start, length) of the aligned blocks.
+	"""
+	rpos, qpos = pos, 0
+	for length, op in CIGAR_RE.findall(cigar):
+		length = int(length)
+		if op in b"M=X":
+			yield rpos, qpos, length
+			rpos += length
+			qpos += length
+		elif op in b"IS":
+			qpos += length
+		elif op in b"DN":
+			rpos += length
+
+
+def _count_sites(records, paired_end=False):
+	"""
+	Count informative non-CpG sites and converted sites of each record.
+
+	:param list records: (flag, chrom, 0-based pos, cigar, seq) tuples
+	:param bool paired_end: records are mates; the strand that tells how
+		sites convert is that of the fragment, which the second mate reads
+		reverse-complemented
+	:return (numpy.ndarray, numpy.ndarray): sites and converted sites per record
+	"""
+	idx, ref, ctx, read, minus = [], [], [], [], []
+	for i, (flag, chrom, pos, cigar, seq) in enumerate(records):
+		if flag & 4 or chrom not in GENOME:
+			continue
+		reverse = bool(flag & 16) != bool(paired_end and flag & 128)
+		for rpos, qpos, length in _aligned_blocks(pos, cigar):
+			# One base of flanking sequence on each side, padded with N at the
+			# contig ends, gives the CpG context: the next base on the forward
+			# strand, the previous one on the reverse strand.
+			flanked = GENOME.fetch(chrom, rpos - 1, rpos + length + 1)
+			if rpos == 0:
+				flanked = np.concatenate([[N], flanked])
+			length = min(length, len(flanked) - 1)
+			if length <= 0:
+				continue
+			if len(flanked) < length + 2:
+				flanked = np.concatenate([flanked, [N]])
+			block = flanked[1:length + 1]
+			context = flanked[:length] if reverse else flanked[2:length + 2]
+			idx.append(np.full(length, i, dtype=np.int64))
+			ref.append(block)
+			ctx.append(context)
+			read.append(np.frombuffer(seq[qpos:qpos + length].upper(), dtype=np.uint8))
+			minus.append(np.full(length, reverse, dtype=bool))
+
+	n = len(records)
+	if not idx:
+		return np.zeros(n, dtype=np.int64), np.zeros(n, dtype=np.int64)
+
+	idx, ref, ctx, read, minus = [np.concatenate(x) for x in (idx, ref, ctx, read, minus)]
+	sites = np.where(minus, (ref == G) & (ctx != C), (ref == C) & (ctx != G))
+	converted = sites & np.where(minus, read == A, read == T)
+	return (np.bincount(idx, weights=sites, minlength=n).astype(np.int64),
+		np.bincount(idx, weights=converted, minlength=n).astype(np.int64))
+
+
+def _groups(records, paired_end):
+	"""
+	Group record indices that have to be judged together: in paired-end mode,
+	the two mates of each alignment, matched by name and mate position within
+	a read name group; each record on its own otherwise.
+	"""
+	if not paired_end:
+		for i in range(len(records)):
+			yield [i]
+		return
+
+	start = 0
+	while start < len(records):
+		end = start
+		while end < len(records) and records[end][5] == records[start][5]:
+			end += 1
+		second = collections.defaultdict(list)
+		for i in range(start, end):
+			if records[i][0] & 128:
+				second[_mate_key(records[i], own=True)].append(i)
+		for i in range(start, end):
+			if records[i][0] & 128:
+				continue
+			mates = second.get(_mate_key(records[i], own=False))
+			if records[i][0] & 64 and mates:
+				yield [i, mates.pop(0)]
+			else:
+				yield [i]
+		for mates in second.values():
+			for i in mates:
+				yield [i]
+		start = end
+
+
+def _mate_key(record, own):
+	"""
+	Key matching an alignment to its mate: (chrom, pos, mate chrom, mate pos)
+	of the second mate equals (mate chrom, mate pos, chrom, pos) of the first.
+	"""
+	flag, chrom, pos, cigar, seq, name, mate_chrom, mate_pos = record
+	if mate_chrom == b"=":
+		mate_chrom = chrom
+	if own:
+		return chrom, pos, mate_chrom, mate_pos
+	return mate_chrom, mate_pos, chrom, pos
+
+
+def filter_chunk(lines):
+	"""
+	Split a chunk of SAM lines into kept and skipped lines.
+
+	:param list lines: SAM records, as bytes with line endings
+	:return (bytes, bytes): kept and skipped lines, in input order
+	"""
+	records = []
+	for line in lines:
+		fields = line.split(b"\t", 10)
+		records.append((int(fields[1]), fields[2], int(fields[3]) - 1, fields[5], fields[9],
+			fields[0], fields[6], int(fields[7]) - 1))
+
+	sites, converted = _count_sites([r[:5] for r in records], OPTS.paired_end)
+	keep = np.zeros(len(records), dtype=bool)
+	for group in _groups(records, OPTS.paired_end):
+		if any(records[i][0] & 4 for i in group):
+			continue
+		n_sites = sites[group].sum()
+		if n_sites < OPTS.min_sites:
+			keep[group] = True
+			continue
+		rate = float(converted[group].sum()) / n_sites
+		if OPTS.reverse:
+			keep[group] = rate <= OPTS.max_rate
+		else:
+			keep[group] = rate >= OPTS.min_rate
+
+	kept = b"".join(line for line, k in zip(lines, keep) if k)
+	skipped = b"".join(line for line, k in zip(lines, keep) if not k)
+	return kept, skipped
+
+
+def read_chunks(stream, paired_end, chunk_bytes=1 << 22):
+	"""
+	Read SAM records in chunks of about chunk_bytes, never splitting a read
+	name group across chunks in paired-end mode.
+
+	:return (list, generator): header lines and a generator of record chunks
+	"""
+	header = []
+	first = []
+	line = stream.readline()
+	while line.startswith(b"@"):
+		header.append(line)
+		line = stream.readline()
+	if line:
+		first = [line]
+
+	def chunks():
+		pending = first
+		while True:
+			lines = stream.readlines(chunk_bytes)
+			if not lines:
+				break
+			lines = pending + lines
+			pending = []
+			if paired_end:
+				name = lines[-1].split(b"\t", 1)[0]
+				cut = len(lines)
+				while cut > 0 and lines[cut - 1].split(b"\t", 1)[0] == name:
+					cut -= 1
+				if cut > 0:
+					lines, pending = lines[:cut], lines[cut:]
+				else:
+					pending = lines
+					continue
+			yield lines
+		if pending:
+			yield pending
+
+	return header, chunks()
+
+
+def open_writer(samtools, path, sort, cores):
+	"""
+	Start a samtools process that encodes SAM text from stdin as BAM.
+	"""
+	if sort:
+		cmd = [samtools, "sort", "-@", str(cores), "-T", path + "_tmp", "-o", path, "-"]
+	else:
+		cmd = [samtools, "view", "-b", "-@", str(cores), "-o", path, "-"]
+	return subprocess.Popen(cmd, stdin=subprocess.PIPE)
+
+
+def main():
+	global OPTS
+
+	parser = ArgumentParser(description="Conversion rate read filter")
+	parser.add_argument("--infile", required=True,
+		help="Input alignments: a SAM/BAM file, or - for SAM on stdin.")
+	parser.add_argument("--outfile", required=True, help="BAM file of kept reads.")
+	parser.add_argument("--skipped", required=True, help="BAM file of skipped reads.")
+	parser.add_argument("--genome", required=True, help="Genome assembly name.")
+	parser.add_argument("--genomeDir", dest="genome_dir", required=True,
+		help="Folder containing the packed reference, <genome>.2bit.")
+	parser.add_argument("--minNonCpgSites", dest="min_sites", type=int, default=3,
+		help="Reads with fewer informative sites are kept.")
+	parser.add_argument("--minConversionRate", dest="min_rate", type=float, default=0.9,
+		help="Conversion rate from which a read counts as converted.")
+	parser.add_argument("--maxConversionRate", dest="max_rate", type=float, default=0.1,
+		help="Conversion rate up to which a read counts as unconverted.")
+	parser.add_argument("-r", "--reverse", dest="reverse", action="store_true", default=False,
+		help="Keep unconverted reads instead of converted ones.")
+	parser.add_argument("--pairedEnd", dest="paired_end", action="store_true", default=False,
+		help="Judge mates together; input has to be grouped by read name.")
+	parser.add_argument("--sort", dest="sort", action="store_true", default=False,
+		help="Coordinate-sort the outputs instead of keeping input order.")
+	parser.add_argument("-p", "--cores", dest="cores", type=int, default=1,
+		help="Number of worker processes.")
+	parser.add_argument("--samtools", dest="samtools", default="samtools",
+		help="Path to samtools.")
+	OPTS = parser.parse_args()
+
+	if OPTS.infile == "-":
+		reader = None
+		stream = getattr(sys.stdin, "buffer", sys.stdin)
+	else:
+		reader = subprocess.Popen([OPTS.samtools, "view", "-h", OPTS.infile], stdout=subprocess.PIPE)
+		stream = reader.stdout
+
+	header, chunks = read_chunks(stream, OPTS.paired_end)
+	writers = [open_writer(OPTS.samtools, path, OPTS.sort, max(OPTS.cores // 2, 1))
+		for path in (OPTS.outfile, OPTS.skipped)]
+	for writer in writers:
+		writer.stdin.write(b"".join(header))
+
+	counts = [0, 0]
+
+	def write(result):
+		for i, lines in enumerate(result):
+			writers[i].stdin.write(lines)
+			counts[i] += lines.count(b"\n")
+
+	if OPTS.cores > 1:
+		pool = multiprocessing.Pool(OPTS.cores, init_worker, (OPTS,))
+		# Bounded number of chunks in flight, collected in submission order.
+		pending = collections.deque()
+		for chunk in chunks:
+			pending.append(pool.apply_async(filter_chunk, (chunk,)))
+			if len(pending) >= 2 * OPTS.cores:
+				write(pending.popleft().get())
+		while pending:
+			write(pending.popleft().get())
+		pool.close()
+		pool.join()
+	else:
+		init_worker(OPTS)
+		for chunk in chunks:
+			write(filter_chunk(chunk))
+
+	status = 0
+	if reader is not None and reader.wait() != 0:
+		status = 1
+	for writer in writers:
+		writer.stdin.close()
+		if writer.wait() != 0:
+			status = 1
+
+	sorted_output = OPTS.sort or any(h.startswith(b"@HD") and b"SO:coordinate" in h for h in header)
+	if status == 0 and sorted_output:
+		for path in (OPTS.outfile, OPTS.skipped):
+			status = status or subprocess.call([OPTS.samtools, "index", path])
+
+	sys.stderr.write("Kept: {}\nSkipped: {}\n".format(*counts))
+	return status
+
+
+if __name__ == "__main__":
+	sys.exit(main())
@@ -6,10 +6,41 @@ This script takes as input a fastq file and returns the quality encoding system
 used by that fastq file.
 The update makes it so by default, the script only tries to differentiate between
 phred33 and phred64, instead of exact flavor, making it much faster for practical
-application. 
+application.
+The file (plain, gzip or bgzf) is read in large blocks and the quality range of
+a whole block is taken at once with numpy. With -s, blocks are sampled at offsets
+spread across the file instead of reading from the start (plain and bgzf files;
+plain gzip can only be read from the start).
+It can also be imported: detect_encoding(path) returns the valid encodings and
+the observed quality range.
 '''
+from __future__ import print_function
+
+import gzip
+import os
 import sys
-from argparse import ArgumentParser 
+import zlib
+from argparse import ArgumentParser
+
+import numpy as np
+
+
+RANGES = {
+    'phred33': (33, 75),
+    'phred64': (59, 104)
+}
+
+COMPLEX_RANGES = {
+    'phred33/Sanger': (33, 73),
+    'phred33/Illumina-1.8': (33, 74),
+    'phred33/Sanger2': (33, 75), # Another Illumina update
+    'phred64/Solexa': (59, 104),
+    'phred64/Illumina-1.3': (64, 104),
+    'phred64/Illumina-1.5': (67, 104)
+}
+
+BLOCK_SIZE = 1 << 22
+BGZF_MAGIC = b"\x1f\x8b\x08\x04"
 
 
 def get_qual_range(qual_str):
@@ -17,17 +48,170 @@ def get_qual_range(qual_str):
     >>> get_qual_range("DLXYXXRXWYYTPMLUUQWTXTRSXSWMDMTRNDNSMJFJFFRMV")
     (68, 89)
     """
- 
-    vals = [ord(c) for c in qual_str]
-    return min(vals), max(vals)
- 
+    if not isinstance(qual_str, bytes):
+        qual_str = qual_str.encode()
+    vals = np.frombuffer(qual_str, dtype=np.uint8)
+    return int(vals.min()), int(vals.max())
+
 def get_encodings_in_range(rmin, rmax, ranges):
     valid_encodings = []
     for encoding, (emin, emax) in ranges.items():
         if rmin >= emin and rmax <= emax:
             valid_encodings.append(encoding)
     return valid_encodings
- 
+
+
+def quality_values(block, max_lines=-1):
+    """
+    Quality characters of the complete fastq records in a block of text. The
+    block may start and end anywhere; a record is recognized by a '+' line
+    preceded by an '@' header two lines up and followed by a line of the same
+    length as the sequence. Lines are found and picked with numpy, not one by
+    one.
+
+    :param bytes block: fastq text
+    :param int max_lines: take at most this many quality lines; -1 for all
+    :return (numpy.ndarray, int): quality characters and number of lines
+    """
+    text = np.frombuffer(block, dtype=np.uint8)
+    # Only lines ended by a newline are complete.
+    ends = np.flatnonzero(text == ord("\n"))
+    starts = np.concatenate([[0], ends[:-1] + 1])
+    n = len(ends)
+    if n < 4:
+        return np.zeros(0, dtype=np.uint8), 0
+    first = text[np.minimum(starts, len(text) - 1)]
+    lengths = ends - starts
+    # '+' lines at 2..n-2, with their header and quality line
+    plus = np.flatnonzero((first[2:n - 1] == ord("+")) & (first[:n - 3] == ord("@"))
+        & (lengths[3:] == lengths[1:n - 2])) + 2
+    quals = plus + 1
+    quals = quals[lengths[quals] > 0]
+    if max_lines > 0:
+        quals = quals[:max_lines]
+    if not len(quals):
+        return np.zeros(0, dtype=np.uint8), 0
+    inside = np.zeros(len(text) + 1, dtype=np.int32)
+    inside[starts[quals]] = 1
+    inside[ends[quals]] = -1
+    values = text[np.cumsum(inside[:-1]) > 0]
+    return values[values != ord("\r")], len(quals)
+
+
+def file_format(path):
+    """
+    'bgzf', 'gzip' or 'plain'.
+    """
+    with open(path, "rb") as handle:
+        head = handle.read(14)
+    if head[:4] == BGZF_MAGIC and head[12:14] == b"BC":
+        return "bgzf"
+    if head[:2] == b"\x1f\x8b":
+        return "gzip"
+    return "plain"
+
+
+def read_blocks(path, block_size=BLOCK_SIZE):
+    """
+    Yield consecutive blocks of decompressed text from the start of the file,
+    each ending with a complete record: the incomplete record at the end of a
+    block is carried over to the next one, so no record is lost or read twice.
+    """
+    opener = open if file_format(path) == "plain" else gzip.open
+    tail = b""
+    with opener(path, "rb") as handle:
+        while True:
+            data = handle.read(block_size)
+            if not data:
+                if tail:
+                    yield tail if tail.endswith(b"\n") else tail + b"\n"
+                break
+            block = tail + data
+            # records are 4 lines from the start of the file on
+            newlines = np.flatnonzero(np.frombuffer(block, dtype=np.uint8) == ord("\n"))
+            n_lines = len(newlines) // 4 * 4
+            cut = int(newlines[n_lines - 1]) + 1 if n_lines else 0
+            tail = block[cut:]
+            if cut:
+                yield block[:cut]
+
+
+def sample_blocks(path, n_samples, block_size=BLOCK_SIZE):
+    """
+    Yield blocks of decompressed text from n_samples offsets spread evenly
+    across the file. Falls back to read_blocks for plain gzip, which cannot
+    be entered anywhere but at the start, and for files no larger than the
+    blocks together.
+    """
+    fmt = file_format(path)
+    size = os.path.getsize(path)
+    if fmt == "gzip" or size <= n_samples * block_size:
+        # small files are read whole
+        for block in read_blocks(path, block_size):
+            yield block
+        return
+
+    with open(path, "rb") as handle:
+        for k in range(n_samples):
+            handle.seek(size * k // n_samples)
+            # no further than the next offset, so no record is read twice
+            length = min(block_size, size * (k + 1) // n_samples - size * k // n_samples)
+            if fmt == "plain":
+                yield handle.read(length)
+                continue
+            # bgzf: every block is a complete gzip member, so decompression
+            # can start at the first block boundary after the offset.
+            raw = handle.read(length)
+            start = raw.find(BGZF_MAGIC)
+            while start >= 0 and raw[start + 12:start + 14] != b"BC":
+                start = raw.find(BGZF_MAGIC, start + 1)
+            if start < 0:
+                continue
+            raw = raw[start:]
+            out = []
+            n_out = 0
+            while raw and n_out < block_size:
+                member = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                out.append(member.decompress(raw))
+                n_out += len(out[-1])
+                raw = member.unused_data
+            yield b"".join(out)
+
+
+def detect_encoding(path, ranges=RANGES, n_samples=0, max_quals=-1):
+    """
+    Detect the quality encoding of a fastq file.
+
+    Reading stops as soon as a single encoding is left, or after max_quals
+    quality lines.
+
+    :param str path: fastq file, plain or gzip/bgzf compressed
+    :param dict ranges: encoding name -> (min, max) of quality characters
+    :param int n_samples: sample this many blocks spread across the file
+        instead of reading from the start
+    :param int max_quals: number of quality lines to test; -1 for no limit
+    :return (list, tuple, int): valid encodings, observed (min, max) and
+        number of quality lines tested
+    """
+    blocks = sample_blocks(path, n_samples) if n_samples > 0 else read_blocks(path)
+    gmin, gmax = 99, 0
+    valid = list(ranges)
+    n_quals = 0
+    for block in blocks:
+        quals, n_lines = quality_values(block, max_quals - n_quals if max_quals > 0 else -1)
+        if not n_lines:
+            continue
+        n_quals += n_lines
+        lmin, lmax = int(quals.min()), int(quals.max())
+        if lmin < gmin or lmax > gmax:
+            gmin, gmax = min(lmin, gmin), max(lmax, gmax)
+            valid = get_encodings_in_range(gmin, gmax, ranges)
+            if len(valid) == 0 or (len(valid) == 1 and max_quals <= 0):
+                break
+        if max_quals > 0 and n_quals >= max_quals:
+            break
+    return valid, (gmin, gmax), n_quals
+
 
 if __name__ == "__main__":
     parser = ArgumentParser(description='Detect quality codes.')
@@ -37,48 +221,18 @@ if __name__ == "__main__":
 
     parser.add_argument("-f", dest="filename", help="Filename to test", required=True)
     parser.add_argument("-c", dest="complex", help="Complex mode: Show the actual encoding system, not just the phred type", action="store_true", default=False)
+    parser.add_argument("-s", dest="samples", help="Sample this many blocks spread across the file"
+                 " instead of reading from the start", default=0, type=int)
 
     opts = parser.parse_args()
-    if opts.complex:
-        RANGES = {
-    'phred33/Sanger': (33, 73),
-    'phred33/Illumina-1.8': (33, 74),
-    'phred33/Sanger2': (33, 75), # Another Illumina update
-    'phred64/Solexa': (59, 104),
-    'phred64/Illumina-1.3': (64, 104),
-    'phred64/Illumina-1.5': (67, 104)
-    }
-    else:
-        # Actually I don't care which exact one it is, I just want to know how to convert it. This will save you lots of time if you just need this much info.
-        RANGES = {
-	'phred33': (33,75),
-	'phred64': (59,104)
-}
+    # Unless asked for, I don't care which exact one it is, I just want to know how to convert it. This will save you lots of time if you just need this much info.
+    ranges = COMPLEX_RANGES if opts.complex else RANGES
 
-    #print("# reading qualities from stdin")
-    #print("RANGES:", RANGES)
-    txt = open(opts.filename)
-    gmin, gmax  = 99, 0
-    valid = []
-    for i, line in enumerate(txt):
-        if ((i+1) % 4) != 0:
-            continue
-        #print i, i+1 % 4, line
-        lmin, lmax = get_qual_range(line.rstrip())
-        if lmin < gmin or lmax > gmax:
-            gmin, gmax = min(lmin, gmin), max(lmax, gmax)
-            valid = get_encodings_in_range(gmin, gmax, RANGES)
-            if len(valid) == 0:
-                print("no encodings for range: %s" % str((gmin, gmax)))
-                raise SystemExit
-            if len(valid) == 1 and opts.n == -1:
-                print "\t".join(valid) + "\t" + str((gmin, gmax)) + "\t" + str(i)
-                raise SystemExit
- 
-        if opts.n > 0 and i > opts.n:
-            print("\t".join(valid) + "\t" + str((gmin, gmax)))
-            raise SystemExit
- 
+    valid, (gmin, gmax), n_quals = detect_encoding(opts.filename, ranges, opts.samples, opts.n)
+    if len(valid) == 0:
+        print("no encodings for range: %s" % str((gmin, gmax)))
+        raise SystemExit
+    if len(valid) == 1 and opts.n == -1:
+        print("\t".join(valid) + "\t" + str((gmin, gmax)) + "\t" + str(n_quals))
+        raise SystemExit
     print("\t".join(valid) + "\t" + str((gmin, gmax)))
-
-
@@ -0,0 +1,304 @@
+#!/usr/bin/env python
+"""
+Quantify many samples with kallisto while loading each index once.
+
+kallisto quant loads the whole transcriptome index for every sample, which
+for projects of thousands of small samples (single cells) takes longer than
+the quantification itself. Instead, rnaKallisto.py --kallisto-batch <file>
+trims the reads of a sample as usual and adds the sample to a project batch
+file. This tool then pseudoaligns all samples of the batch file in one
+kallisto bus run per index (and read type), counts equivalence classes with
+bustools and runs the EM of every sample with kallisto quant-tcc. The results
+are split back per sample into the usual <sample>/kallisto folder:
+abundance.h5, abundance.tsv and run_info.json.
+
+The numbers of processed and pseudoaligned reads of each sample are added to
+the stats file of its pipeline run, as the sample pipeline reports them.
+
+Samples that already have an abundance.h5 are skipped, so the tool can be
+run again as more samples finish trimming. Bootstraps are not estimated in
+this mode.
+
+The batch file names the indexes in the genomes folder. With
+--stage-resources, each index is copied to node-local scratch when the tool
+runs, as the pipelines do with their resources, and held there until it is
+done.
+
+The batch file has one tab-separated line per sample: sample name, kallisto
+index, output folder, fragment length and standard deviation ("-" for
+paired-end data), the trimmed read file(s) and the pipeline's stats file.
+
+Usage: kallisto_batch.py -b <batch.tsv> [-p cores] [--clean]
+	[--stage-resources <scratch> --genomes <genomes folder>]
+"""
+
+import errno
+import fcntl
+import json
+import os
+import re
+import shutil
+import subprocess
+import sys
+from argparse import ArgumentParser
+from collections import OrderedDict
+
+import numpy as np
+
+import kallisto_h5
+
+
+FIELDS = ["sample_name", "index", "outdir", "fragment_length", "fragment_length_sdev", "fastq1", "fastq2",
+	"stats_file"]
+
+
+def add_sample(batch, sample_name, index, outdir, fastq1, fastq2=None,
+		fragment_length=None, fragment_length_sdev=None, stats_file=None):
+	"""
+	Add a sample to a batch file, replacing an earlier line of the same sample.
+
+	The file is locked while it is rewritten, so that the samples of a
+	project can be added by pipelines running at the same time.
+	"""
+	values = [sample_name, index, outdir, fragment_length, fragment_length_sdev, fastq1, fastq2, stats_file]
+	line = "\t".join("-" if value is None else str(value) for value in values) + "\n"
+	with open(batch, "a+") as handle:
+		fcntl.flock(handle, fcntl.LOCK_EX)
+		handle.seek(0)
+		lines = [l for l in handle if l.split("\t", 1)[0] != sample_name]
+		handle.seek(0)
+		handle.truncate()
+		handle.writelines(lines + [line])
+		handle.flush()
+		fcntl.flock(handle, fcntl.LOCK_UN)
+
+
+def read_batch(batch):
+	"""
+	:return list: one dict per sample of a batch file, keyed by FIELDS
+	"""
+	samples = []
+	with open(batch) as handle:
+		fcntl.flock(handle, fcntl.LOCK_SH)
+		for line in handle:
+			if line.strip() and not line.startswith("#"):
+				values = [None if v == "-" else v for v in line.rstrip("\n").split("\t")]
+				samples.append(dict(zip(FIELDS, values)))
+		fcntl.flock(handle, fcntl.LOCK_UN)
+	return samples
+
+
+def count_reads(fastq, block_size=1 << 22):
+	"""
+	Number of records of an uncompressed fastq file.
+	"""
+	lines = 0
+	with open(fastq, "rb") as handle:
+		for block in iter(lambda: handle.read(block_size), b""):
+			lines += block.count(b"\n")
+	return lines // 4
+
+
+def _barcode_index(barcode):
+	"""
+	Position in the kallisto batch file of the sample of a bustools barcode:
+	kallisto bus -x bulk gives each sample its number as barcode, which
+	bustools prints in nucleotides, two bits per base.
+	"""
+	if barcode.isdigit():
+		return int(barcode)
+	return int("".join(str("ACGT".index(base)) for base in barcode), 4)
+
+
+def read_mtx(mtx):
+	"""
+	:return (numpy.ndarray, numpy.ndarray, numpy.ndarray): row, column (both
+		0-based) and value of the entries of a MatrixMarket coordinate file
+	"""
+	with open(mtx) as handle:
+		for line in handle:
+			if not line.startswith("%"):
+				break
+		entries = np.loadtxt(handle, ndmin=2).reshape(-1, 3)
+	return entries[:, 0].astype(np.int64) - 1, entries[:, 1].astype(np.int64) - 1, entries[:, 2]
+
+
+def _run(cmd):
+	print(" ".join(cmd))
+	sys.stdout.flush()
+	subprocess.check_call(cmd)
+
+
+def quantify_group(samples, workdir, cores=1, kallisto="kallisto", bustools="bustools", index=None):
+	"""
+	Pseudoalign and quantify samples of the same index and read type in
+	one kallisto run.
+
+	:param list samples: samples, as read by read_batch
+	:param str workdir: folder for the intermediate files
+	:param str index: copy of the samples' index to read, e.g. a staged one
+	:return list: quantification folder and number of pseudoaligned reads of
+		each sample, None for samples without any
+	"""
+	index = index or samples[0]["index"]
+	paired = samples[0]["fastq2"] is not None
+	if not os.path.exists(workdir):
+		os.makedirs(workdir)
+
+	with open(os.path.join(workdir, "batch.txt"), "w") as out:
+		for i, sample in enumerate(samples):
+			out.write("\t".join([str(i), sample["fastq1"]] + ([sample["fastq2"]] if paired else [])) + "\n")
+	cmd = [kallisto, "bus", "-x", "bulk", "-i", index, "-o", workdir, "-t", str(cores),
+		"--batch", os.path.join(workdir, "batch.txt")]
+	if paired:
+		cmd.append("--paired")
+	_run(cmd)
+
+	bus = os.path.join(workdir, "output.s.bus")
+	_run([bustools, "sort", "-t", str(cores), "-o", bus, os.path.join(workdir, "output.bus")])
+	# Count equivalence classes, not genes: each transcript is its own gene.
+	t2g = os.path.join(workdir, "t2g.txt")
+	with open(os.path.join(workdir, "transcripts.txt")) as handle, open(t2g, "w") as out:
+		for line in handle:
+			out.write("{0}\t{0}\n".format(line.strip()))
+	count = os.path.join(workdir, "count")
+	_run([bustools, "count", "--cm", "-m", "-t", os.path.join(workdir, "transcripts.txt"),
+		"-e", os.path.join(workdir, "matrix.ec"), "-g", t2g, "-o", count, bus])
+
+	quant = os.path.join(workdir, "quant")
+	cmd = [kallisto, "quant-tcc", "-t", str(cores), "-i", index, "-e", count + ".ec.txt", "-o", quant]
+	if paired:
+		cmd += ["-f", os.path.join(workdir, "flens.txt")]
+	else:
+		cmd += ["-l", samples[0]["fragment_length"], "-s", samples[0]["fragment_length_sdev"]]
+	_run(cmd + ["--matrix-to-directories", count + ".mtx"])
+
+	# Matrix rows, and the folders of quant-tcc, follow the barcode list.
+	with open(count + ".barcodes") as handle:
+		rows = [_barcode_index(line.strip()) for line in handle if line.strip()]
+	folders = sorted((d for d in os.listdir(quant) if re.match(r"abundance_\d+$", d)),
+		key=lambda d: int(d.split("_")[1]))
+	if len(folders) != len(rows):
+		raise Exception("kallisto quant-tcc wrote {} samples for {} barcodes in {}".format(
+			len(folders), len(rows), quant))
+	row, _, value = read_mtx(count + ".mtx")
+	pseudoaligned = np.bincount(row, value, len(rows))
+
+	results = [None] * len(samples)
+	for row, folder, n in zip(rows, folders, pseudoaligned):
+		results[row] = (os.path.join(quant, folder), n)
+	return results
+
+
+def report_stats(stats_file, n_processed, n_pseudoaligned):
+	"""
+	Add the read counts of a sample to the stats file of its pipeline run, in
+	the key, value and annotation lines of pm.report_result.
+	"""
+	rate = round(100.0 * n_pseudoaligned / n_processed, 1) if n_processed else 0.0
+	with open(stats_file, "a") as out:
+		fcntl.flock(out, fcntl.LOCK_EX)
+		for key, value in [("Kallisto_processed_reads", n_processed),
+				("Kallisto_pseudoaligned_reads", int(n_pseudoaligned)), ("Kallisto_pseudoaligned_rate", rate)]:
+			out.write("{}\t{}\t{}\n".format(key, value, "kallisto_batch"))
+		out.flush()
+		fcntl.flock(out, fcntl.LOCK_UN)
+
+
+def write_sample(sample, folder, n_pseudoaligned, run_info, bootstraps=()):
+	"""
+	Write the quantification of one sample as kallisto quant would have, and
+	report its read counts to the sample's stats file.
+	"""
+	ids, lengths, eff_lengths, est_counts, _ = kallisto_h5.read_tsv(os.path.join(folder, "abundance.tsv"))
+	n_processed = count_reads(sample["fastq1"])
+	aux = {
+		"num_processed": [n_processed],
+		"kallisto_version": [run_info.get("kallisto_version", "")],
+		"index_version": [run_info.get("index_version", 0)],
+		"start_time": [run_info.get("start_time", "")],
+		"call": [run_info.get("call", "")]}
+	outdir = sample["outdir"]
+	if not os.path.exists(outdir):
+		os.makedirs(outdir)
+	kallisto_h5.write_tsv(os.path.join(outdir, "abundance.tsv"), ids, lengths, eff_lengths, est_counts)
+	kallisto_h5.write_run_info(os.path.join(outdir, "run_info.json"), len(ids), len(bootstraps),
+		n_processed, n_pseudoaligned, run_info)
+	# Last, as it marks the sample as done.
+	kallisto_h5.write_abundance(os.path.join(outdir, "abundance.h5"), ids, lengths, eff_lengths, est_counts,
+		bootstraps, aux)
+	if sample.get("stats_file"):
+		report_stats(sample["stats_file"], n_processed, n_pseudoaligned)
+
+
+def kallisto_batch(batch, cores=1, kallisto="kallisto", bustools="bustools", clean=False, force=False,
+		stager=None):
+	"""
+	Quantify the samples of a batch file that have not been quantified yet.
+
+	:param str batch: batch file
+	:param int cores: number of threads
+	:param bool clean: remove the reads of a sample once it is quantified
+	:param bool force: quantify samples again
+	:param resource_staging.ResourceStager stager: stages the indexes on
+		node-local scratch
+	:return int: number of samples that could not be quantified
+	"""
+	groups = OrderedDict()
+	for sample in read_batch(batch):
+		if force or not os.path.exists(os.path.join(sample["outdir"], "abundance.h5")):
+			key = (sample["index"], sample["fastq2"] is not None,
+				sample["fragment_length"], sample["fragment_length_sdev"])
+			groups.setdefault(key, []).append(sample)
+
+	failed = 0
+	for i, samples in enumerate(groups.values()):
+		workdir = "{}.work{}_{}".format(batch, os.getpid(), i)
+		index = stager.stage(samples[0]["index"]) if stager is not None else None
+		results = quantify_group(samples, workdir, cores, kallisto, bustools, index)
+		with open(os.path.join(workdir, "run_info.json")) as handle:
+			run_info = json.load(handle)
+		for sample, result in zip(samples, results):
+			if result is None:
+				print("No reads pseudoaligned for sample " + sample["sample_name"])
+				failed += 1
+				continue
+			write_sample(sample, result[0], result[1], run_info)
+			if clean:
+				for fastq in filter(None, (sample["fastq1"], sample["fastq2"])):
+					try:
+						os.remove(fastq)
+					except OSError as e:
+						if e.errno != errno.ENOENT:
+							raise
+		shutil.rmtree(workdir)
+		print("Quantified {} samples against {}".format(len(samples), samples[0]["index"]))
+	return failed
+
+
+if __name__ == "__main__":
+	parser = ArgumentParser(description="Quantify a batch of samples with kallisto, loading each index once.")
+	parser.add_argument("-b", "--batch", dest="batch", required=True, help="Batch file written by rnaKallisto.py --kallisto-batch.")
+	parser.add_argument("-p", "--cores", dest="cores", type=int, default=1, help="Number of threads.")
+	parser.add_argument("--clean", dest="clean", action="store_true", default=False,
+		help="Remove the trimmed reads of each sample once it is quantified.")
+	parser.add_argument("-f", "--force", dest="force", action="store_true", default=False,
+		help="Quantify samples that already have results again.")
+	parser.add_argument("--kallisto", dest="kallisto", default="kallisto", help="Path to kallisto.")
+	parser.add_argument("--bustools", dest="bustools", default="bustools", help="Path to bustools.")
+	parser.add_argument("--stage-resources", dest="stage_resources",
+		help="Node-local scratch folder to copy the kallisto indexes to, once per node.")
+	parser.add_argument("--stage-resources-size", dest="stage_resources_size", type=float, default=200,
+		help="Maximum size of the staged resources, in GB; least recently used assemblies are evicted.")
+	parser.add_argument("--genomes", dest="genomes",
+		help="Genomes folder of the indexes, as in the pipeline config; needed with --stage-resources.")
+	args = parser.parse_args()
+	stager = None
+	if args.stage_resources:
+		if not args.genomes:
+			parser.error("--stage-resources needs --genomes")
+		sys.path.append(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+		import resource_staging
+		stager = resource_staging.ResourceStager(args.stage_resources, args.genomes, args.stage_resources_size)
+	sys.exit(kallisto_batch(args.batch, args.cores, args.kallisto, args.bustools, args.clean, args.force,
+		stager) > 0)
@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+"""
+kallisto quantification with bootstraps spread over concurrent kallisto runs.
+
+kallisto quant -b runs every bootstrap EM after the main one within one
+call, which dominates the run time of a sample from about a hundred
+bootstraps on. Here the bootstraps are split into shards, each run by a
+kallisto quant of its own, all at the same time, shard i with seed + i. All
+runs pseudoalign the same reads and fit them with the same EM, so their main
+estimates are the same; those of the first shard are kept, with the
+bootstraps of all shards, in one abundance.h5 in kallisto's layout, plus
+abundance.tsv, bs_abundance_<n>.tsv and run_info.json as kallisto quant and
+h5dump write them.
+
+The bootstraps are kallisto's own, with its bias correction; only, drawn
+from one random sequence per shard, they are not the same draws as those of
+a single kallisto quant -b run with the same seed.
+
+Each run loads the index and pseudoaligns the reads again, so the shards
+take that much more memory and CPU time; pick their number (-j) to fit the
+job's memory.
+
+Usage: kallisto_bootstrap.py -i <index.idx> -o <output folder> -b <n> [-l length -s sdev] [-p cores] [-j shards] <R1.fastq> [<R2.fastq>]
+"""
+
+import json
+import os
+import shutil
+import subprocess
+import sys
+from argparse import ArgumentParser
+
+import numpy as np
+
+import kallisto_h5
+
+
+def shard_bounds(n_boot, shards):
+	"""
+	:return list: first and last (excluded) bootstrap of each shard
+	"""
+	bounds = np.linspace(0, n_boot, max(1, min(shards, n_boot)) + 1).astype(int)
+	return [(first, last) for first, last in zip(bounds[:-1], bounds[1:]) if last > first]
+
+
+def merge_shards(folders, outdir):
+	"""
+	Merge the abundance.h5 files of kallisto runs of the same reads into one,
+	with the estimates and run information of the first run and the
+	bootstraps of all, in the order of the runs.
+
+	:param list folders: output folders of the runs
+	:param str outdir: output folder of the merged result
+	:return int: number of bootstraps
+	"""
+	main = kallisto_h5.read_abundance(os.path.join(folders[0], "abundance.h5"))
+	bootstraps = [main["bootstraps"]] + [
+		kallisto_h5.read_abundance(os.path.join(folder, "abundance.h5"))["bootstraps"] for folder in folders[1:]]
+	bootstraps = np.concatenate(bootstraps)
+	with open(os.path.join(folders[0], "run_info.json")) as handle:
+		run_info = json.load(handle)
+	run_info["n_bootstraps"] = len(bootstraps)
+	with open(os.path.join(outdir, "run_info.json"), "w") as out:
+		json.dump(run_info, out, indent=1, sort_keys=True)
+		out.write("\n")
+	kallisto_h5.write_abundance(os.path.join(outdir, "abundance.h5"), main["ids"], main["lengths"],
+		main["eff_lengths"], main["est_counts"], bootstraps, main["aux"])
+	kallisto_h5.dump(os.path.join(outdir, "abundance.h5"), outdir, bootstraps=True)
+	return len(bootstraps)
+
+
+def kallisto_bootstrap(index, outdir, fastqs, n_boot, fragment_length=None, fragment_length_sdev=None,
+		cores=1, shards=None, seed=42, kallisto="kallisto"):
+	"""
+	Quantify a sample, running its bootstraps in concurrent kallisto runs.
+
+	:param str index: kallisto index
+	:param str outdir: output folder
+	:param list fastqs: reads, one file or both mates
+	:param int n_boot: number of bootstraps
+	:param int cores: number of threads of all runs together
+	:param int shards: number of kallisto runs, default one per core
+	:param int seed: seed of the first shard
+	"""
+	bounds = shard_bounds(n_boot, shards or cores)
+	workdir = os.path.join(outdir, "tmp_bootstrap")
+	procs = []
+	for i, (first, last) in enumerate(bounds):
+		folder = os.path.join(workdir, "shard" + str(i))
+		if not os.path.exists(folder):
+			os.makedirs(folder)
+		threads = cores // len(bounds) + (i < cores % len(bounds))
+		cmd = [kallisto, "quant", "-i", index, "-o", folder, "-b", str(last - first),
+			"--seed", str(seed + i), "-t", str(max(1, threads))]
+		if len(fastqs) == 1:
+			cmd += ["--single", "-l", str(fragment_length), "-s", str(fragment_length_sdev)]
+		cmd += fastqs
+		print(" ".join(cmd))
+		sys.stdout.flush()
+		procs.append(subprocess.Popen(cmd))
+	failed = [i for i, proc in enumerate(procs) if proc.wait() != 0]
+	if failed:
+		raise Exception("kallisto quant failed for {} of {} bootstrap shards".format(len(failed), len(procs)))
+
+	if not os.path.exists(outdir):
+		os.makedirs(outdir)
+	merge_shards([os.path.join(workdir, "shard" + str(i)) for i in range(len(bounds))], outdir)
+	shutil.rmtree(workdir)
+
+
+if __name__ == "__main__":
+	parser = ArgumentParser(description="kallisto quantification with bootstraps in concurrent kallisto runs.")
+	parser.add_argument("-i", "--index", dest="index", required=True, help="kallisto index.")
+	parser.add_argument("-o", "--output-dir", dest="outdir", required=True, help="Output folder.")
+	parser.add_argument("-b", "--bootstrap-samples", dest="n_boot", type=int, default=1, help="Number of bootstraps.")
+	parser.add_argument("-l", "--fragment-length", dest="fragment_length", type=float, default=None,
+		help="Mean fragment length, for single-end reads.")
+	parser.add_argument("-s", "--sd", dest="fragment_length_sdev", type=float, default=None,
+		help="Fragment length standard deviation, for single-end reads.")
+	parser.add_argument("-p", "--cores", dest="cores", type=int, default=1, help="Number of threads of all runs.")
+	parser.add_argument("-j", "--shards", dest="shards", type=int, default=None,
+		help="Number of kallisto runs, each loading the index; default one per core.")
+	parser.add_argument("--seed", dest="seed", type=int, default=42, help="Seed of the first shard.")
+	parser.add_argument("--kallisto", dest="kallisto", default="kallisto", help="Path to kallisto.")
+	parser.add_argument("fastqs", nargs="+", help="Reads: one file, or one file per mate.")
+	args = parser.parse_args()
+	if len(args.fastqs) == 1 and (args.fragment_length is None or args.fragment_length_sdev is None):
+		parser.error("Single-end reads need -l and -s.")
+	if args.n_boot < 1:
+		parser.error("-b must be at least 1; use kallisto quant without bootstraps.")
+	sys.exit(kallisto_bootstrap(args.index, args.outdir, args.fastqs, args.n_boot,
+		args.fragment_length, args.fragment_length_sdev, args.cores, args.shards, args.seed, args.kallisto))
@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+"""
+Read and write kallisto abundance.h5 files.
+
+Files are written in the layout of kallisto quant: est_counts at the root,
+targets and run information under /aux and bootstrap estimates as
+/bootstrap/bs0, bs1, ..., so that kallisto h5dump and sleuth read them as
+they read kallisto's own. The command line dumps a file to abundance.tsv (and
+bs_abundance_<n>.tsv per bootstrap, with -b), as kallisto h5dump does.
+
+Usage: kallisto_h5.py -i <abundance.h5> -o <output folder> [-b]
+"""
+
+import json
+import os
+import sys
+from argparse import ArgumentParser
+
+import h5py
+import numpy as np
+
+
+TSV_HEADER = "target_id\tlength\teff_length\test_counts\ttpm\n"
+COMPRESSION = 6
+
+
+def tpm(est_counts, eff_lengths):
+	"""
+	Transcripts per million, as kallisto computes them.
+	"""
+	rho = np.divide(est_counts, eff_lengths, out=np.zeros(len(est_counts)), where=eff_lengths > 0)
+	total = rho.sum()
+	return rho * 1e6 / total if total > 0 else rho
+
+
+def _strings(values):
+	"""
+	:return numpy.ndarray: values as variable-length strings, the type kallisto
+		writes target names and run information with
+	"""
+	return np.array([v.decode() if isinstance(v, bytes) else str(v) for v in values], dtype=object)
+
+
+def read_abundance(path, bootstraps=True):
+	"""
+	:param str path: abundance.h5 file
+	:param bool bootstraps: read the bootstrap estimates too
+	:return dict: ids, lengths, eff_lengths, est_counts, bootstraps (one row
+		per bootstrap) and aux, the remaining /aux datasets
+	"""
+	with h5py.File(path, "r") as h5:
+		aux = h5["aux"]
+		abundance = {
+			"ids": np.array([i.decode() if isinstance(i, bytes) else i for i in aux["ids"][:]]),
+			"lengths": aux["lengths"][:],
+			"eff_lengths": aux["eff_lengths"][:],
+			"est_counts": h5["est_counts"][:],
+			"aux": dict((key, aux[key][:]) for key in aux if key not in ("ids", "lengths", "eff_lengths"))}
+		n_boot = int(aux["num_bootstrap"][0])
+		if bootstraps and n_boot:
+			abundance["bootstraps"] = np.array([h5["bootstrap/bs" + str(i)][:] for i in range(n_boot)])
+		else:
+			abundance["bootstraps"] = np.zeros((0, len(abundance["ids"])))
+	return abundance
+
+
+def write_abundance(path, ids, lengths, eff_lengths, est_counts, bootstraps=(), aux=None):
+	"""
+	Write an abundance.h5 file, replacing it atomically.
+
+	:param str path: abundance.h5 file
+	:param ids: target names
+	:param lengths: target lengths
+	:param eff_lengths: effective target lengths
+	:param est_counts: estimated counts
+	:param bootstraps: estimated counts of each bootstrap
+	:param dict aux: run information (num_processed, call, start_time,
+		kallisto_version, index_version, fld, bias_observed, bias_normalized);
+		missing entries are filled in as kallisto does for a run without them
+	"""
+	info = {
+		"num_processed": [0],
+		"index_version": [0],
+		"kallisto_version": ["0"],
+		"start_time": [""],
+		"call": [""],
+		"fld": np.zeros(1000, np.int32),
+		"bias_observed": np.zeros(4096, np.int32),
+		"bias_normalized": np.zeros(4096)}
+	info.update(aux or {})
+	info["num_bootstrap"] = [len(bootstraps)]
+
+	tmp = "{}.tmp{}".format(path, os.getpid())
+	with h5py.File(tmp, "w") as h5:
+		group = h5.create_group("aux")
+		group.create_dataset("ids", data=_strings(ids), dtype=h5py.string_dtype(),
+			compression="gzip", compression_opts=COMPRESSION)
+		group.create_dataset("lengths", data=np.asarray(lengths, np.int32), compression="gzip", compression_opts=COMPRESSION)
+		group.create_dataset("eff_lengths", data=np.asarray(eff_lengths, np.float64), compression="gzip", compression_opts=COMPRESSION)
+		for key, value in info.items():
+			value = np.asarray(value)
+			if value.dtype.kind in "USO":
+				group.create_dataset(key, data=_strings(value), dtype=h5py.string_dtype())
+				continue
+			if value.dtype.kind in "iu":
+				value = value.astype(np.int32)
+			group.create_dataset(key, data=value)
+		h5.create_dataset("est_counts", data=np.asarray(est_counts, np.float64), compression="gzip", compression_opts=COMPRESSION)
+		if len(bootstraps):
+			group = h5.create_group("bootstrap")
+			for i, counts in enumerate(bootstraps):
+				group.create_dataset("bs" + str(i), data=np.asarray(counts, np.float64),
+					compression="gzip", compression_opts=COMPRESSION)
+	os.rename(tmp, path)
+
+
+def read_tsv(path):
+	"""
+	:param str path: abundance.tsv file
+	:return (numpy.ndarray, ...): target names, lengths, effective lengths,
+		estimated counts and TPM
+	"""
+	table = np.genfromtxt(path, delimiter="\t", skip_header=1, dtype=None, encoding="utf-8",
+		names=["target_id", "length", "eff_length", "est_counts", "tpm"], ndmin=1)
+	return (table["target_id"].astype(str), table["length"].astype(np.int64),
+		table["eff_length"].astype(np.float64), table["est_counts"].astype(np.float64),
+		table["tpm"].astype(np.float64))
+
+
+def write_tsv(path, ids, lengths, eff_lengths, est_counts):
+	"""
+	Write an abundance.tsv file, as kallisto h5dump does.
+	"""
+	with open(path, "w") as out:
+		out.write(TSV_HEADER)
+		for row in zip(ids, lengths, eff_lengths, est_counts, tpm(est_counts, eff_lengths)):
+			out.write("{}\t{}\t{:g}\t{:g}\t{:g}\n".format(*row))
+
+
+def write_run_info(path, n_targets, n_bootstraps, n_processed, n_pseudoaligned, aux=None):
+	"""
+	Write a run_info.json file, as kallisto quant does.
+	"""
+	aux = aux or {}
+	info = {
+		"n_targets": int(n_targets),
+		"n_bootstraps": int(n_bootstraps),
+		"n_processed": int(n_processed),
+		"n_pseudoaligned": int(n_pseudoaligned),
+		"p_pseudoaligned": round(100.0 * n_pseudoaligned / n_processed, 1) if n_processed else 0.0,
+		"kallisto_version": aux.get("kallisto_version", ""),
+		"index_version": aux.get("index_version", 0),
+		"start_time": aux.get("start_time", ""),
+		"call": aux.get("call", "")}
+	with open(path, "w") as out:
+		json.dump(info, out, indent=1, sort_keys=True)
+		out.write("\n")
+
+
+def dump(path, outdir, bootstraps=False):
+	"""
+	Write the tables of an abundance.h5 file into a folder.
+	"""
+	abundance = read_abundance(path, bootstraps)
+	write_tsv(os.path.join(outdir, "abundance.tsv"), abundance["ids"], abundance["lengths"],
+		abundance["eff_lengths"], abundance["est_counts"])
+	for i, counts in enumerate(abundance["bootstraps"]):
+		write_tsv(os.path.join(outdir, "bs_abundance_{}.tsv".format(i)), abundance["ids"],
+			abundance["lengths"], abundance["eff_lengths"], counts)
+
+
+if __name__ == "__main__":
+	parser = ArgumentParser(description="Dump a kallisto abundance.h5 file.")
+	parser.add_argument("-i", "--input", dest="h5", required=True, help="abundance.h5 file.")
+	parser.add_argument("-o", "--output-dir", dest="outdir", default=".", help="Output folder.")
+	parser.add_argument("-b", "--bootstraps", dest="bootstraps", action="store_true", default=False,
+		help="Also write one table per bootstrap.")
+	args = parser.parse_args()
+	sys.exit(dump(args.h5, args.outdir, args.bootstraps))
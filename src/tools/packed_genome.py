@@ -0,0 +1,240 @@
+#!/usr/bin/env python
+"""
+2-bit packed genome store.
+
+Builds a UCSC .2bit file next to a refgenie <assembly>.fa and gives random
+access to it through mmap, so that every process on a host reading the same
+assembly shares the same page-cache pages instead of loading the fasta.
+Lookups go through a per-contig offset index and only unpack the bytes of the
+requested slice.
+
+Lowercase (soft-masked) bases are stored uppercase; N and any other non-ACGT
+bases are stored as N blocks.
+
+Usage: packed_genome.py -f <assembly>.fa [-o <assembly>.2bit]
+"""
+
+import mmap
+import os
+import shutil
+import struct
+import sys
+from argparse import ArgumentParser
+
+import numpy as np
+
+
+SIGNATURE = 0x1A412743
+BASES = np.frombuffer(b"TCAG", dtype=np.uint8)
+SHIFTS = np.array([6, 4, 2, 0], dtype=np.uint8)
+N = ord("N")
+
+CODES = np.zeros(256, dtype=np.uint8)
+IS_BASE = np.zeros(256, dtype=bool)
+for _code, _base in enumerate("TCAG"):
+	for _b in (_base, _base.lower()):
+		CODES[ord(_b)] = _code
+		IS_BASE[ord(_b)] = True
+
+
+def default_path(fasta):
+	"""
+	Path of the packed store for a fasta file: <assembly>.fa -> <assembly>.2bit
+	"""
+	return os.path.splitext(fasta)[0] + ".2bit"
+
+
+class PackedGenome(object):
+	"""
+	Memory-mapped, read-only view of a .2bit file.
+
+	Sequences are returned as uint8 arrays of uppercase ASCII bases.
+	"""
+
+	def __init__(self, path):
+		self.path = path
+		with open(path, "rb") as handle:
+			self._mm = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+
+		self._endian = "<"
+		signature, version, count, _ = struct.unpack_from("<IIII", self._mm, 0)
+		if signature != SIGNATURE:
+			self._endian = ">"
+			signature, version, count, _ = struct.unpack_from(">IIII", self._mm, 0)
+			if signature != SIGNATURE:
+				raise ValueError("Not a .2bit file: " + path)
+		offset_format = self._endian + ("Q" if version == 1 else "I")
+
+		self._offsets = {}
+		pos = 16
+		for _ in range(count):
+			name_size = struct.unpack_from("B", self._mm, pos)[0]
+			name = self._mm[pos + 1:pos + 1 + name_size].decode()
+			pos += 1 + name_size
+			self._offsets[name] = struct.unpack_from(offset_format, self._mm, pos)[0]
+			pos += struct.calcsize(offset_format)
+		self._records = {}
+
+	def __contains__(self, chrom):
+		return _name(chrom) in self._offsets
+
+	def __iter__(self):
+		return iter(self._offsets)
+
+	def _record(self, chrom):
+		"""
+		Size, N blocks and packed sequence offset of a contig, parsed on first use.
+		"""
+		chrom = _name(chrom)
+		try:
+			return self._records[chrom]
+		except KeyError:
+			pass
+		pos = self._offsets[chrom]
+		size, n_count = struct.unpack_from(self._endian + "II", self._mm, pos)
+		pos += 8
+		blocks = np.frombuffer(self._mm, dtype=self._endian + "u4", count=2 * n_count, offset=pos)
+		n_starts = blocks[:n_count].astype(np.int64)
+		n_ends = n_starts + blocks[n_count:]
+		pos += 8 * n_count
+		mask_count = struct.unpack_from(self._endian + "I", self._mm, pos)[0]
+		pos += 4 + 8 * mask_count + 4
+		record = self._records[chrom] = (size, n_starts, n_ends, pos)
+		return record
+
+	def length(self, chrom):
+		"""
+		Length of a contig.
+		"""
+		return self._record(chrom)[0]
+
+	def fetch(self, chrom, start, end):
+		"""
+		Sequence of chrom[start:end], 0-based and clipped to the contig.
+
+		:param str chrom: contig name
+		:param int start: start position, inclusive
+		:param int end: end position, exclusive
+		:return numpy.ndarray: uint8 array of ASCII bases
+		"""
+		size, n_starts, n_ends, offset = self._record(chrom)
+		start, end = max(start, 0), min(end, size)
+		if end <= start:
+			return np.zeros(0, dtype=np.uint8)
+
+		first = start // 4
+		packed = np.frombuffer(self._mm, dtype=np.uint8, count=(end + 3) // 4 - first, offset=offset + first)
+		codes = ((packed[:, None] >> SHIFTS) & 3).ravel()
+		seq = BASES[codes[start - 4 * first:end - 4 * first]]
+
+		i = np.searchsorted(n_ends, start, side="right")
+		j = np.searchsorted(n_starts, end, side="left")
+		for n_start, n_end in zip(n_starts[i:j], n_ends[i:j]):
+			seq[max(n_start, start) - start:min(n_end, end) - start] = N
+		return seq
+
+	def close(self):
+		self._mm.close()
+
+
+def _name(chrom):
+	return chrom if isinstance(chrom, str) else chrom.decode()
+
+
+def _read_fasta(fasta):
+	"""
+	Yield (name, sequence bytes) of each record of a fasta file.
+	"""
+	name, parts = None, []
+	with open(fasta, "rb") as handle:
+		for line in handle:
+			if line.startswith(b">"):
+				if name is not None:
+					yield name, b"".join(parts)
+				name, parts = line[1:].split()[0], []
+			else:
+				parts.append(line.rstrip())
+	if name is not None:
+		yield name, b"".join(parts)
+
+
+def _pack(seq):
+	"""
+	Encode a sequence as a .2bit record: size, N blocks, no mask blocks,
+	reserved word and the packed bases.
+	"""
+	seq = np.frombuffer(seq, dtype=np.uint8)
+	is_n = ~IS_BASE[seq]
+	edges = np.diff(np.concatenate([[0], is_n.astype(np.int8), [0]]))
+	n_starts = np.flatnonzero(edges == 1)
+	n_sizes = np.flatnonzero(edges == -1) - n_starts
+
+	codes = CODES[seq]
+	codes = np.concatenate([codes, np.zeros(-len(codes) % 4, dtype=np.uint8)]).reshape(-1, 4)
+	packed = (codes[:, 0] << 6) | (codes[:, 1] << 4) | (codes[:, 2] << 2) | codes[:, 3]
+
+	record = struct.pack("<II", len(seq), len(n_starts))
+	record += n_starts.astype("<u4").tobytes() + n_sizes.astype("<u4").tobytes()
+	record += struct.pack("<II", 0, 0)
+	return record + packed.astype(np.uint8).tobytes()
+
+
+def build(fasta, output=None):
+	"""
+	Build the .2bit store of a fasta file.
+
+	The file is written under a temporary name and moved into place when
+	complete, so concurrent builders and readers never see a partial store.
+
+	:param str fasta: path to the fasta file
+	:param str output: path of the store, <assembly>.2bit by default
+	:return str: path of the store
+	"""
+	output = output or default_path(fasta)
+	tmp = "{}.tmp{}".format(output, os.getpid())
+
+	names, offsets = [], []
+	with open(tmp + ".data", "wb") as data:
+		for name, seq in _read_fasta(fasta):
+			names.append(name)
+			offsets.append(data.tell())
+			data.write(_pack(seq))
+		data_size = data.tell()
+
+	index_size = sum(1 + len(name) + 4 for name in names)
+	header_size = 16 + index_size
+	version = 0 if header_size + data_size < 2 ** 32 else 1
+	if version == 1:
+		index_size += 4 * len(names)
+		header_size += 4 * len(names)
+
+	with open(tmp, "wb") as out:
+		out.write(struct.pack("<IIII", SIGNATURE, version, len(names), 0))
+		for name, offset in zip(names, offsets):
+			out.write(struct.pack("B", len(name)) + name)
+			out.write(struct.pack("<Q" if version == 1 else "<I", header_size + offset))
+		with open(tmp + ".data", "rb") as data:
+			shutil.copyfileobj(data, out, 1 << 24)
+	os.remove(tmp + ".data")
+	os.rename(tmp, output)
+	return output
+
+
+def open_genome(genome_dir, genome):
+	"""
+	Open the packed store of a refgenie assembly, <genome_dir>/<genome>.2bit.
+	"""
+	path = os.path.join(genome_dir, genome + ".2bit")
+	if not os.path.exists(path):
+		raise IOError("Packed genome not found: {}; build it with packed_genome.py -f {}".format(
+			path, os.path.join(genome_dir, genome + ".fa")))
+	return PackedGenome(path)
+
+
+if __name__ == "__main__":
+	parser = ArgumentParser(description="Build a 2-bit packed genome store.")
+	parser.add_argument("-f", "--fasta", dest="fasta", required=True, help="Genome fasta file.")
+	parser.add_argument("-o", "--output", dest="output", default=None,
+		help="Output .2bit file; default: next to the fasta file.")
+	args = parser.parse_args()
+	sys.stdout.write(build(args.fasta, args.output) + "\n")
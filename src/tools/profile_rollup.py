@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+"""
+Project-level rollup of the stage profiles of the samples.
+
+Reads the stage_profile.json a pipeline run with --profile leaves in each
+sample folder and sums them up per pipeline and stage: how many samples ran
+the stage, median and maximum wall time, total CPU time, mean cores used,
+and the maximum peak memory, threads, and data read and written. The peak
+memory of a stage across samples is what a job running it has to ask for.
+
+Usage: profile_rollup.py [-o rollup.tsv] <project results folder | sample folder | stage_profile.json> ...
+"""
+
+import json
+import os
+import sys
+from argparse import ArgumentParser
+
+
+PROFILE_JSON = "stage_profile.json"
+COLUMNS = ["pipeline", "stage", "samples", "wall_s_median", "wall_s_max", "cpu_s_total",
+	"cores_mean", "peak_rss_mb_max", "threads_max", "read_mb_max", "write_mb_max"]
+
+
+def profile_files(paths):
+	"""
+	:param list paths: profile files, sample folders or folders of sample
+		folders
+	:return list: profile files found
+	"""
+	found = []
+	for path in paths:
+		if os.path.isfile(path):
+			found.append(path)
+		elif os.path.isfile(os.path.join(path, PROFILE_JSON)):
+			found.append(os.path.join(path, PROFILE_JSON))
+		elif os.path.isdir(path):
+			for name in sorted(os.listdir(path)):
+				if os.path.isfile(os.path.join(path, name, PROFILE_JSON)):
+					found.append(os.path.join(path, name, PROFILE_JSON))
+	return found
+
+
+def median(values):
+	values = sorted(values)
+	middle = len(values) // 2
+	return values[middle] if len(values) % 2 else (values[middle - 1] + values[middle]) / 2.0
+
+
+def rollup(files):
+	"""
+	:return list: one row per pipeline and stage, slowest total CPU first
+	"""
+	stages = {}
+	for path in files:
+		with open(path) as handle:
+			profile = json.load(handle)
+		for row in profile["stages"]:
+			stages.setdefault((profile.get("pipeline", ""), row["stage"]), []).append(row)
+	rows = []
+	for (pipeline, stage), runs in stages.items():
+		rows.append({"pipeline": pipeline, "stage": stage, "samples": len(runs),
+			"wall_s_median": median([run["wall_s"] for run in runs]),
+			"wall_s_max": max(run["wall_s"] for run in runs),
+			"cpu_s_total": round(sum(run["cpu_s"] for run in runs), 1),
+			"cores_mean": round(sum(run["cores"] for run in runs) / len(runs), 2),
+			"peak_rss_mb_max": max(run["peak_rss_mb"] for run in runs),
+			"threads_max": max(run["threads"] for run in runs),
+			"read_mb_max": max(run["read_mb"] for run in runs),
+			"write_mb_max": max(run["write_mb"] for run in runs)})
+	rows.sort(key=lambda row: (row["pipeline"], -row["cpu_s_total"]))
+	return rows
+
+
+def write_tsv(out, rows):
+	out.write("\t".join(COLUMNS) + "\n")
+	for row in rows:
+		out.write("\t".join(str(row[column]) for column in COLUMNS) + "\n")
+
+
+if __name__ == "__main__":
+	parser = ArgumentParser(description="Project-level rollup of the stage profiles of the samples.")
+	parser.add_argument("-o", "--output", dest="output", default=None,
+		help="Rollup table to write, instead of stdout.")
+	parser.add_argument("paths", nargs="+",
+		help="Project results folders, sample folders or stage_profile.json files.")
+	args = parser.parse_args()
+	files = profile_files(args.paths)
+	if not files:
+		sys.exit("No " + PROFILE_JSON + " found; run the pipelines with --profile.")
+	if args.output:
+		with open(args.output, "w") as out:
+			write_tsv(out, rollup(files))
+	else:
+		write_tsv(sys.stdout, rollup(files))
@@ -0,0 +1,303 @@
+#!/usr/bin/env python
+"""
+Distribution of aligned reads over gene model regions.
+
+Takes the place of RSeQC read_distribution.py and writes the same report.
+Regions are derived from a BED12 gene model as RSeQC does: CDS exons, 5' and
+3' UTR exons, introns, and 1, 5 and 10kb upstream of the TSS and downstream of
+the TES, merged per class and each cleared of the classes before it. Every
+aligned block of a read ("tag") is assigned by its midpoint, CDS first.
+
+The regions are built once per gene model and cached as numpy arrays in
+<model>.regions.npz, next to the model or, if that folder is not writable,
+in ~/.cache/rnapipe. The BAM file is counted per chromosome by a pool of
+worker processes.
+
+Usage: read_distribution.py -i <file_sorted.bam> -r <model.bed> [-p cores]
+"""
+
+import array
+import hashlib
+import multiprocessing
+import os
+import re
+import subprocess
+import sys
+from argparse import ArgumentParser
+
+import numpy as np
+
+
+CIGAR_RE = re.compile(b"(\\d+)([MIDNSHP=X])")
+# unmapped, secondary, QC fail, duplicate
+SKIP_FLAGS = "0x704"
+
+REGIONS = ["CDS_Exons", "5'UTR_Exons", "3'UTR_Exons", "Introns",
+	"TSS_up_1kb", "TSS_up_5kb", "TSS_up_10kb", "TES_down_1kb", "TES_down_5kb", "TES_down_10kb"]
+FLANKS = [1000, 5000, 10000]
+# As in RSeQC, each class is cleared of the regions of higher priority,
+# except that 5' and 3' UTRs are left to overlap.
+SUBTRACTED = {
+	"5'UTR_Exons": REGIONS[:1],
+	"3'UTR_Exons": REGIONS[:1],
+	"Introns": REGIONS[:3]}
+for _region in REGIONS[4:]:
+	SUBTRACTED[_region] = REGIONS[:4]
+
+
+def _merge(starts, ends):
+	"""
+	Union of intervals, as sorted, non-overlapping starts and ends.
+	"""
+	if len(starts) == 0:
+		return np.zeros(0, np.int64), np.zeros(0, np.int64)
+	order = np.argsort(starts, kind="mergesort")
+	starts, ends = starts[order], np.maximum.accumulate(ends[order])
+	new = np.flatnonzero(np.concatenate([[True], starts[1:] > ends[:-1]]))
+	return starts[new], ends[np.concatenate([new[1:] - 1, [len(ends) - 1]])]
+
+
+def _contains(regions, positions):
+	"""
+	Whether each position lies in one of a set of merged regions.
+	"""
+	starts, ends = regions
+	if len(starts) == 0:
+		return np.zeros(len(positions), dtype=bool)
+	i = np.searchsorted(starts, positions, side="right") - 1
+	return (i >= 0) & (positions < ends[np.maximum(i, 0)])
+
+
+def _subtract(a, b):
+	"""
+	Merged regions a minus merged regions b.
+	"""
+	if len(a[0]) == 0 or len(b[0]) == 0:
+		return a
+	points = np.unique(np.concatenate(a + b))
+	starts, ends = points[:-1], points[1:]
+	keep = _contains(a, starts) & ~_contains(b, starts)
+	return _merge(starts[keep], ends[keep])
+
+
+def parse_bed12(bed):
+	"""
+	Yield (chrom, strand, tx start, tx end, cds start, cds end, exon starts,
+	exon ends) of each transcript of a BED12 file.
+	"""
+	with open(bed) as handle:
+		for line in handle:
+			if line.startswith(("#", "track", "browser")):
+				continue
+			fields = line.split()
+			if len(fields) < 12:
+				continue
+			tx_start = int(fields[1])
+			sizes = np.array(fields[10].rstrip(",").split(","), dtype=np.int64)
+			starts = tx_start + np.array(fields[11].rstrip(",").split(","), dtype=np.int64)
+			yield (fields[0], fields[5], tx_start, int(fields[2]), int(fields[6]), int(fields[7]),
+				starts, starts + sizes)
+
+
+def build_regions(bed):
+	"""
+	Regions of each class of a BED12 gene model.
+
+	:return dict: region class -> chromosome -> (starts, ends) arrays
+	"""
+	raw = dict((region, {}) for region in REGIONS)
+
+	def add(region, chrom, starts, ends):
+		raw[region].setdefault(chrom, []).append((np.asarray(starts, np.int64), np.asarray(ends, np.int64)))
+
+	for chrom, strand, tx_start, tx_end, cds_start, cds_end, starts, ends in parse_bed12(bed):
+		if cds_start != cds_end:
+			cds = (ends >= cds_start) & (starts <= cds_end)
+			add("CDS_Exons", chrom, np.maximum(starts[cds], cds_start), np.minimum(ends[cds], cds_end))
+		left, right = starts < cds_start, ends > cds_end
+		left_utr = (starts[left], np.minimum(ends[left], cds_start))
+		right_utr = (np.maximum(starts[right], cds_end), ends[right])
+		if strand == "-":
+			left_utr, right_utr = right_utr, left_utr
+		add("5'UTR_Exons", chrom, *left_utr)
+		add("3'UTR_Exons", chrom, *right_utr)
+		add("Introns", chrom, ends[:-1], starts[1:])
+		for size, up, down in zip(FLANKS, REGIONS[4:7], REGIONS[7:]):
+			before = ([max(tx_start - size, 0)], [tx_start])
+			after = ([tx_end], [tx_end + size])
+			if strand == "-":
+				before, after = after, before
+			add(up, chrom, *before)
+			add(down, chrom, *after)
+
+	regions = {}
+	for region in REGIONS:
+		regions[region] = dict((chrom, _merge(np.concatenate([s for s, _ in parts]),
+			np.concatenate([e for _, e in parts]))) for chrom, parts in raw[region].items())
+	for region in REGIONS[1:]:
+		for other in SUBTRACTED[region]:
+			for chrom in regions[region]:
+				if chrom in regions[other]:
+					regions[region][chrom] = _subtract(regions[region][chrom], regions[other][chrom])
+	return regions
+
+
+def cache_path(bed):
+	"""
+	Cache file of the regions of a gene model: next to it if its folder is
+	writable, else in ~/.cache/rnapipe.
+	"""
+	folder = os.path.dirname(os.path.abspath(bed))
+	name = os.path.basename(bed) + ".regions.npz"
+	if os.access(folder, os.W_OK):
+		return os.path.join(folder, name)
+	folder = os.path.join(os.path.expanduser("~"), ".cache", "rnapipe")
+	if not os.path.isdir(folder):
+		os.makedirs(folder)
+	digest = hashlib.md5(os.path.abspath(bed).encode()).hexdigest()[:8]
+	return os.path.join(folder, digest + "_" + name)
+
+
+def load_regions(bed):
+	"""
+	Path of the region cache of a gene model, built if it is missing or older
+	than the model.
+	"""
+	path = cache_path(bed)
+	stat = os.stat(bed)
+	signature = np.array([stat.st_mtime, stat.st_size], dtype=np.float64)
+	if os.path.exists(path):
+		with np.load(path) as cache:
+			if np.array_equal(cache["signature"], signature):
+				return path
+
+	arrays = {"signature": signature}
+	for region, chroms in build_regions(bed).items():
+		for chrom, (starts, ends) in chroms.items():
+			arrays[_key(region, chrom, "starts")] = starts
+			arrays[_key(region, chrom, "ends")] = ends
+	# np.savez appends .npz to names without it, so the temporary name keeps it.
+	tmp = "{}.tmp{}.npz".format(path[:-len(".npz")], os.getpid())
+	np.savez(tmp, **arrays)
+	os.rename(tmp, path)
+	return path
+
+
+def count_contig(job):
+	"""
+	Count the tags of one chromosome per region class.
+
+	:param tuple job: BAM file, chromosome, samtools, region cache
+	:return (int, numpy.ndarray): number of reads and tags per class,
+		followed by the number of unassigned tags
+	"""
+	bam, chrom, samtools, cache = job
+	with np.load(cache) as arrays:
+		regions = [(arrays[_key(region, chrom, "starts")], arrays[_key(region, chrom, "ends")])
+			if _key(region, chrom, "starts") in arrays.files else (np.zeros(0, np.int64), np.zeros(0, np.int64))
+			for region in REGIONS]
+
+	counts = np.zeros(len(REGIONS) + 1, dtype=np.int64)
+	reads = 0
+	mids = array.array("l")
+	proc = subprocess.Popen([samtools, "view", "-F", SKIP_FLAGS, bam, chrom], stdout=subprocess.PIPE)
+	for line in proc.stdout:
+		reads += 1
+		fields = line.split(b"\t", 6)
+		pos = int(fields[3]) - 1
+		for length, op in CIGAR_RE.findall(fields[5]):
+			length = int(length)
+			if op in b"M=X":
+				mids.append(pos + length // 2)
+				pos += length
+			elif op in b"DN":
+				pos += length
+		if len(mids) >= 1 << 20:
+			counts += _assign(regions, np.frombuffer(mids, dtype=np.int_))
+			mids = array.array("l")
+	if proc.wait() != 0:
+		raise Exception("samtools view failed on " + bam + " " + chrom)
+	counts += _assign(regions, np.frombuffer(mids, dtype=np.int_))
+	return reads, counts
+
+
+def _assign(regions, mids):
+	"""
+	Tags per region class of a set of tag midpoints, and the unassigned ones,
+	with the priorities of RSeQC read_distribution.py.
+	"""
+	inside = [_contains(r, mids) for r in regions]
+	cds, utr5, utr3, intron, up1, up5, up10, down1, down5, down10 = inside
+	counts = np.zeros(len(REGIONS) + 1, dtype=np.int64)
+	left = ~cds
+	counts[0] = cds.sum()
+	counts[1] = (left & utr5 & ~utr3).sum()
+	counts[2] = (left & utr3 & ~utr5).sum()
+	unassigned = (left & utr5 & utr3).sum()
+	left &= ~utr5 & ~utr3
+	counts[3] = (left & intron).sum()
+	left &= ~intron
+	unassigned += (left & up10 & down10).sum()
+	left &= ~(up10 & down10)
+	# Nearest flanks first, TSS before TES at each distance. Flanks are
+	# nested: a tag within 1kb is also within 5 and 10kb.
+	for i, flanks in enumerate(((up1, down1), (up5, down5), (up10, down10))):
+		for offset, flank in zip((4, 7), flanks):
+			hit = (left & flank).sum()
+			counts[offset + i:offset + 3] += hit
+			left &= ~flank
+	counts[-1] = unassigned + left.sum()
+	return counts
+
+
+def _key(region, chrom, field):
+	return "{}|{}|{}".format(region, chrom, field)
+
+
+def read_distribution(bam, bed, cores=1, samtools="samtools", out=sys.stdout):
+	"""
+	Count the tags of a sorted, indexed BAM file per region class and write
+	the report of RSeQC read_distribution.py.
+	"""
+	cache = load_regions(bed)
+	with np.load(cache) as arrays:
+		bases = dict((region, 0) for region in REGIONS)
+		for key in arrays.files:
+			if key.endswith("|starts"):
+				region = key.split("|", 1)[0]
+				bases[region] += int((arrays[key[:-len("starts")] + "ends"] - arrays[key]).sum())
+
+	idxstats = subprocess.check_output([samtools, "idxstats", bam]).decode()
+	jobs = [(bam, fields[0], samtools, cache) for fields in (line.split("\t") for line in idxstats.splitlines())
+		if len(fields) > 2 and fields[0] != "*" and int(fields[2]) > 0]
+	if cores > 1 and len(jobs) > 1:
+		pool = multiprocessing.Pool(min(cores, len(jobs)))
+		results = pool.map(count_contig, jobs, chunksize=1)
+		pool.close()
+		pool.join()
+	else:
+		results = [count_contig(job) for job in jobs]
+
+	reads = sum(r[0] for r in results)
+	counts = sum((r[1] for r in results), np.zeros(len(REGIONS) + 1, dtype=np.int64))
+	# Each flank count includes the tags of the narrower flanks.
+	tags = int(counts[:4].sum() + counts[6] + counts[9] + counts[-1])
+
+	out.write("%-30s%d\n" % ("Total Reads", reads))
+	out.write("%-30s%d\n" % ("Total Tags", tags))
+	out.write("%-30s%d\n" % ("Total Assigned Tags", tags - counts[-1]))
+	out.write("=" * 69 + "\n")
+	out.write("%-20s%-20s%-20s%-20s\n" % ("Group", "Total_bases", "Tag_count", "Tags/Kb"))
+	for region, count in zip(REGIONS, counts):
+		out.write("%-20s%-20d%-20d%-18.2f\n" % (region, bases[region], count, count * 1000.0 / (bases[region] + 1)))
+	out.write("=" * 69 + "\n")
+
+
+if __name__ == "__main__":
+	parser = ArgumentParser(description="Read distribution over gene model regions.")
+	parser.add_argument("-i", "--input", dest="bam", required=True, help="Sorted and indexed BAM file.")
+	parser.add_argument("-r", "--refgene", dest="bed", required=True, help="Gene model in BED12 format.")
+	parser.add_argument("-p", "--cores", dest="cores", type=int, default=1, help="Number of worker processes.")
+	parser.add_argument("--samtools", dest="samtools", default="samtools", help="Path to samtools.")
+	args = parser.parse_args()
+	read_distribution(args.bam, args.bed, args.cores, args.samtools)
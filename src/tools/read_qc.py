@@ -0,0 +1,275 @@
+#!/usr/bin/env python
+"""
+Read quality metrics of a fastq stream, computed on batches of reads.
+
+Meant to be teed into while the reads stream into the trimmer, so the
+metrics come without another read of the data: per-position quality
+distribution and base composition (N content included), read length, GC
+content and mean quality histograms, and k-mers overrepresented against
+the base composition of the reads. Each batch is turned into a few flat
+numpy arrays and counted with bincount; nothing is kept per read.
+
+The quality encoding is told from the range of quality characters seen, as
+detect_quality_code.py does. Results go to <prefix>_<name>_qc.json and a
+self-contained <prefix>_<name>_qc.html report. With two names, the records
+of the stream alternate between them (interleaved mates).
+
+Usage: <fastq stream> | read_qc.py -o <prefix> [-n R1 [R2]] [-c count file]
+"""
+
+import itertools
+import json
+import sys
+from argparse import ArgumentParser
+
+import numpy as np
+
+from detect_quality_code import RANGES, get_encodings_in_range
+
+
+BATCH_SIZE = 100000
+K = 7
+MIN_KMER_RATIO = 5
+MIN_KMER_COUNT = 20
+TOP_KMERS = 20
+
+# A, C, G, T and everything else (N)
+CODES = np.full(256, 4, np.uint8)
+for _i, _base in enumerate("ACGT"):
+	CODES[ord(_base)] = _i
+	CODES[ord(_base.lower())] = _i
+
+
+class ReadQC(object):
+	"""
+	Metrics of a set of reads, added to batch by batch.
+	"""
+
+	def __init__(self, k=K):
+		self.k = k
+		self.n_reads = 0
+		self.lengths = np.zeros(1, np.int64)
+		# Position by quality character and position by base.
+		self.quals = np.zeros((0, 128), np.int64)
+		self.bases = np.zeros((0, 5), np.int64)
+		self.gc = np.zeros(101, np.int64)
+		self.mean_quals = np.zeros(128, np.int64)
+		self.kmers = np.zeros(4 ** k, np.int64)
+
+	def _grow(self, length):
+		if length > len(self.quals):
+			self.quals = np.vstack([self.quals, np.zeros((length - len(self.quals), 128), np.int64)])
+			self.bases = np.vstack([self.bases, np.zeros((length - len(self.bases), 5), np.int64)])
+		if length >= len(self.lengths):
+			self.lengths = np.concatenate([self.lengths, np.zeros(length + 1 - len(self.lengths), np.int64)])
+
+	def add(self, seqs, quals):
+		"""
+		Add a batch of reads.
+
+		:param list seqs: sequences, as bytes
+		:param list quals: quality strings, as bytes
+		"""
+		lengths = np.array([len(s) for s in seqs], np.int64)
+		if not len(lengths):
+			return
+		self.n_reads += len(lengths)
+		self._grow(int(lengths.max()))
+		self.lengths += np.bincount(lengths, minlength=len(self.lengths))
+
+		seq = CODES[np.frombuffer(b"".join(seqs), np.uint8)]
+		qual = np.frombuffer(b"".join(quals), np.uint8) & 127
+		if len(qual) != len(seq):
+			raise Exception("Sequence and quality lengths differ in a batch of reads")
+		if not len(seq):
+			return
+		starts = np.cumsum(lengths) - lengths
+		pos = np.arange(len(seq)) - np.repeat(starts, lengths)
+		size = len(self.quals)
+		self.quals += np.bincount(pos * 128 + qual, minlength=size * 128).reshape(size, 128)
+		self.bases += np.bincount(pos * 5 + seq, minlength=size * 5).reshape(size, 5)
+
+		# Per-read sums; reduceat needs the empty reads left out.
+		full = lengths > 0
+		read_starts, read_lengths = starts[full], lengths[full]
+		gc = np.add.reduceat(((seq == 1) | (seq == 2)).astype(np.int64), read_starts)
+		acgt = np.add.reduceat((seq < 4).astype(np.int64), read_starts)
+		percent = np.round(100.0 * gc / np.maximum(acgt, 1)).astype(np.int64)
+		self.gc += np.bincount(percent[acgt > 0], minlength=101)
+		# Rounded half up, so that the shift by the phred offset comes later.
+		mean_qual = np.floor(np.add.reduceat(qual, read_starts, dtype=np.int64) / read_lengths.astype(float) + 0.5).astype(np.int64)
+		self.mean_quals += np.bincount(mean_qual, minlength=128)
+
+		# k-mers of all windows without N that end within their read.
+		n = len(seq) - self.k + 1
+		if n > 0:
+			code = np.zeros(n, np.int32)
+			for j in range(self.k):
+				code <<= 2
+				code |= seq[j:j + n] & 3
+			n_count = np.concatenate([[0], np.cumsum(seq == 4, dtype=np.int32)])
+			ends = np.repeat(starts + lengths, lengths)[:n]
+			valid = (np.arange(n) + self.k <= ends) & (n_count[self.k:] - n_count[:n] == 0)
+			self.kmers += np.bincount(code[valid], minlength=len(self.kmers))
+
+	def phred_offset(self):
+		"""
+		33 or 64, from the range of quality characters seen.
+		"""
+		seen = np.flatnonzero(self.quals.sum(axis=0))
+		if not len(seen):
+			return 33
+		valid = get_encodings_in_range(int(seen.min()), int(seen.max()), RANGES)
+		return 64 if valid == ["phred64"] else 33
+
+	def overrepresented_kmers(self):
+		"""
+		:return list: (k-mer, count, observed/expected) of k-mers seen at least
+			MIN_KMER_RATIO times more often than their bases make expected
+		"""
+		total = self.kmers.sum()
+		composition = self.bases[:, :4].sum(axis=0).astype(float)
+		if not total or not composition.sum():
+			return []
+		composition /= composition.sum()
+		# Probability of each k-mer code, built up base by base.
+		expected = np.ones(1)
+		for _ in range(self.k):
+			expected = np.outer(expected, composition).ravel()
+		expected *= total
+		ratio = np.divide(self.kmers, expected, out=np.zeros(len(expected)), where=expected > 0)
+		hits = np.flatnonzero((ratio >= MIN_KMER_RATIO) & (self.kmers >= MIN_KMER_COUNT))
+		hits = hits[np.argsort(-ratio[hits], kind="mergesort")][:TOP_KMERS]
+		return [(self._kmer(code), int(self.kmers[code]), round(float(ratio[code]), 2)) for code in hits]
+
+	def _kmer(self, code):
+		return "".join("ACGT"[(code >> (2 * (self.k - 1 - j))) & 3] for j in range(self.k))
+
+	def summary(self):
+		"""
+		:return dict: metrics, JSON-serializable
+		"""
+		offset = self.phred_offset()
+		bases = self.bases.sum(axis=0)
+		n_bases = int(bases.sum())
+		scores = np.arange(128) - offset
+		per_position = self.quals.sum(axis=1)
+		cumulative = np.cumsum(self.quals, axis=1)
+
+		def quantile(q):
+			index = (cumulative < (q * per_position)[:, None]).sum(axis=1)
+			return (np.minimum(index, 127) - offset).tolist()
+
+		return {
+			"reads": self.n_reads,
+			"bases": n_bases,
+			"phred_offset": offset,
+			"mean_length": round(float(n_bases) / self.n_reads, 2) if self.n_reads else 0,
+			"mean_quality": round(float((self.quals.sum(axis=0) * scores).sum()) / n_bases, 2) if n_bases else 0,
+			"gc_content": round(100.0 * (bases[1] + bases[2]) / max(bases[:4].sum(), 1), 2),
+			"n_content": round(100.0 * bases[4] / max(n_bases, 1), 4),
+			"length_histogram": self.lengths.tolist(),
+			"gc_histogram": self.gc.tolist(),
+			"mean_quality_histogram": dict((int(s), int(c)) for s, c in zip(scores, self.mean_quals) if c),
+			"position_quality": {
+				"mean": np.round(np.divide((self.quals * scores).sum(axis=1), per_position,
+					out=np.zeros(len(per_position)), where=per_position > 0), 2).tolist(),
+				"lower_quartile": quantile(0.25),
+				"median": quantile(0.5),
+				"upper_quartile": quantile(0.75)},
+			"position_bases": dict((base, np.round(100.0 * self.bases[:, i] / np.maximum(per_position, 1), 2).tolist())
+				for i, base in enumerate("ACGTN")),
+			"overrepresented_kmers": self.overrepresented_kmers()}
+
+
+def _svg_plot(series, width=640, height=200):
+	"""
+	Inline SVG line plot of named series of y values over their index.
+	"""
+	colors = ["#1f77b4", "#d62728", "#2ca02c", "#ff7f0e", "#7f7f7f"]
+	top = max([max(values) for values in series.values() if len(values)] + [1])
+	length = max([len(values) for values in series.values()] + [2])
+	lines = ['<svg width="{}" height="{}" style="border:1px solid #ccc">'.format(width, height + 20)]
+	for i, (name, values) in enumerate(series.items()):
+		points = " ".join("{:.1f},{:.1f}".format(x * width / float(length - 1), height - y * height / float(top))
+			for x, y in enumerate(values))
+		lines.append('<polyline fill="none" stroke="{}" points="{}"/>'.format(colors[i % len(colors)], points))
+		lines.append('<text x="{}" y="{}" fill="{}" font-size="12">{}</text>'.format(
+			5 + 90 * i, height + 15, colors[i % len(colors)], name))
+	lines.append("</svg>")
+	return "\n".join(lines)
+
+
+def write_report(prefix, name, summary):
+	"""
+	Write <prefix>_<name>_qc.json and <prefix>_<name>_qc.html.
+	"""
+	with open("{}_{}_qc.json".format(prefix, name), "w") as out:
+		json.dump(summary, out, indent=1, sort_keys=True)
+
+	quality = summary["position_quality"]
+	rows = "".join("<tr><td>{}</td><td>{}</td><td>{}</td></tr>".format(*kmer) for kmer in summary["overrepresented_kmers"])
+	with open("{}_{}_qc.html".format(prefix, name), "w") as out:
+		out.write("<html><head><title>Read QC {0}</title></head><body>\n<h1>Read QC {0}</h1>\n".format(name))
+		out.write("<p>{reads} reads, {bases} bases, mean length {mean_length}, mean quality {mean_quality} "
+			"(phred+{phred_offset}), GC {gc_content}%, N {n_content}%</p>\n".format(**summary))
+		out.write("<h2>Quality per position</h2>\n")
+		out.write(_svg_plot(dict((key, quality[key]) for key in ("mean", "median", "lower_quartile", "upper_quartile"))))
+		out.write("\n<h2>Bases per position (%)</h2>\n")
+		out.write(_svg_plot(summary["position_bases"]))
+		out.write("\n<h2>GC content per read (%)</h2>\n")
+		out.write(_svg_plot({"reads": summary["gc_histogram"]}))
+		out.write("\n<h2>Read length</h2>\n")
+		out.write(_svg_plot({"reads": summary["length_histogram"]}))
+		out.write("\n<h2>Overrepresented {}-mers</h2>\n".format(K))
+		out.write("<table><tr><th>k-mer</th><th>count</th><th>observed/expected</th></tr>{}</table>\n".format(rows))
+		out.write("</body></html>\n")
+
+
+def read_qc(stream, prefix, names=("R1",), count_file=None, batch_size=BATCH_SIZE):
+	"""
+	Collect the metrics of a fastq stream and write their reports.
+
+	:param stream: binary fastq stream
+	:param str prefix: prefix of the reports
+	:param tuple names: name of the reads, one per interleaved mate
+	:param str count_file: file to write the number of records to
+	:return dict: summary by name
+	"""
+	collectors = [ReadQC() for _ in names]
+	n_records = 0
+	while True:
+		lines = list(itertools.islice(stream, 4 * batch_size))
+		if len(lines) % 4:
+			raise Exception("Truncated fastq record at the end of the stream")
+		if not lines:
+			break
+		seqs = [line.rstrip(b"\r\n") for line in lines[1::4]]
+		quals = [line.rstrip(b"\r\n") for line in lines[3::4]]
+		# Mates alternate from the first record of the stream on.
+		for i, collector in enumerate(collectors):
+			first = (i - n_records) % len(names)
+			collector.add(seqs[first::len(names)], quals[first::len(names)])
+		n_records += len(seqs)
+
+	summaries = {}
+	for name, collector in zip(names, collectors):
+		summaries[name] = collector.summary()
+		write_report(prefix, name, summaries[name])
+	if count_file:
+		with open(count_file, "w") as out:
+			out.write("{} -\n".format(n_records))
+	return summaries
+
+
+if __name__ == "__main__":
+	parser = ArgumentParser(description="Read quality metrics of a fastq stream.")
+	parser.add_argument("-o", "--out-prefix", dest="prefix", required=True, help="Prefix of the reports.")
+	parser.add_argument("-n", "--names", dest="names", nargs="+", default=["R1"],
+		help="Name of the reads; two names for interleaved mates.")
+	parser.add_argument("-c", "--count-file", dest="count_file", default=None,
+		help="Write the number of records to this file.")
+	parser.add_argument("-i", "--input", dest="input", default="-", help="Fastq file; - for stdin.")
+	args = parser.parse_args()
+	stream = getattr(sys.stdin, "buffer", sys.stdin) if args.input == "-" else open(args.input, "rb")
+	read_qc(stream, args.prefix, args.names, args.count_file)
@@ -6,15 +6,153 @@ key with any number of column key specificities.
 I wrote it to pull output from biseq methcalling results, but it could
 be used for anything... just give a tsv file and a key column to pull, and any
 rows to restrict to if desired.
+
+Many row queries can be answered at once with -q: give a file (or - for stdin)
+with one query per line, each made of space-separated key=value pairs like the
+--rowmatch arguments. Answers are printed per query, prefixed with the query.
+With -x, a key index of the file is kept next to it (<file>.idx) and reused for
+as long as the file's size and modification time don't change, so lookups seek
+straight to the matching rows instead of scanning the file.
 """
 
 __author__ = "Nathan C. Sheffield"
 
 import sys, os, csv
+import pickle
 import subprocess
 from argparse import ArgumentParser
 
 
+def parse_query(query_string):
+	"""
+	Turn "key=value key2=value2" into a list of (key, value) pairs.
+
+	:raise ValueError: if a pair has no "="
+	"""
+	query = []
+	for pair in query_string.split():
+		if "=" not in pair:
+			raise ValueError("not a key=value pair: '{}' in query '{}'".format(pair, query_string))
+		query.append(tuple(pair.split("=", 1)))
+	return query
+
+
+def split_line(line):
+	"""
+	Fields of a line, read the way csv reads the file without an index.
+	"""
+	return next(csv.reader([line.decode().rstrip("\r\n")], delimiter="\t"), [])
+
+
+def make_row(fields, header):
+	"""
+	Row keyed by column name, or by column number without a header.
+	"""
+	if header:
+		return dict(zip(header, fields))
+	return dict(enumerate(fields))
+
+
+def row_matches(row, query):
+	return all(row.get(key) == value for key, value in query)
+
+
+def scan(input_file, header):
+	"""
+	Yield (byte offset, row) for every row of the file, skipping the header
+	line if there is one.
+	"""
+	with open(input_file, "rb") as handle:
+		offset = 0
+		if header:
+			offset = len(handle.readline())
+		for line in handle:
+			yield offset, make_row(split_line(line), header)
+			offset += len(line)
+
+
+def read_header(input_file):
+	with open(input_file, "rb") as handle:
+		return split_line(handle.readline())
+
+
+def load_index(input_file):
+	"""
+	Load the key index of a file, or start a new one if there is none or the
+	file changed since it was built.
+	"""
+	stat = os.stat(input_file)
+	try:
+		with open(input_file + ".idx", "rb") as handle:
+			index = pickle.load(handle)
+	except (IOError, OSError, EOFError, pickle.UnpicklingError):
+		index = None
+	if not index or index["mtime"] != stat.st_mtime or index["size"] != stat.st_size:
+		index = {"mtime": stat.st_mtime, "size": stat.st_size, "columns": {}}
+	return index
+
+
+def extend_index(input_file, index, keys, header):
+	"""
+	Add the columns in keys that are not indexed yet, in a single scan, and
+	save the index. Each column maps a value to the offsets of its rows.
+	"""
+	missing = [key for key in set(keys) if key not in index["columns"]]
+	if not missing:
+		return
+	columns = dict((key, {}) for key in missing)
+	for offset, row in scan(input_file, header):
+		for key in missing:
+			columns[key].setdefault(row.get(key), []).append(offset)
+	index["columns"].update(columns)
+	tmp = "{}.idx.{}".format(input_file, os.getpid())
+	with open(tmp, "wb") as handle:
+		pickle.dump(index, handle, 2)
+	os.rename(tmp, input_file + ".idx")
+
+
+def batch_lookup(input_file, queries, header):
+	"""
+	Answer all queries in a single pass over the file.
+
+	:return list: the matching rows of each query
+	"""
+	results = [[] for _ in queries]
+	# Queries are looked up by their first key=value pair; the rest is checked.
+	by_first = {}
+	for i, query in enumerate(queries):
+		by_first.setdefault(query[0], []).append(i)
+	first_keys = set(key for key, _ in by_first)
+	for _, row in scan(input_file, header):
+		for key in first_keys:
+			for i in by_first.get((key, row.get(key)), []):
+				if row_matches(row, queries[i]):
+					results[i].append(row)
+	return results
+
+
+def indexed_lookup(input_file, queries, header):
+	"""
+	Answer all queries by seeking to the rows given by the key index.
+
+	:return list: the matching rows of each query
+	"""
+	index = load_index(input_file)
+	extend_index(input_file, index, [query[0][0] for query in queries], header)
+	results = []
+	with open(input_file, "rb") as handle:
+		for query in queries:
+			key, value = query[0]
+			rows = []
+			for offset in index["columns"][key].get(value, []):
+				handle.seek(offset)
+				row = make_row(split_line(handle.readline()), header)
+				if row_matches(row, query):
+					rows.append(row)
+			results.append(rows)
+	return results
+
+
 parser = ArgumentParser(description='TSV Parser')
 
 parser.add_argument('-i', '--input-file', dest='input_file',
@@ -32,6 +170,17 @@ parser.add_argument('-r', '--rowmatch', dest='rowmatch',
 	key=value pairs are accepted.",
 	required=False)
 
+parser.add_argument('-q', '--queries', dest='queries',
+	default=None,
+	help="File with one row query per line (- for stdin), each in --rowmatch \
+	format; all queries are answered in a single pass.",
+	required=False)
+
+parser.add_argument('-x', '--index', dest='index',
+ 	default=False, action="store_true",
+	help="Keep a key index next to the file and use it for row queries.",
+	required=False)
+
 parser.add_argument('-k', '--keys', dest='include_keys',
  	default=False, action="store_true",
 	help="Print out keys? By default, No.",
@@ -44,6 +193,33 @@ parser.add_argument('-H', '--no-header', dest='header',
 
 args = parser.parse_args()
 
+if args.queries or (args.index and args.rowmatch):
+	if args.queries:
+		query_input = sys.stdin if args.queries == "-" else open(args.queries)
+		query_strings = [line.strip() for line in query_input if line.strip()]
+	else:
+		query_strings = [" ".join(args.rowmatch)]
+	try:
+		queries = [parse_query(query_string) for query_string in query_strings]
+		columns = args.column
+		if not args.header:
+			queries = [[(int(key), value) for key, value in query] for query in queries]
+			columns = [int(key) for key in columns]
+	except ValueError as e:
+		parser.error(str(e))
+	header = read_header(args.input_file) if args.header else []
+
+	lookup = indexed_lookup if args.index else batch_lookup
+	for query_string, rows in zip(query_strings, lookup(args.input_file, queries, header)):
+		prefix = [query_string] if args.queries else []
+		for row in rows:
+			for key in columns:
+				if args.include_keys:
+					print("\t".join(prefix + [str(key), row[key]]))
+				else:
+					print("\t".join(prefix + [row[key]]))
+	sys.exit(0)
+
 input_open = open(args.input_file, 'rb')
 if args.header:
 	f = csv.DictReader(input_open, delimiter="\t")
@@ -0,0 +1,75 @@
+"""
+Coverage tracks of contigs whose alignments are all filtered out.
+
+samtools is replaced by a script answering idxstats with mapped reads on
+every contig and view with no records, as for a contig holding only
+multimappers, secondary, duplicate or QC-failed alignments; without a
+mapping quality cutoff, chr1 has one read.
+"""
+
+import os
+import stat
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "src", "tools"))
+
+import bam_coverage
+import bigwig
+
+
+FAKE_SAMTOOLS = """#!/bin/sh
+if [ "$1" = idxstats ]; then
+	printf 'chr1\\t1000\\t5\\t0\\nchrUn\\t500\\t3\\t0\\n*\\t0\\t0\\t0\\n'
+elif [ "$2" = -H ]; then
+	printf '@SQ\\tSN:chr1\\tLN:1000\\n@SQ\\tSN:chrUn\\tLN:500\\n'
+elif [ "$1" = view ] && [ "$7" = chr1 ] && [ "$5" = 0 ]; then
+	printf 'r1\\t0\\tchr1\\t11\\t0\\t10M\\t*\\t0\\t0\\tAAAAAAAAAA\\t*\\n'
+fi
+"""
+
+
+def fake_samtools(folder):
+	path = os.path.join(str(folder), "samtools")
+	with open(path, "w") as out:
+		out.write(FAKE_SAMTOOLS)
+	os.chmod(path, os.stat(path).st_mode | stat.S_IEXEC)
+	return path
+
+
+def test_depth_runs_without_intervals():
+	none = np.zeros(0, dtype=np.int_)
+	starts, ends, depth = bam_coverage.depth_runs(none, none, 1000)
+	assert len(starts) == len(ends) == len(depth) == 0
+
+
+def test_depth_runs():
+	starts, ends, depth = bam_coverage.depth_runs(np.array([0, 5, 20]), np.array([10, 10, 30]), 25)
+	assert starts.tolist() == [0, 5, 20]
+	assert ends.tolist() == [5, 10, 25]
+	assert depth.tolist() == [1, 2, 1]
+
+
+def test_all_filtered_track(tmp_path):
+	output = str(tmp_path / "track.bw")
+	bam_coverage.bam_coverage("sample.bam", [("chr1", 1000), ("chrUn", 500)], output,
+		wigsum=1000, mapq=30, cores=2, samtools=fake_samtools(tmp_path))
+	track = bigwig.BigWig(output)
+	assert list(track.intervals("chr1")[0]) == []
+	assert np.isnan(track.values("chrUn", 0, 500)).all()
+	track.close()
+
+
+def test_all_filtered_depth(tmp_path):
+	# the depth track of the pipelines: raw depth, chromosomes from the header
+	samtools = fake_samtools(tmp_path)
+	output = str(tmp_path / "depth.bw")
+	bam_coverage.bam_coverage("sample.bam", bam_coverage.bam_chrom_sizes(samtools, "sample.bam"), output,
+		cores=2, samtools=samtools)
+	track = bigwig.BigWig(output)
+	starts, ends, depth = track.intervals("chr1")
+	assert (starts.tolist(), ends.tolist(), depth.tolist()) == ([10], [20], [1.0])
+	assert len(track.intervals("chrUn")[0]) == 0
+	assert track.mean("chrUn", 0, 500) == 0.0
+	track.close()
@@ -0,0 +1,49 @@
+"""
+Read counts of bam_stats.collect, with the read hashes spilled over several
+chunks and bucket files.
+"""
+
+import os
+import stat
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "src", "tools"))
+
+import bam_stats
+
+
+def fake_samtools(folder, records):
+	"""
+	samtools answering view with the given (name, flag, chrom) records.
+	"""
+	sam = os.path.join(str(folder), "records.sam")
+	with open(sam, "w") as out:
+		for name, flag, chrom in records:
+			out.write("\t".join([name, str(flag), chrom, "1", "255", "10M", "*", "0", "0", "A" * 10, "*"]) + "\n")
+	path = os.path.join(str(folder), "samtools")
+	with open(path, "w") as out:
+		out.write("#!/bin/sh\ncat " + sam + "\n")
+	os.chmod(path, os.stat(path).st_mode | stat.S_IEXEC)
+	return path
+
+
+def test_collect_counts_reads(tmp_path):
+	# 300 reads: every third has three alignments, and every tenth is unmapped
+	records = []
+	for i in range(300):
+		if i % 10 == 0:
+			records.append(("read%d" % i, 4, "*"))
+		elif i % 3 == 0:
+			records += [("read%d" % i, 0, "chr1"), ("read%d" % i, 256, "chr2"), ("read%d" % i, 256, "chr1")]
+		else:
+			records.append(("read%d" % i, 16, "chr1"))
+	bam = str(tmp_path / "sample.bam")
+	stats = bam_stats.collect(bam, samtools=fake_samtools(tmp_path, records), chunk_size=7)
+	multi = len([i for i in range(300) if i % 10 and i % 3 == 0])
+	assert stats["Aligned_reads"] == 270
+	assert stats["Multimapped_reads"] == multi
+	assert stats["Uniquely_mapped_reads"] == 270 - multi
+	assert stats["Secondary_alignments"] == 2 * multi
+	assert stats["Total_records"] == len(records)
+	# the bucket files are removed
+	assert not [name for name in os.listdir(str(tmp_path)) if name.startswith("sample.bam.stats")]
@@ -0,0 +1,53 @@
+"""
+Conversion rate of paired-end fragments, whose second mate reads the
+reverse complement of the fragment's strand.
+"""
+
+import os
+import sys
+from argparse import Namespace
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "src", "tools"))
+
+import bisulfiteReadFiltering_forRNA as bisulfite_filter
+import packed_genome
+
+
+# Non-CpG cytosines at 0-based 2, 4, 6 and 8 of the forward strand; none on
+# the reverse strand (no G).
+CHROM = "TTCACACACATT"
+
+
+def init(tmp_path, paired_end):
+	with open(str(tmp_path / "test.fa"), "w") as out:
+		out.write(">chr1\n" + CHROM + "\n")
+	packed_genome.build(str(tmp_path / "test.fa"))
+	bisulfite_filter.init_worker(Namespace(genome_dir=str(tmp_path), genome="test", paired_end=paired_end,
+		min_sites=3, min_rate=0.9, max_rate=0.1, reverse=False))
+
+
+def sam(name, flag, pos, seq, mate_pos):
+	return "\t".join([name, str(flag), "chr1", str(pos), "255", "{}M".format(len(seq)), "=", str(mate_pos),
+		"0", seq, "*"]).encode() + b"\n"
+
+
+def test_second_mate_counts_on_fragment_strand(tmp_path):
+	init(tmp_path, paired_end=True)
+	# A converted fragment of the forward strand: both mates read T at the
+	# cytosines, the second one aligned to the reverse strand.
+	converted = CHROM.replace("C", "T")
+	lines = [sam("r1", 1 + 2 + 32 + 64, 1, converted[:6], 5), sam("r1", 1 + 2 + 16 + 128, 5, converted[4:], 1)]
+	records = [(int(f[1]), f[2], int(f[3]) - 1, f[5], f[9]) for f in (l.split(b"\t") for l in lines)]
+	sites, converted_sites = bisulfite_filter._count_sites(records, paired_end=True)
+	assert sites.tolist() == [2, 3]
+	assert converted_sites.tolist() == [2, 3]
+	kept, skipped = bisulfite_filter.filter_chunk(lines)
+	assert kept == b"".join(lines) and skipped == b""
+
+
+def test_single_end_reverse_read(tmp_path):
+	init(tmp_path, paired_end=False)
+	# a single read on the reverse strand reads the G of the other strand
+	records = [(16, b"chr1", 0, b"12M", CHROM.replace("C", "T").encode())]
+	sites, converted_sites = bisulfite_filter._count_sites(records)
+	assert sites.tolist() == [0] and converted_sites.tolist() == [0]
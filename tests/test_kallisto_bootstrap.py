@@ -0,0 +1,52 @@
+"""
+Merging the abundance.h5 files of bootstrap shards, as kallisto writes them.
+"""
+
+import json
+import os
+import sys
+
+import h5py
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "src", "tools"))
+
+import kallisto_bootstrap
+import kallisto_h5
+
+
+IDS = ["ENST1", "ENST2", "ENST3"]
+
+
+def write_shard(folder, est_counts, bootstraps):
+	os.makedirs(folder)
+	aux = {"num_processed": [100], "kallisto_version": ["0.48.0"], "start_time": ["Mon Jan 1 2024"],
+		"call": ["kallisto quant -b {}".format(len(bootstraps))]}
+	kallisto_h5.write_abundance(os.path.join(folder, "abundance.h5"), IDS, [1000, 2000, 500],
+		[800.0, 1800.0, 300.0], est_counts, bootstraps, aux)
+	kallisto_h5.write_run_info(os.path.join(folder, "run_info.json"), len(IDS), len(bootstraps), 100, 90, aux)
+
+
+def test_shard_bounds():
+	assert kallisto_bootstrap.shard_bounds(10, 4) == [(0, 2), (2, 5), (5, 7), (7, 10)]
+	assert kallisto_bootstrap.shard_bounds(2, 8) == [(0, 1), (1, 2)]
+
+
+def test_merge_shards(tmp_path):
+	first, second = str(tmp_path / "shard0"), str(tmp_path / "shard1")
+	write_shard(first, [10.0, 50.0, 30.0], [[11.0, 49.0, 30.0], [9.0, 52.0, 29.0]])
+	write_shard(second, [10.0, 50.0, 30.0], [[12.0, 48.0, 30.0]])
+	assert kallisto_bootstrap.merge_shards([first, second], str(tmp_path)) == 3
+
+	merged = kallisto_h5.read_abundance(str(tmp_path / "abundance.h5"))
+	assert merged["ids"].tolist() == IDS
+	assert merged["est_counts"].tolist() == [10.0, 50.0, 30.0]
+	assert merged["bootstraps"][:, 0].tolist() == [11.0, 9.0, 12.0]
+	with h5py.File(str(tmp_path / "abundance.h5"), "r") as h5:
+		# variable-length strings, as kallisto writes them
+		for key in ("ids", "call", "kallisto_version", "start_time"):
+			assert h5py.check_string_dtype(h5["aux"][key].dtype).length is None
+		assert h5["aux/num_bootstrap"][0] == 3
+	with open(str(tmp_path / "run_info.json")) as handle:
+		assert json.load(handle)["n_bootstraps"] == 3
+	assert os.path.exists(str(tmp_path / "bs_abundance_2.tsv"))